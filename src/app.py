@@ -1,14 +1,113 @@
-from whilelexel import WhileLexer
-from whileparser import WhileParser
+import mmap
+import os
+import sys
+
+from implementation import PRINTER, INTERPRETER, COMPILER, BYTECODE, CHECKER, CLOSURES, PYTHON, \
+    PYTHON_SOURCE, COMPILER_64, VECTORIZED, TARGETS, Diagnostic, compilation
+from programcache import compile_cached
+from whilelexel import tokenize_blocks
+from whileparser import WhileParser, run_program
+
+MODES = {
+    "-p": PRINTER,
+    "-i": INTERPRETER,
+    "-c": COMPILER,
+    "-x": COMPILER_64,
+    "-b": BYTECODE,
+    "-v": VECTORIZED,
+    "-l": CLOSURES,
+    "-y": PYTHON,
+    "-g": PYTHON_SOURCE,
+}
 
 
 def readfile(file_name: str) -> str:
     with open(file_name, 'r') as f:
         return f.read()
 
+
+def usage():
+    print("Usage: {0} [--stream] [--no-cache] [--stats] [(-p|-i|-c|-x|-b|-v|-l|-y|-g) inputfile [-o outputfile]]\n"
+          "       {0} [--jobs N] [--no-cache] [--stats] (-p|-i|-c|-x|-b|-v|-l|-y|-g) (inputfile|directory|pattern)...\n"
+          "       {0} [--no-cache] [--stats] -v inputfile --inputs (stdinfile|pattern)..."
+          .format(sys.argv[0]),
+          file=sys.stderr)
+    exit(1)
+
+
+def print_statistics(file_name: str, eliminated_evaluations: int):
+    print("{0}: {1} evaluations removed by common subexpression elimination".format(file_name, eliminated_evaluations),
+          file=sys.stderr)
+
+
+def parse_stream(parser: WhileParser, file_name: str):
+    """Lexes the memory-mapped file block by block, so neither the source nor its tokens are held in memory."""
+    with open(file_name, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped.
+            data = b""
+        try:
+            parser.parse_token_blocks(tokenize_blocks(data))
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
 if __name__ == '__main__':
-    lexer = WhileLexer()
-    parser = WhileParser()
+    arguments = sys.argv[1:]
+    streaming = False
+    use_cache = True
+    statistics = False
+    jobs = None
+    while arguments and arguments[0].startswith("--"):
+        option = arguments.pop(0)
+        if option == "--stream":
+            streaming = True
+        elif option == "--no-cache":
+            use_cache = False
+        elif option == "--stats":
+            statistics = True
+        elif option == "--jobs" and arguments and arguments[0].isdigit() and int(arguments[0]) >= 1:
+            jobs = int(arguments.pop(0))
+        else:
+            usage()
+    mode = PRINTER
+    file_names = ['../test/00.test']
+    input_names = None
+    output_file_name = None
+    if arguments:
+        if len(arguments) < 2 or arguments[0] not in MODES:
+            usage()
+        mode = MODES[arguments[0]]
+        file_names = arguments[1:]
+        if "--inputs" in file_names:
+            # The program runs once on all the inputs.
+            if len(file_names) < 3 or file_names[1] != "--inputs" or mode != VECTORIZED or jobs is not None \
+                    or streaming:
+                usage()
+            from vectorized import input_file_names
+            input_names = input_file_names(file_names[2:])
+            file_names = file_names[:1]
+        if "-o" in file_names:
+            if len(file_names) != 3 or file_names[1] != "-o" or mode not in TARGETS:
+                usage()
+            output_file_name = file_names[2]
+            file_names = file_names[:1]
+
+    # Several files, directories and patterns are compiled by a pool of worker processes.
+    if jobs is not None or len(file_names) != 1 or not os.path.isfile(file_names[0]):
+        if streaming or output_file_name:
+            usage()
+        from batch import expand_file_names, print_batch
+        exit(print_batch(mode, expand_file_names(file_names), jobs or 1, use_cache, statistics))
+    file_name = file_names[0]
+
+    # The assembly is written in large blocks, a big buffer keeps the writes to the file few.
+    output = open(output_file_name, 'w', buffering=1 << 16) if output_file_name else None
+    # Without streaming the parser only checks and optimizes the program, which may come from the cache instead.
+    parser = WhileParser(mode if streaming else CHECKER, output, streaming)
     # while True:
     #     try:
     #         text = input('calc > ')
@@ -17,6 +116,27 @@ if __name__ == '__main__':
     #     if text:
     #         parser.parse(lexer.tokenize(text))
 
-    text = readfile('../test/00.test')
-    tokenz = lexer.tokenize(text)
-    parser.parse(tokenz)
\ No newline at end of file
+    status = 0
+    try:
+        if streaming:
+            parse_stream(parser, file_name)
+        else:
+            program = compile_cached(parser, readfile(file_name), use_cache)
+            if program is not None and input_names is not None:
+                from vectorized import print_lanes
+                status = print_lanes(program[1], input_names)
+            elif program is not None:
+                run_program(mode, program[0], program[1], output)
+        if statistics:
+            print_statistics(file_name, compilation().eliminated_evaluations)
+    except Diagnostic as diagnostic:
+        print(diagnostic)
+        exit(1)
+    except RecursionError as exception:
+        from program import runtime_diagnostic
+        print(runtime_diagnostic(exception))
+        exit(1)
+    finally:
+        if output:
+            output.close()
+    exit(status)
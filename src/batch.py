@@ -0,0 +1,124 @@
+import glob
+import io
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Iterator
+
+from implementation import CHECKER, Diagnostic, compilation, reset_state
+from programcache import compile_cached
+from whileparser import WhileParser, run_program
+
+# The parser of the worker process, created once by start_worker() and reused for every file, and the settings of
+# the batch.
+worker_parser: WhileParser = None
+worker_mode: int = None
+worker_use_cache = True
+
+
+class BatchResult:
+    """The outcome of one file of a batch: what the program wrote, its exit status, the time it took and the
+    computations removed by the optimizer."""
+
+    def __init__(self, file_name: str, output: str, errors: str, status: int, seconds: float,
+                 eliminated_evaluations: int = 0):
+        self.file_name = file_name
+        self.output = output
+        self.errors = errors
+        self.status = status
+        self.seconds = seconds
+        self.eliminated_evaluations = eliminated_evaluations
+
+
+def expand_file_names(arguments: List[str]) -> List[str]:
+    """Expands the directories and the glob patterns, which the shell may have left as they are. The files of a
+    directory are taken in name order, without the input (.in) and expected output (.out) files of the tests."""
+    file_names = []
+    for argument in arguments:
+        if os.path.isdir(argument):
+            file_names.extend(os.path.join(argument, name) for name in sorted(os.listdir(argument))
+                              if os.path.splitext(name)[1] not in (".in", ".out")
+                              and os.path.isfile(os.path.join(argument, name)))
+        elif glob.has_magic(argument):
+            file_names.extend(sorted(glob.glob(argument)))
+        else:
+            file_names.append(argument)
+    return file_names
+
+
+def start_worker(mode: int, use_cache: bool):
+    global worker_parser, worker_mode, worker_use_cache
+    worker_parser = WhileParser(CHECKER)
+    worker_mode = mode
+    worker_use_cache = use_cache
+
+
+def input_of(file_name: str) -> str:
+    """The standard input of a program is read from the .in file next to it, as in the tests."""
+    input_file_name = os.path.splitext(file_name)[0] + ".in"
+    if not os.path.isfile(input_file_name):
+        return ""
+    with open(input_file_name, 'r') as f:
+        return f.read()
+
+
+def run_file(file_name: str) -> BatchResult:
+    """Compiles and runs one file on the parser of the worker, with the standard streams redirected."""
+    output = io.StringIO()
+    errors = io.StringIO()
+    status = 0
+    old_streams = sys.stdin, sys.stdout, sys.stderr
+    start = time.perf_counter()
+    try:
+        sys.stdin, sys.stdout, sys.stderr = io.StringIO(input_of(file_name)), output, errors
+        reset_state()
+        with open(file_name, 'r') as f:
+            text = f.read()
+        program = compile_cached(worker_parser, text, worker_use_cache)
+        if program is not None:
+            run_program(worker_mode, program[0], program[1])
+    except Diagnostic as diagnostic:
+        output.write("{0}\n".format(diagnostic))
+        status = 1
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = old_streams
+    return BatchResult(file_name, output.getvalue(), errors.getvalue(), status, time.perf_counter() - start,
+                       compilation().eliminated_evaluations)
+
+
+def run_batch(mode: int, file_names: List[str], jobs: int, use_cache: bool) -> Iterator[BatchResult]:
+    """Runs the files in a pool of jobs worker processes, and yields the results in the order of the files."""
+    if jobs == 1:
+        start_worker(mode, use_cache)
+        for file_name in file_names:
+            yield run_file(file_name)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=start_worker, initargs=(mode, use_cache)) as executor:
+        # Several files are sent to a worker at once, so many small files do not wait on the pipes to the workers.
+        chunk_size = max(1, len(file_names) // (jobs * 4))
+        yield from executor.map(run_file, file_names, chunksize=chunk_size)
+
+
+def print_batch(mode: int, file_names: List[str], jobs: int, use_cache: bool = True, statistics: bool = False) -> int:
+    """Prints the output of every file after a header, and its status and time (and with statistics, the
+    computations removed by the optimizer) to the standard error. Returns the highest exit status."""
+    status = 0
+    for result in run_batch(mode, file_names, jobs, use_cache):
+        if len(file_names) > 1:
+            print("==> {0} <==".format(result.file_name))
+        sys.stdout.write(result.output)
+        sys.stdout.flush()
+        sys.stderr.write(result.errors)
+        print("{0}: exit {1} in {2:.3f}s".format(result.file_name, result.status, result.seconds), file=sys.stderr)
+        if statistics:
+            print("{0}: {1} evaluations removed by common subexpression elimination".format(
+                result.file_name, result.eliminated_evaluations), file=sys.stderr)
+        status = max(status, result.status)
+    return status
@@ -0,0 +1,366 @@
+import gc
+import glob
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List
+
+from implementation import *
+from peephole import generate_optimized_code
+from app import readfile, parse_stream
+from bytecode import compile_bytecode, execute_bytecode
+from pythoncode import generate_python
+from vectorized import execute_lanes
+from whilelexel import WhileLexer, tokenize
+from whileparser import WhileParser
+
+# Nested loops with arithmetic in the innermost body. The initial values are read so the constant merge
+# optimizer cannot fold the loop counters.
+LOOP_PROGRAM = """
+program loops
+    natural n
+    natural i
+    natural j
+    natural sum
+begin
+    read(n)
+    read(sum)
+    i := n
+    while i > 0 do
+        j := i
+        while j > 0 do
+            sum := sum + j % 7
+            j := j - 1
+        done
+        i := i - 1
+    done
+    write(sum)
+end
+"""
+
+# Reads numbers until a 0 and writes each of them back.
+ECHO_PROGRAM = """
+program echo
+    natural n
+begin
+    read(n)
+    while n > 0 do
+        write(n + 1)
+        read(n)
+    done
+end
+"""
+
+# A machine generated program: the statements below are repeated many times.
+GENERATED_DECLARATIONS = """
+program generated
+    natural a
+    natural b
+    boolean c
+begin
+    read(a)
+    read(b)
+    c := false
+"""
+
+GENERATED_STATEMENTS = """
+    a := a + b * 3 - 1
+    c := a < b and not c
+    if c then
+        b := b + 100
+    endif
+    write(a % 1000)
+"""
+
+REPEAT = 3
+
+
+def parse(text: str) -> List[Instruction]:
+    reset_state()
+    return WhileParser(CHECKER).parse_token_arrays(tokenize(text))
+
+
+def count_statements(commands: List[Instruction]) -> int:
+    count = 0
+    for command in commands:
+        count += 1
+        if isinstance(command, IfInstruction):
+            count += count_statements(command.true_branch) + count_statements(command.false_branch)
+        elif isinstance(command, (WhileInstruction, RepeatInstruction)):
+            count += count_statements(command.body)
+    return count
+
+
+def run(function: Callable, stdin: str) -> (float, str):
+    stdout = io.StringIO()
+    old_stdin, old_stdout = sys.stdin, sys.stdout
+    sys.stdin, sys.stdout = io.StringIO(stdin), stdout
+    try:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdin, sys.stdout = old_stdin, old_stdout
+    return elapsed, stdout.getvalue()
+
+
+def best_of(function: Callable, stdin: str) -> (float, str):
+    results = [run(function, stdin) for _ in range(REPEAT)]
+    return min(it[0] for it in results), results[0][1]
+
+
+def benchmark_execution(name: str, text: str, stdin: str):
+    commands = parse(text)
+    bytecode = compile_bytecode(commands)
+    program = compile_to_closures(commands)
+    python_program = generate_python(name, commands)
+    modes = [
+        ("tree", lambda: execute_program(commands)),
+        ("bytecode", lambda: execute_bytecode(bytecode)),
+        ("closures", lambda: program()),
+        ("python", lambda: python_program.run()),
+    ]
+    tree_time, tree_output = best_of(modes[0][1], stdin)
+    s = "{0:<20} tree: {1:8.3f}s".format(name, tree_time)
+    for mode, function in modes[1:]:
+        elapsed, output = best_of(function, stdin)
+        if output != tree_output:
+            print("{0}: output of the {1} mode differs".format(name, mode))
+            exit(1)
+        s += "   {0}: {1:8.3f}s ({2:.2f}x)".format(mode, elapsed, tree_time / elapsed)
+    print(s)
+
+
+def benchmark_lexer(name: str, text: str):
+    sly_time, count = min((timed(lambda: len(list(WhileLexer().tokenize(text)))) for _ in range(REPEAT)))
+    fast_time, fast_count = min((timed(lambda: len(tokenize(text))) for _ in range(REPEAT)))
+    if count != fast_count:
+        print("{0}: the lexers produce different tokens".format(name))
+        exit(1)
+    print("{0:<20} sly lexer: {1:8.0f} tokens/s   fast lexer: {2:8.0f} tokens/s ({3:.2f}x)".format(
+        name, count / sly_time, count / fast_time, sly_time / fast_time))
+
+
+def timed(function: Callable) -> (float, int):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def benchmark_memory(name: str, text: str):
+    gc.collect()
+    tracemalloc.start()
+    commands = parse(text)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    statements = count_statements(commands)
+    print("{0:<20} {1} statements: {2:.1f} bytes per statement".format(name, statements, size / statements))
+
+
+def peak_memory(function: Callable) -> int:
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_streaming(name: str, text: str):
+    """The peak memory of checking a program file read as a whole and streamed from a memory map."""
+    with tempfile.NamedTemporaryFile('w', suffix=".w", delete=False) as f:
+        f.write(text)
+    try:
+        reset_state()
+        whole = peak_memory(lambda: WhileParser(CHECKER).parse_token_arrays(tokenize(readfile(f.name))))
+        reset_state()
+        streamed = peak_memory(lambda: parse_stream(WhileParser(CHECKER, streaming=True), f.name))
+    finally:
+        os.remove(f.name)
+    print("{0:<20} peak whole: {1:8.1f}MB   streamed: {2:8.1f}MB".format(name, whole / 1e6, streamed / 1e6))
+
+
+def chain_source(terms: int, op: str, variables: List[str], constant: str) -> str:
+    """A left associative chain of the operator, alternating variables and constants."""
+    return variables[0] + "".join(" {0} {1}".format(op, constant if i % 2 else variables[i // 2 % len(variables)])
+                                  for i in range(1, terms))
+
+
+def benchmark_optimizer(sizes: List[int]):
+    """Checks and optimizes programs with long machine generated expressions, through the parser and at the default
+    recursion limit like the command line interpreter: the time per term should not grow with the length of the
+    chain. The passes over an expression recurse once per operator, so a chain of more than about 950 operators is
+    reported as nested too deeply."""
+    for size in sizes:
+        text = (GENERATED_DECLARATIONS + "    write({0})\n    write({1})\nend\n".format(
+            chain_source(size, "+", ["a", "b"], "1"), chain_source(size, "and", ["c"], "true")))
+        elapsed, _ = timed(lambda: parse(text))
+        print("{0:<20} {1:6} terms: {2:8.3f}s ({3:.2f}us per term)".format(
+            "check and optimize", size, elapsed, elapsed / (2 * size) * 1e6))
+
+
+def assembly(text: str, peephole: bool, target: Target = X86) -> str:
+    commands = parse(text)
+    compilation().target = target
+    sink = io.StringIO()
+    out = Emitter(sink)
+    generate_prologue(out)
+    if peephole:
+        generate_optimized_code(commands, out)
+    else:
+        generate_code_of_commands(commands, out)
+    generate_epilogue(out)
+    return sink.getvalue()
+
+
+def count_instructions(code: str) -> int:
+    text = code[code.index("section .text"):]
+    return sum(1 for it in text.splitlines()[2:] if it and not it.endswith(":"))
+
+
+def run_native(directory: str, name: str, code: str, stdin: str, target: Target = X86) -> float:
+    """Assembles and links the code with io.c like the Makefile does, and returns the best running time."""
+    base = os.path.join(directory, name)
+    with open(base + ".asm", 'w') as f:
+        f.write(code)
+    subprocess.run(["nasm", "-f" + target.object_format, base + ".asm"], check=True)
+    subprocess.run(["gcc"] + target.gcc_options + [base + ".o", "../io.c", "-o", base], check=True)
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        subprocess.run([base], input=stdin.encode(), stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_peephole(programs: List[tuple]):
+    """The instructions of the generated code without and with the peephole optimizer, and the running times of the
+    linked programs when nasm and gcc are installed."""
+    native = shutil.which("nasm") is not None and shutil.which("gcc") is not None
+    with tempfile.TemporaryDirectory() as directory:
+        for name, text, stdin in programs:
+            plain, optimized = assembly(text, False), assembly(text, True)
+            before, after = count_instructions(plain), count_instructions(optimized)
+            s = "{0:<20} instructions: {1:5} -> {2:5} ({3:.0f}%)".format(
+                name, before, after, 100 * (before - after) / before)
+            if native:
+                plain_time = run_native(directory, name + "_plain", plain, stdin)
+                optimized_time = run_native(directory, name + "_peephole", optimized, stdin)
+                s += "   time: {0:8.3f}s -> {1:8.3f}s ({2:.2f}x)".format(
+                    plain_time, optimized_time, plain_time / optimized_time)
+            print(s)
+
+
+def benchmark_targets(programs: List[tuple]):
+    """The instructions of the 32 bit and of the 64 bit code, which keeps the variables of loops in registers, and
+    the running times of the linked programs when nasm and gcc are installed."""
+    native = shutil.which("nasm") is not None and shutil.which("gcc") is not None
+    with tempfile.TemporaryDirectory() as directory:
+        for name, text, stdin in programs:
+            code, code_64 = assembly(text, True), assembly(text, True, X86_64)
+            s = "{0:<20} instructions: 32 bit {1:5}   64 bit {2:5}".format(
+                name, count_instructions(code), count_instructions(code_64))
+            if native:
+                time_32 = run_native(directory, name + "_32", code, stdin)
+                time_64 = run_native(directory, name + "_64", code_64, stdin, X86_64)
+                s += "   time: {0:8.3f}s -> {1:8.3f}s ({2:.2f}x)".format(time_32, time_64, time_32 / time_64)
+            print(s)
+
+
+def test_programs() -> List[tuple]:
+    """The test programs with their inputs, as in the Makefile."""
+    programs = []
+    for file_name in sorted(glob.glob("../test/test_*.ok")):
+        base = file_name[:-len(".ok")]
+        stdin = ""
+        for input_file in (base + ".in", base + ".out" if base.endswith("test_read") else None):
+            if input_file is not None and os.path.exists(input_file):
+                stdin = readfile(input_file)
+        programs.append((os.path.basename(base), readfile(file_name), stdin))
+    return programs
+
+
+def run_command(command: List[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def benchmark_startup(file_name: str):
+    """Runs the command line interpreter on a short program, after removing the cached parser tables (cold) and
+    with the tables it has just saved (warm)."""
+    command = [sys.executable, "app.py", "-i", file_name]
+    cold_times = []
+    warm_times = []
+    for _ in range(REPEAT):
+        if os.path.exists(WhileParser.tables_file):
+            os.remove(WhileParser.tables_file)
+        cold_times.append(run_command(command))
+        warm_times.append(run_command(command))
+    cold, warm = min(cold_times), min(warm_times)
+    print("{0:<20} cold: {1:8.3f}s   warm: {2:8.3f}s ({3:.2f}x)".format("startup", cold, warm, cold / warm))
+
+
+def benchmark_lanes(name: str, text: str, inputs: List[str]):
+    """Runs the program on every input with the tree interpreter, and once on all of them with the vectorized
+    lanes."""
+    commands = parse(text)
+
+    def run_tree() -> List[str]:
+        outputs = []
+        for stdin in inputs:
+            reset_frame()
+            outputs.append(run(lambda: execute_program(commands), stdin)[1])
+        return outputs
+    tree_time, tree_outputs = min(timed(run_tree) for _ in range(REPEAT))
+    lanes_time, results = min(timed(lambda: execute_lanes(commands, inputs)) for _ in range(REPEAT))
+    if [it.output for it in results] != tree_outputs:
+        print("{0}: output of the lanes differs".format(name))
+        exit(1)
+    print("{0:<20} {1} inputs   tree: {2:8.3f}s   lanes: {3:8.3f}s ({4:.2f}x)".format(
+        name, len(inputs), tree_time, lanes_time, tree_time / lanes_time))
+
+
+def benchmark_io(lines: int):
+    """Runs the command line interpreter on a program that reads and writes every line, with the standard streams
+    redirected to a file and a pipe."""
+    with tempfile.TemporaryDirectory() as directory:
+        program_name = os.path.join(directory, "echo.w")
+        input_name = os.path.join(directory, "echo.in")
+        with open(program_name, 'w') as f:
+            f.write(ECHO_PROGRAM)
+        with open(input_name, 'w') as f:
+            f.write("".join("{0}\n".format(i) for i in range(1, lines + 1)) + "0\n")
+        times = []
+        for _ in range(REPEAT):
+            with open(input_name) as stdin:
+                start = time.perf_counter()
+                subprocess.run([sys.executable, "app.py", "--no-cache", "-i", program_name], stdin=stdin,
+                               stdout=subprocess.PIPE, check=True)
+                times.append(time.perf_counter() - start)
+    elapsed = min(times)
+    print("{0:<20} {1:8.3f}s ({2:.0f} lines/s)".format("read and write", elapsed, lines / elapsed))
+
+
+if __name__ == '__main__':
+    benchmark_startup("../test/test_write_natural.ok")
+    generated_program = GENERATED_DECLARATIONS + GENERATED_STATEMENTS * 25000 + "end\n"
+    benchmark_lexer("generated program", generated_program)
+    benchmark_memory("generated program", generated_program)
+    benchmark_streaming("generated program", generated_program)
+    benchmark_optimizer([200, 400, 800])
+    benchmark_peephole(test_programs() + [("nested loops", LOOP_PROGRAM, "1000\n0\n")])
+    benchmark_targets(test_programs() + [("nested loops", LOOP_PROGRAM, "1000\n0\n")])
+    benchmark_execution("nested loops", LOOP_PROGRAM, "1000\n0\n")
+    with open("../test/test_looping.ok") as f:
+        benchmark_execution("test_looping", f.read(), "20000\n10000\n0\n")
+    benchmark_io(200000)
+    with open("../test/test_divisor.ok") as f:
+        benchmark_lanes("test_divisor", f.read(), ["{0}\n0\n".format(n) for n in range(2, 4002)])
+    benchmark_lanes("nested loops", LOOP_PROGRAM, ["{0}\n{1}\n".format(n % 100, n) for n in range(2000)])
@@ -0,0 +1,412 @@
+from typing import List, Dict, Set
+
+from implementation import *
+
+# Opcodes. Every instruction is an opcode followed by a fixed number of integer arguments. The arguments are
+# slots of the frame (variables, pooled constants and temporaries) or absolute jump targets.
+MOVE = 0            # MOVE destination source
+ADD = 1             # ADD destination left right (the same layout for every binary operator)
+SUB = 2
+MUL = 3
+DIV = 4
+MOD = 5
+LESS = 6
+GREATER = 7
+LESS_EQ = 8
+GREATER_EQ = 9
+EQUAL = 10
+AND = 11
+OR = 12
+NOT = 13            # NOT destination source
+JUMP = 14           # JUMP target
+JUMP_IF_FALSE = 15  # JUMP_IF_FALSE condition target
+REPEAT = 16         # REPEAT counter target: decrements the counter and jumps to the target, unless it ran out
+READ_NATURAL = 17   # READ_NATURAL destination
+READ_BOOLEAN = 18   # READ_BOOLEAN destination
+WRITE_NATURAL = 19  # WRITE_NATURAL source
+WRITE_BOOLEAN = 20  # WRITE_BOOLEAN source
+HALT = 21
+JUMP_IF_TRUE = 22   # JUMP_IF_TRUE condition target
+JUMP_LESS = 23      # JUMP_LESS left right target (the same layout for every comparison)
+JUMP_GREATER = 24
+JUMP_LESS_EQ = 25
+JUMP_GREATER_EQ = 26
+JUMP_EQUAL = 27
+JUMP_NOT_EQUAL = 28
+CHECK = 29          # CHECK variable: stops the program when the variable has not been assigned yet
+
+BINARY_OPCODES = {
+    "+": ADD,
+    "-": SUB,
+    "*": MUL,
+    "/": DIV,
+    "%": MOD,
+    "<": LESS,
+    ">": GREATER,
+    "<=": LESS_EQ,
+    ">=": GREATER_EQ,
+    "=": EQUAL,
+    "and": AND,
+    "or": OR,
+}
+
+# A comparison that decides a jump, and the comparison that jumps when it is false.
+COMPARISON_JUMPS = {
+    "<": JUMP_LESS,
+    ">": JUMP_GREATER,
+    "<=": JUMP_LESS_EQ,
+    ">=": JUMP_GREATER_EQ,
+    "=": JUMP_EQUAL,
+}
+NEGATED_COMPARISON_JUMPS = {
+    "<": JUMP_GREATER_EQ,
+    ">": JUMP_LESS_EQ,
+    "<=": JUMP_GREATER,
+    ">=": JUMP_LESS,
+    "=": JUMP_NOT_EQUAL,
+}
+
+OPCODE_NAMES = ["MOVE", "ADD", "SUB", "MUL", "DIV", "MOD", "LESS", "GREATER", "LESS_EQ", "GREATER_EQ", "EQUAL",
+                "AND", "OR", "NOT", "JUMP", "JUMP_IF_FALSE", "REPEAT", "READ_NATURAL", "READ_BOOLEAN",
+                "WRITE_NATURAL", "WRITE_BOOLEAN", "HALT", "JUMP_IF_TRUE", "JUMP_LESS", "JUMP_GREATER", "JUMP_LESS_EQ",
+                "JUMP_GREATER_EQ", "JUMP_EQUAL", "JUMP_NOT_EQUAL", "CHECK"]
+
+JUMP_OPCODES = {JUMP, JUMP_IF_FALSE, JUMP_IF_TRUE, REPEAT, JUMP_LESS, JUMP_GREATER, JUMP_LESS_EQ, JUMP_GREATER_EQ,
+                JUMP_EQUAL, JUMP_NOT_EQUAL}
+
+ARGUMENT_COUNT = [2, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 2, 1, 2, 2, 1, 1, 1, 1, 0, 2, 3, 3, 3, 3, 3, 3, 1]
+
+
+class Bytecode:
+
+    def __init__(self):
+        self.code: List[int] = []
+        self.lines: List[int] = []
+        self.names: List[str] = []
+        self.frame: List[int] = []
+        self.variables: Dict[str, int] = {}
+        self.constants: Dict[int, int] = {}
+        self.free_temporaries: List[int] = []
+        # The variables that are assigned on every path to the code being compiled. The others are checked when
+        # they are read.
+        self.assigned: Set[str] = set()
+
+    def variable(self, name: str) -> int:
+        if name not in self.variables:
+            self.variables[name] = self.new_slot(name, None)
+        return self.variables[name]
+
+    def constant(self, value: int) -> int:
+        if value not in self.constants:
+            self.constants[value] = self.new_slot(str(value), value)
+        return self.constants[value]
+
+    def temporary(self) -> int:
+        if self.free_temporaries:
+            return self.free_temporaries.pop()
+        return self.new_slot("<temporary>", None)
+
+    def release(self, slot: int):
+        if self.names[slot] == "<temporary>" and slot not in self.free_temporaries:
+            self.free_temporaries.append(slot)
+
+    def new_slot(self, name: str, value) -> int:
+        self.names.append(name)
+        self.frame.append(value)
+        return len(self.frame) - 1
+
+    def emit(self, line: int, opcode: int, *arguments: int) -> int:
+        position = len(self.code)
+        self.code.append(opcode)
+        self.code.extend(arguments)
+        self.lines.extend([line] * (1 + len(arguments)))
+        return position
+
+    def patch(self, position: int, target: int):
+        self.code[position + ARGUMENT_COUNT[self.code[position]]] = target
+
+    def here(self) -> int:
+        return len(self.code)
+
+    def disassemble(self) -> str:
+        s = ""
+        pc = 0
+        while pc < len(self.code):
+            opcode = self.code[pc]
+            arguments = self.code[pc + 1:pc + 1 + ARGUMENT_COUNT[opcode]]
+            if opcode in JUMP_OPCODES:
+                arguments = ["[{0}]".format(it) for it in arguments[:-1]] + [str(arguments[-1])]
+            else:
+                arguments = ["[{0}]".format(it) for it in arguments]
+            s += "{0:>6} {1:<14} {2}\n".format(pc, OPCODE_NAMES[opcode], " ".join(arguments))
+            pc += 1 + ARGUMENT_COUNT[opcode]
+        for slot, name in enumerate(self.names):
+            s += "{0:>6} [{1}] {2}\n".format("", slot, name)
+        return s
+
+
+def compile_bytecode(commands: List[Instruction]) -> Bytecode:
+    bytecode = Bytecode()
+    for name in compilation().symbol_table:
+        bytecode.variable(name)
+    compile_commands(bytecode, commands)
+    bytecode.emit(-1, HALT)
+    return bytecode
+
+
+def compile_commands(bytecode: Bytecode, commands: List[Instruction]):
+    for command in commands:
+        compile_instruction(bytecode, command)
+
+
+def compile_instruction(bytecode: Bytecode, command: Instruction):
+    line = command.line
+    if isinstance(command, AssignInstruction):
+        compile_expression(bytecode, command.right, line, bytecode.variable(command.left))
+        bytecode.assigned.add(command.left)
+
+    elif isinstance(command, ReadInstruction):
+        if command.symbol.symbol_type == NATURAL:
+            bytecode.emit(line, READ_NATURAL, bytecode.variable(command.id))
+        else:
+            bytecode.emit(line, READ_BOOLEAN, bytecode.variable(command.id))
+        bytecode.assigned.add(command.id)
+
+    elif isinstance(command, WriteInstruction):
+        slot = compile_expression(bytecode, command.exp, line)
+        bytecode.emit(line, WRITE_NATURAL if command.exp_type == NATURAL else WRITE_BOOLEAN, slot)
+        bytecode.release(slot)
+
+    elif isinstance(command, IfInstruction):
+        else_jump = compile_jump(bytecode, command.condition, line, False)
+        assigned = set(bytecode.assigned)
+        compile_commands(bytecode, command.true_branch)
+        if command.false_branch:
+            end_jump = bytecode.emit(line, JUMP, 0)
+            bytecode.patch(else_jump, bytecode.here())
+            true_assigned, bytecode.assigned = bytecode.assigned, assigned
+            compile_commands(bytecode, command.false_branch)
+            bytecode.assigned &= true_assigned
+            bytecode.patch(end_jump, bytecode.here())
+        else:
+            bytecode.patch(else_jump, bytecode.here())
+            bytecode.assigned = assigned
+
+    elif isinstance(command, WhileInstruction):
+        # The condition is tested after the body, which saves a jump in every iteration.
+        assigned = set(bytecode.assigned)
+        test_jump = bytecode.emit(line, JUMP, 0)
+        begin = bytecode.here()
+        compile_commands(bytecode, command.body)
+        bytecode.patch(test_jump, bytecode.here())
+        bytecode.assigned = assigned
+        bytecode.patch(compile_jump(bytecode, command.condition, line, True), begin)
+
+    elif isinstance(command, RepeatInstruction):
+        # The count is evaluated once, into a counter that is reserved for the whole loop.
+        counter = bytecode.temporary()
+        compile_expression(bytecode, command.count, line, counter)
+        assigned = set(bytecode.assigned)
+        test_jump = bytecode.emit(line, JUMP, 0)
+        begin = bytecode.here()
+        compile_commands(bytecode, command.body)
+        bytecode.patch(test_jump, bytecode.emit(line, REPEAT, counter, begin))
+        bytecode.assigned = assigned
+        bytecode.release(counter)
+
+    else:
+        error(line, "Bug: Unsupported instruction: {0}".format(type(command).__name__))
+
+
+def compile_expression(bytecode: Bytecode, exp: Expression, line: int, destination: int = None) -> int:
+    """Compiles the expression and returns the slot that holds its value. Variables and constants are used in
+    place, unless a destination slot is given."""
+    if isinstance(exp, (NumberExpression, BooleanExpression, IdExpression)):
+        if isinstance(exp, IdExpression):
+            slot = bytecode.variable(exp.name)
+            if exp.name not in bytecode.assigned:
+                bytecode.emit(line, CHECK, slot)
+        else:
+            slot = bytecode.constant(int(exp.value))
+        if destination is None:
+            return slot
+        bytecode.emit(line, MOVE, destination, slot)
+        return destination
+
+    if isinstance(exp, BinopExpression):
+        if exp.op not in BINARY_OPCODES:
+            error(line, "Unkonwn operator: {0}".format(exp.op))
+        left = compile_expression(bytecode, exp.left, line)
+        right = compile_expression(bytecode, exp.right, line)
+        bytecode.release(left)
+        bytecode.release(right)
+        if destination is None:
+            destination = bytecode.temporary()
+        bytecode.emit(line, BINARY_OPCODES[exp.op], destination, left, right)
+        return destination
+
+    if isinstance(exp, NotExpression):
+        operand = compile_expression(bytecode, exp.operand, line)
+        bytecode.release(operand)
+        if destination is None:
+            destination = bytecode.temporary()
+        bytecode.emit(line, NOT, destination, operand)
+        return destination
+
+    if isinstance(exp, TernaryExpression):
+        else_jump = compile_jump(bytecode, exp.condition, line, False)
+        if destination is None:
+            destination = bytecode.temporary()
+        compile_expression(bytecode, exp.true_expression, line, destination)
+        end_jump = bytecode.emit(line, JUMP, 0)
+        bytecode.patch(else_jump, bytecode.here())
+        compile_expression(bytecode, exp.false_expression, line, destination)
+        bytecode.patch(end_jump, bytecode.here())
+        return destination
+
+    error(-1, "Bug: Unsupported expression: {0}".format(type(exp).__name__))
+
+
+def compile_jump(bytecode: Bytecode, condition: Expression, line: int, jump_if: bool) -> int:
+    """Compiles a jump taken when the condition is jump_if, and returns its position to patch the target. A
+    comparison jumps by itself, without its boolean."""
+    if isinstance(condition, NotExpression):
+        return compile_jump(bytecode, condition.operand, line, not jump_if)
+    if isinstance(condition, BinopExpression) and condition.op in COMPARISON_JUMPS:
+        left = compile_expression(bytecode, condition.left, line)
+        right = compile_expression(bytecode, condition.right, line)
+        bytecode.release(left)
+        bytecode.release(right)
+        jumps = COMPARISON_JUMPS if jump_if else NEGATED_COMPARISON_JUMPS
+        return bytecode.emit(line, jumps[condition.op], left, right, 0)
+    slot = compile_expression(bytecode, condition, line)
+    bytecode.release(slot)
+    return bytecode.emit(line, JUMP_IF_TRUE if jump_if else JUMP_IF_FALSE, slot, 0)
+
+
+def execute_bytecode(bytecode: Bytecode):
+    code = bytecode.code
+    frame = list(bytecode.frame)
+    pc = 0
+    try:
+        # The opcodes are compared as literals (see the table above), ordered by how often they occur in loops.
+        while True:
+            op = code[pc]
+            if op == 24:  # JUMP_GREATER
+                if frame[code[pc + 1]] > frame[code[pc + 2]]:
+                    pc = code[pc + 3]
+                else:
+                    pc += 4
+            elif op == 23:  # JUMP_LESS
+                if frame[code[pc + 1]] < frame[code[pc + 2]]:
+                    pc = code[pc + 3]
+                else:
+                    pc += 4
+            elif op == 1:  # ADD
+                frame[code[pc + 1]] = frame[code[pc + 2]] + frame[code[pc + 3]]
+                pc += 4
+            elif op == 2:  # SUB
+                frame[code[pc + 1]] = frame[code[pc + 2]] - frame[code[pc + 3]]
+                pc += 4
+            elif op == 16:  # REPEAT
+                counter = code[pc + 1]
+                if frame[counter] > 0:
+                    frame[counter] -= 1
+                    pc = code[pc + 2]
+                else:
+                    pc += 3
+            elif op == 0:  # MOVE
+                frame[code[pc + 1]] = frame[code[pc + 2]]
+                pc += 3
+            elif op == 15:  # JUMP_IF_FALSE
+                if frame[code[pc + 1]]:
+                    pc += 3
+                else:
+                    pc = code[pc + 2]
+            elif op == 22:  # JUMP_IF_TRUE
+                if frame[code[pc + 1]]:
+                    pc = code[pc + 2]
+                else:
+                    pc += 3
+            elif op == 14:  # JUMP
+                pc = code[pc + 1]
+            elif op == 25:  # JUMP_LESS_EQ
+                if frame[code[pc + 1]] <= frame[code[pc + 2]]:
+                    pc = code[pc + 3]
+                else:
+                    pc += 4
+            elif op == 26:  # JUMP_GREATER_EQ
+                if frame[code[pc + 1]] >= frame[code[pc + 2]]:
+                    pc = code[pc + 3]
+                else:
+                    pc += 4
+            elif op == 27:  # JUMP_EQUAL
+                if frame[code[pc + 1]] == frame[code[pc + 2]]:
+                    pc = code[pc + 3]
+                else:
+                    pc += 4
+            elif op == 28:  # JUMP_NOT_EQUAL
+                if frame[code[pc + 1]] != frame[code[pc + 2]]:
+                    pc = code[pc + 3]
+                else:
+                    pc += 4
+            elif op == 5:  # MOD
+                frame[code[pc + 1]] = frame[code[pc + 2]] % frame[code[pc + 3]]
+                pc += 4
+            elif op == 3:  # MUL
+                frame[code[pc + 1]] = frame[code[pc + 2]] * frame[code[pc + 3]]
+                pc += 4
+            elif op == 4:  # DIV
+                frame[code[pc + 1]] = frame[code[pc + 2]] // frame[code[pc + 3]]
+                pc += 4
+            elif op == 29:  # CHECK
+                if frame[code[pc + 1]] is None:
+                    error(bytecode.lines[pc], "Variable has not been initialized {0}".format(
+                        bytecode.names[code[pc + 1]]))
+                pc += 2
+            elif op == 7:  # GREATER
+                frame[code[pc + 1]] = frame[code[pc + 2]] > frame[code[pc + 3]]
+                pc += 4
+            elif op == 6:  # LESS
+                frame[code[pc + 1]] = frame[code[pc + 2]] < frame[code[pc + 3]]
+                pc += 4
+            elif op == 10:  # EQUAL
+                frame[code[pc + 1]] = frame[code[pc + 2]] == frame[code[pc + 3]]
+                pc += 4
+            elif op == 13:  # NOT
+                frame[code[pc + 1]] = int(not frame[code[pc + 2]])
+                pc += 3
+            elif op == 11:  # AND
+                frame[code[pc + 1]] = frame[code[pc + 2]] and frame[code[pc + 3]]
+                pc += 4
+            elif op == 12:  # OR
+                frame[code[pc + 1]] = frame[code[pc + 2]] or frame[code[pc + 3]]
+                pc += 4
+            elif op == 8:  # LESS_EQ
+                frame[code[pc + 1]] = frame[code[pc + 2]] <= frame[code[pc + 3]]
+                pc += 4
+            elif op == 9:  # GREATER_EQ
+                frame[code[pc + 1]] = frame[code[pc + 2]] >= frame[code[pc + 3]]
+                pc += 4
+            elif op == 19:  # WRITE_NATURAL
+                write_line(str(frame[code[pc + 1]]))
+                pc += 2
+            elif op == 20:  # WRITE_BOOLEAN
+                write_line("true" if frame[code[pc + 1]] else "false")
+                pc += 2
+            elif op == 17:  # READ_NATURAL
+                frame[code[pc + 1]] = int(read_line())
+                pc += 2
+            elif op == 18:  # READ_BOOLEAN
+                frame[code[pc + 1]] = 1 if read_line() == "true" else 0
+                pc += 2
+            elif op == 21:  # HALT
+                break
+            else:
+                error(bytecode.lines[pc], "Bug: Unsupported opcode: {0}".format(op))
+    finally:
+        flush_output()
+
+    # The variables occupy the first slots, in the order of their symbols.
+    state = compilation()
+    state.value_frame[:] = frame[:len(state.symbol_table)]
@@ -1,11 +1,134 @@
-from typing import List, Dict
+import codecs
+import io
+import sys
+import threading
+from typing import List, Dict, Callable, TextIO
 
 BOOLEAN = 0
 NATURAL = 1
 INDENT = " " * 4
 
+PRINTER = 0
+INTERPRETER = 1
+COMPILER = 2
+BYTECODE = 3
+CHECKER = 4
+CLOSURES = 5
+PYTHON = 6
+PYTHON_SOURCE = 7
+COMPILER_64 = 8
+VECTORIZED = 9
+
 types = {BOOLEAN, NATURAL}
-ID: int = 0
+
+
+class Emitter:
+    """Collects the lines of the generated assembly and writes them to a file-like sink in large blocks, so code
+    generation takes linear time and never holds the whole program in memory."""
+
+    def __init__(self, sink: TextIO, block_size: int = 4096):
+        self.sink = sink
+        self.block_size = block_size
+        self.lines: List[str] = []
+
+    def emit(self, line: str):
+        self.lines.append(line)
+        if len(self.lines) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.sink.write("\n".join(self.lines))
+            self.sink.write("\n")
+            self.lines.clear()
+
+
+class Target:
+    """The machine the assembly is generated for: 32 bit x86, linked with io.c by gcc -m32."""
+    # The registers that hold the values of expressions. edx is the scratch register of divisions and comparisons.
+    registers = ["eax", "ebx", "ecx", "esi", "edi"]
+    # The callee-saved registers that keep the variables of a loop while it runs.
+    variable_registers: List[str] = []
+    # Saved by the prologue for the C caller.
+    saved_registers = ["ebx", "esi", "edi"]
+    stack_pointer = "esp"
+    word_size = 4
+    # How the assembly is built, see the Makefile.
+    object_format = "elf"
+    gcc_options = ["-m32"]
+
+    def emit_header(self, out: Emitter):
+        pass
+
+    def stack_register(self, register: str) -> str:
+        """The register pushed to save the value of the register."""
+        return register
+
+    def emit_write(self, out: Emitter, type_name: str):
+        out.emit("push eax")
+        out.emit("call write_{0}".format(type_name))
+        out.emit("add esp,4")
+
+    def emit_repeat(self, out: Emitter, body: List['Instruction']):
+        """Emits the loop that runs the body as many times as eax says."""
+        begin_label = next_label()
+        out.emit("mov ecx,eax")
+        out.emit("{0}:".format(begin_label))
+        out.emit("push ecx")
+        generate_code_of_commands(body, out)
+        out.emit("pop ecx")
+        out.emit("loop {0}".format(begin_label))
+
+
+class X86_64Target(Target):
+    """x86-64 for the System V ABI, linked with io.c by gcc without -m32. The values are 32 bit, so they are kept
+    in the lower halves of the registers, and the variables used most by a loop are kept in the callee-saved
+    registers, which the calls of io.c do not change."""
+    registers = ["eax", "ecx", "esi", "edi", "r8d", "r9d", "r10d", "r11d"]
+    variable_registers = ["ebx", "r12d", "r13d", "r14d", "r15d"]
+    # Five pushes after the return address keep the stack aligned to 16 bytes at the calls.
+    saved_registers = ["rbx", "r12", "r13", "r14", "r15"]
+    stack_pointer = "rsp"
+    word_size = 8
+    object_format = "elf64"
+    gcc_options: List[str] = []
+
+    def emit_header(self, out: Emitter):
+        # The variables are addressed relative to rip, so gcc can link a position independent executable.
+        out.emit("default rel")
+
+    def stack_register(self, register: str) -> str:
+        if register.startswith("e"):
+            return "r" + register[1:]
+        return register[:-1]
+
+    def emit_write(self, out: Emitter, type_name: str):
+        out.emit("mov edi,eax")
+        out.emit("call write_{0}".format(type_name))
+
+    def emit_repeat(self, out: Emitter, body: List['Instruction']):
+        """The counter is saved on the stack in the body with 8 more bytes, which keeps the stack aligned. The loop
+        does not run for a count of 0."""
+        begin_label = next_label()
+        end_label = next_label()
+        out.emit("mov ecx,eax")
+        out.emit("test ecx,ecx")
+        out.emit("je near {0}".format(end_label))
+        out.emit("{0}:".format(begin_label))
+        out.emit("push rcx")
+        out.emit("sub rsp,8")
+        generate_code_of_commands(body, out)
+        out.emit("add rsp,8")
+        out.emit("pop rcx")
+        out.emit("dec ecx")
+        out.emit("jne near {0}".format(begin_label))
+        out.emit("{0}:".format(end_label))
+
+
+X86 = Target()
+X86_64 = X86_64Target()
+# The target of each compiling mode.
+TARGETS = {COMPILER: X86, COMPILER_64: X86_64}
 
 
 class Symbol:
@@ -15,14 +138,21 @@ class Symbol:
         self.name = name
         self.symbol_type = type
         self.label = next_label()
+        self.slot: int = None
+        # The node shared by every reference to the variable.
+        self.expression: IdExpression = None
+        # Declared by the optimizer, not by the program.
+        self.temporary = False
 
     def declare(self):
+        symbol_table = compilation().symbol_table
         if self.name in symbol_table:
             error(self.line, "Re-declared variable: {0}".format(self.name))
+        self.slot = len(symbol_table)
         symbol_table[self.name] = self
 
-    def get_code(self) -> str:
-        return "{0}: resb {1} \t; variable: {2}\n".format(self.label, self.get_size(), self.name)
+    def emit_code(self, out: Emitter):
+        out.emit("{0}: resb {1} \t; variable: {2}".format(self.label, self.get_size(), self.name))
 
     def get_size(self) -> int:
         if self.symbol_type == BOOLEAN:
@@ -31,21 +161,113 @@ class Symbol:
             return 4
 
 
-symbol_table: Dict[str, Symbol] = {}
-value_table: Dict[str, int] = {}
+Environment = List[int]
+
+
+class Compilation:
+    """The state of compiling and running one program. The compilation in use is kept per thread (see
+    compilation()), so programs can be compiled in several threads at once."""
+
+    def __init__(self, stdin: TextIO = None, stdout: TextIO = None):
+        self.symbol_table: Dict[str, Symbol] = {}
+        # Values of the variables, indexed by the slots of their symbols (None while not initialized).
+        self.value_frame: Environment = []
+        self.label_count = 0
+        self.target: Target = X86
+        # The variables kept in registers by the loops being generated, by name.
+        self.loop_registers: Dict[str, str] = {}
+        self.number_expressions: Dict[int, NumberExpression] = {}
+        # The computations removed by the common subexpression elimination of the optimizer.
+        self.eliminated_evaluations = 0
+        # The streams of the read and write instructions, the standard streams when None.
+        self.stdin = stdin
+        self.stdout = stdout
+        # The buffers of the interpreter on these streams, see read_line() and write_line().
+        self.input: InputBuffer = None
+        self.output: Emitter = None
+        self.previous: Compilation = None
+
+    def __enter__(self) -> 'Compilation':
+        self.previous = getattr(current, "compilation", None)
+        current.compilation = self
+        return self
+
+    def __exit__(self, *exception):
+        current.compilation = self.previous
+        self.previous = None
+
+
+current = threading.local()
+
+
+def compilation() -> Compilation:
+    """The compilation in use in this thread. A thread starts with a compilation of its own."""
+    try:
+        return current.compilation
+    except AttributeError:
+        current.compilation = Compilation()
+        return current.compilation
+
+
+class Diagnostic(Exception):
+    """An error in a While program, found while it is compiled or run."""
+
+    def __init__(self, line: int, message: str):
+        super().__init__(line, message)
+        self.line = line
+        self.message = message
+
+    def __str__(self) -> str:
+        return "Line {0}: Error: {1}".format(self.line, self.message)
+
+
+class UninitializedVariable(Exception):
+    pass
 
 
 class Expression:
+    """Expressions are kept small: they have __slots__ and no line numbers. Literals and variable references are
+    shared nodes, so the tree must not be modified through them."""
+    __slots__ = ()
+    # Set by type_check(), or fixed by the class.
+    type: int = None
+
+    def type_check(self, line: int) -> int:
+        """Checks the expression bottom-up, stores its type on every node and returns it. Errors are reported at
+        the line of the enclosing instruction."""
+        return self.type
 
     def get_type(self) -> int:
-        pass
+        return self.type
+
+    def emit_code(self, out: Emitter):
+        """Emits the code that leaves the value of the expression in eax. Booleans are 0 or 1 in the whole
+        register."""
+        self.emit_value(out, compilation().target.registers, {})
 
-    def get_code(self) -> str:
+    def emit_value(self, out: Emitter, registers: List[str], needs: Dict[int, int]):
+        """Emits the code that computes the value into registers[0], changing only the given registers, edx and the
+        stack. needs caches the register needs of the operators by the id of their nodes."""
         pass
 
+    def register_need(self, needs: Dict[int, int]) -> int:
+        """The number of registers needed to compute the value without saving one on the stack (Sethi-Ullman)."""
+        return 1
+
+    def source_operand(self) -> str:
+        """The value as the source operand of an instruction, or None when it has to be computed into a
+        register."""
+        return None
+
     def get_value(self) -> int:
         pass
 
+    def compile_closure(self) -> Callable[[Environment], int]:
+        pass
+
+    def resolve(self):
+        pass
+
     def print(self):
         print(self.to_string())
 
@@ -54,179 +276,596 @@ class Expression:
 
 
 class NumberExpression(Expression):
+    __slots__ = ("value",)
+    type = NATURAL
 
-    def __init__(self, text: str):
-        self.value = int(text)
+    def __init__(self, value: int):
+        self.value = int(value)
 
-    def get_type(self) -> int:
-        return NATURAL
+    def emit_value(self, out: Emitter, registers: List[str], needs: Dict[int, int]):
+        out.emit("mov {0},{1}".format(registers[0], self.value))
 
-    def get_code(self) -> str:
-        return "mov eax,{0}\n".format(self.value)
+    def source_operand(self) -> str:
+        return str(self.value)
 
     def get_value(self) -> int:
         return self.value
 
+    def compile_closure(self) -> Callable[[Environment], int]:
+        value = self.value
+        return lambda env: value
+
     def to_string(self) -> str:
         return str(self.value)
 
 
 class BooleanExpression(Expression):
+    __slots__ = ("value",)
+    type = BOOLEAN
 
     def __init__(self, value: bool):
         self.value = value
 
-    def get_type(self) -> int:
-        return BOOLEAN
+    def emit_value(self, out: Emitter, registers: List[str], needs: Dict[int, int]):
+        out.emit("mov {0},{1}".format(registers[0], self.source_operand()))
 
-    def get_code(self) -> str:
-        return "mov al,{0}\n".format(1 if self.value else 0)
+    def source_operand(self) -> str:
+        return "1" if self.value else "0"
 
     def get_value(self) -> int:
         return int(self.value)
 
+    def compile_closure(self) -> Callable[[Environment], int]:
+        value = int(self.value)
+        return lambda env: value
+
     def to_string(self) -> str:
         return "true" if self.value else "false"
 
 
 class IdExpression(Expression):
+    __slots__ = ("name", "symbol", "slot", "frame", "type")
 
-    def __init__(self, line: int, name: str):
-        self.line = line
+    def __init__(self, name: str):
         self.name = name
+        self.symbol: Symbol = None
+        self.slot: int = None
+        self.frame: Environment = None
+        self.type = None
 
-    def get_type(self) -> int:
+    def type_check(self, line: int) -> int:
+        symbol_table = compilation().symbol_table
         if self.name not in symbol_table:
-            error(self.line, "Undefined variable: {0}".format(self.name))
-        return symbol_table[self.name].symbol_type
+            error(line, "Undefined variable: {0}".format(self.name))
+        self.symbol = symbol_table[self.name]
+        self.type = self.symbol.symbol_type
+        return self.type
+
+    def emit_value(self, out: Emitter, registers: List[str], needs: Dict[int, int]):
+        register = compilation().loop_registers.get(self.name)
+        if register is not None:
+            out.emit("mov {0},{1}".format(registers[0], register))
+        elif self.type == BOOLEAN:
+            out.emit("movzx {0},byte [{1}]".format(registers[0], self.symbol.label))
+        else:
+            out.emit("mov {0},[{1}]".format(registers[0], self.symbol.label))
 
-    def get_code(self) -> str:
-        if self.name not in symbol_table:
-            error(self.line, "Undefined variable: {0}".format(self.name))
-        return "mov eax,[{0}]\n".format(symbol_table[self.name].label)
+    def source_operand(self) -> str:
+        register = compilation().loop_registers.get(self.name)
+        if register is not None:
+            return register
+        # A boolean variable takes one byte.
+        if self.type == BOOLEAN:
+            return None
+        return "[{0}]".format(self.symbol.label)
 
     def get_value(self) -> int:
-        if self.name not in symbol_table:
-            error(self.line, "Variable has not been initialized {0}".format(self.name))
-        return value_table[self.name]
+        value = self.frame[self.slot]
+        if value is None:
+            raise UninitializedVariable(self.name)
+        return value
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        slot = self.slot
+        name = self.name
+
+        def id_closure(env: Environment) -> int:
+            value = env[slot]
+            if value is None:
+                raise UninitializedVariable(name)
+            return value
+        return id_closure
+
+    def resolve(self):
+        self.slot = self.symbol.slot
+        self.frame = compilation().value_frame
 
     def to_string(self) -> str:
         return self.name
 
 
-class BinopExpression(Expression):
+# Literals are interned: there is one node for each boolean value and for each distinct number.
+TRUE_EXPRESSION = BooleanExpression(True)
+FALSE_EXPRESSION = BooleanExpression(False)
 
-    def __init__(self, line: int, op: str, left: Expression, right: Expression):
-        self.line = line
-        self.op = op
+
+def new_number_expression(value: int) -> NumberExpression:
+    number_expressions = compilation().number_expressions
+    expression = number_expressions.get(value)
+    if expression is None:
+        expression = number_expressions[value] = NumberExpression(value)
+    return expression
+
+
+def new_boolean_expression(value: bool) -> BooleanExpression:
+    return TRUE_EXPRESSION if value else FALSE_EXPRESSION
+
+
+def new_id_expression(name: str) -> IdExpression:
+    """Returns the node shared by all references to the declared variable. An undeclared name gets a node of its
+    own, which type_check() reports."""
+    symbol = compilation().symbol_table.get(name)
+    if symbol is None:
+        return IdExpression(name)
+    if symbol.expression is None:
+        symbol.expression = IdExpression(name)
+    return symbol.expression
+
+
+class BinopExpression(Expression):
+    """Base class of the binary operators. Every operator is a subclass, so evaluation, type checking and code
+    generation never compare operator strings; op is kept for printing and the optimizer."""
+    __slots__ = ("left", "right")
+    op: str = None
+    operand_type: int = None
+    commutative = False
+
+    def __init__(self, left: Expression, right: Expression):
         self.left = left
         self.right = right
 
-    def get_type(self) -> int:
-        if self.op == "=":
-            if self.left.get_type() != self.right.get_type():
-                error(self.line, "Left and right operands of '=' have different types.")
+    def type_check(self, line: int) -> int:
+        if self.left.type_check(line) != self.operand_type:
+            error(line, "Left operand of '{0}' has unexpected type.".format(self.op))
+        if self.right.type_check(line) != self.operand_type:
+            error(line, "Right operand of '{0}' has unexpected type.".format(self.op))
+        return self.type
+
+    def emit_value(self, out: Emitter, registers: List[str], needs: Dict[int, int]):
+        """The operand that needs more registers is computed first, so the other one can use the registers it
+        leaves. When both need all the registers, the right one is saved on the stack."""
+        target = registers[0]
+        direct = self.direct_operand()
+        if direct is not None:
+            direct[0].emit_value(out, registers, needs)
+            self.emit_operator_code(out, target, direct[1])
+            return
+        left = self.left.register_need(needs)
+        right = self.right.register_need(needs)
+        if left >= right and right < len(registers):
+            self.left.emit_value(out, registers, needs)
+            self.right.emit_value(out, registers[1:], needs)
+            self.emit_operator_code(out, target, registers[1])
+        elif right > left and left < len(registers):
+            self.right.emit_value(out, [registers[1], target] + registers[2:], needs)
+            self.left.emit_value(out, [target] + registers[2:], needs)
+            self.emit_operator_code(out, target, registers[1])
+        else:
+            machine = compilation().target
+            self.right.emit_value(out, registers, needs)
+            out.emit("push {0}".format(machine.stack_register(target)))
+            self.left.emit_value(out, registers, needs)
+            self.emit_operator_code(out, target, "[{0}]".format(machine.stack_pointer))
+            out.emit("add {0},{1}".format(machine.stack_pointer, machine.word_size))
+
+    def register_need(self, needs: Dict[int, int]) -> int:
+        need = needs.get(id(self))
+        if need is None:
+            direct = self.direct_operand()
+            if direct is not None:
+                need = needs[id(self)] = direct[0].register_need(needs)
+            else:
+                left = self.left.register_need(needs)
+                right = self.right.register_need(needs)
+                need = needs[id(self)] = left + 1 if left == right else max(left, right)
+        return need
+
+    def direct_operand(self) -> (Expression, str):
+        """The operand that is not computed but used by the instruction of the operator, with the other operand.
+        A commutative operator can take either operand. None when both have to be computed."""
+        operand = self.right_operand()
+        if operand is not None:
+            return self.left, operand
+        if self.commutative:
+            operand = self.left.source_operand()
+            if operand is not None:
+                return self.right, operand
+        return None
+
+    def right_operand(self) -> str:
+        return self.right.source_operand()
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        """Emits the operator on the left value in the target register and the right value in the operand."""
+        pass
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        pass
+
+    def resolve(self):
+        self.left.resolve()
+        self.right.resolve()
+
+    def to_string(self) -> str:
+        return "({0}) {1} ({2})".format(self.left.to_string(), self.op, self.right.to_string())
+
+
+class AddExpression(BinopExpression):
+    __slots__ = ()
+    op = "+"
+    operand_type = NATURAL
+    type = NATURAL
+    commutative = True
+
+    def get_value(self) -> int:
+        return self.left.get_value() + self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) + right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value + right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        out.emit("add {0},{1}".format(target, operand))
+
+
+class SubExpression(BinopExpression):
+    __slots__ = ()
+    op = "-"
+    operand_type = NATURAL
+    type = NATURAL
+
+    def get_value(self) -> int:
+        return self.left.get_value() - self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) - right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value - right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        out.emit("sub {0},{1}".format(target, operand))
+
+
+class MulExpression(BinopExpression):
+    __slots__ = ()
+    op = "*"
+    operand_type = NATURAL
+    type = NATURAL
+    commutative = True
+
+    def get_value(self) -> int:
+        return self.left.get_value() * self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) * right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value * right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        # The low half of the product is the same for signed and unsigned numbers.
+        if operand.isdigit():
+            out.emit("imul {0},{0},{1}".format(target, operand))
         else:
-            if self.left.get_type() != operand_type(self.op):
-                error(self.line, "Left operand of '{0}' has unexpected type.".format(self.op))
-            if self.right.get_type() != operand_type(self.op):
-                error(self.line, "Right operand of '{0}' has unexpected type.".format(self.op))
-        return return_type(self.op)
-
-    def get_code(self) -> str:
-        s = self.left.get_code()
-        s += "push eax\n"
-        s += self.right.get_code()
-        s += "pop eax\n"
-        s += eq_code(self.left.get_type() if self.op == "=" else operator_code(self.op))
-        return s
+            out.emit("imul {0},{1}".format(target, operand))
+
+
+class DivExpression(BinopExpression):
+    __slots__ = ()
+    op = "/"
+    operand_type = NATURAL
+    type = NATURAL
 
     def get_value(self) -> int:
-        left_value: int = self.left.get_value()
-        right_value: int = self.right.get_value()
-        if self.op == "+":
-            return left_value + right_value
-        elif self.op == "-":
-            return left_value - right_value
-        elif self.op == "*":
-            return left_value * right_value
-        elif self.op == "/":
-            return left_value // right_value
-        elif self.op == "%":
-            return left_value % right_value
-        elif self.op == "<":
-            return left_value < right_value
-        elif self.op == ">":
-            return left_value > right_value
-        elif self.op == "<=":
-            return left_value <= right_value
-        elif self.op == ">=":
-            return left_value <= right_value
-        elif self.op == "and":
+        return self.left.get_value() // self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) // right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value // right_value
+
+    def right_operand(self) -> str:
+        return division_operand(self.right)
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        emit_division_code(out, target, operand, "eax")
+
+
+class ModExpression(BinopExpression):
+    __slots__ = ()
+    op = "%"
+    operand_type = NATURAL
+    type = NATURAL
+
+    def get_value(self) -> int:
+        return self.left.get_value() % self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) % right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value % right_value
+
+    def right_operand(self) -> str:
+        return division_operand(self.right)
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        emit_division_code(out, target, operand, "edx")
+
+
+class LessExpression(BinopExpression):
+    __slots__ = ()
+    op = "<"
+    operand_type = NATURAL
+    type = BOOLEAN
+
+    def get_value(self) -> int:
+        return self.left.get_value() < self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) < right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value < right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        emit_comparison_code(out, target, operand, "b")
+
+
+class GreaterExpression(BinopExpression):
+    __slots__ = ()
+    op = ">"
+    operand_type = NATURAL
+    type = BOOLEAN
+
+    def get_value(self) -> int:
+        return self.left.get_value() > self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) > right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value > right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        emit_comparison_code(out, target, operand, "a")
+
+
+class LessEqExpression(BinopExpression):
+    __slots__ = ()
+    op = "<="
+    operand_type = NATURAL
+    type = BOOLEAN
+
+    def get_value(self) -> int:
+        return self.left.get_value() <= self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) <= right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value <= right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        emit_comparison_code(out, target, operand, "be")
+
+
+class GreaterEqExpression(BinopExpression):
+    __slots__ = ()
+    op = ">="
+    operand_type = NATURAL
+    type = BOOLEAN
+
+    def get_value(self) -> int:
+        return self.left.get_value() >= self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) >= right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value >= right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        emit_comparison_code(out, target, operand, "ae")
+
+
+class AndExpression(BinopExpression):
+    __slots__ = ()
+    op = "and"
+    operand_type = BOOLEAN
+    type = BOOLEAN
+    commutative = True
+
+    def get_value(self) -> int:
+        # Both operands are evaluated.
+        left_value = self.left.get_value()
+        right_value = self.right.get_value()
+        return left_value and right_value
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+
+        def and_closure(env: Environment) -> int:
+            left_value = left(env)
+            right_value = right(env)
             return left_value and right_value
-        elif self.op == "or":
+        return and_closure
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value and right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        out.emit("and {0},{1}".format(target, operand))
+
+
+class OrExpression(BinopExpression):
+    __slots__ = ()
+    op = "or"
+    operand_type = BOOLEAN
+    type = BOOLEAN
+    commutative = True
+
+    def get_value(self) -> int:
+        # Both operands are evaluated.
+        left_value = self.left.get_value()
+        right_value = self.right.get_value()
+        return left_value or right_value
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+
+        def or_closure(env: Environment) -> int:
+            left_value = left(env)
+            right_value = right(env)
             return left_value or right_value
-        elif self.op == "=":
-            return left_value == right_value
-        else:
-            error(self.line, "Unkonwn operator: {0}".format(self.op))
+        return or_closure
 
-    def to_string(self) -> str:
-        return "({0}) {1} ({2})".format(self.left.to_string(), self.op, self.right.to_string())
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value or right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        out.emit("or {0},{1}".format(target, operand))
+
+
+class EqExpression(BinopExpression):
+    __slots__ = ()
+    op = "="
+    type = BOOLEAN
+    commutative = True
+
+    def type_check(self, line: int) -> int:
+        if self.left.type_check(line) != self.right.type_check(line):
+            error(line, "Left and right operands of '=' have different types.")
+        return self.type
+
+    def get_value(self) -> int:
+        return self.left.get_value() == self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], int]:
+        left = self.left.compile_closure()
+        right = self.right.compile_closure()
+        return lambda env: left(env) == right(env)
+
+    def compute(self, left_value: int, right_value: int) -> int:
+        return left_value == right_value
+
+    def emit_operator_code(self, out: Emitter, target: str, operand: str):
+        emit_comparison_code(out, target, operand, "e")
+
+
+BINOP_EXPRESSIONS: Dict[str, type] = {
+    it.op: it for it in (AddExpression, SubExpression, MulExpression, DivExpression, ModExpression, LessExpression,
+                         GreaterExpression, LessEqExpression, GreaterEqExpression, AndExpression, OrExpression,
+                         EqExpression)
+}
+
+
+def new_binop_expression(op: str, left: Expression, right: Expression) -> BinopExpression:
+    if op not in BINOP_EXPRESSIONS:
+        error(-1, "Unkonwn operator: {0}".format(op))
+    return BINOP_EXPRESSIONS[op](left, right)
 
 
 class NotExpression(Expression):
+    __slots__ = ("op", "operand")
+    type = BOOLEAN
 
-    def __init__(self, line: int, op: str, operand: Expression):
-        self.line = line
+    def __init__(self, op: str, operand: Expression):
         self.op = op
         self.operand = operand
 
-    def get_type(self) -> int:
-        if self.operand.get_type() != BOOLEAN:
-            error(self.line, "Operand of 'not' is not boolean.")
-        return BOOLEAN
+    def type_check(self, line: int) -> int:
+        if self.operand.type_check(line) != BOOLEAN:
+            error(line, "Operand of 'not' is not boolean.")
+        return self.type
+
+    def emit_value(self, out: Emitter, registers: List[str], needs: Dict[int, int]):
+        self.operand.emit_value(out, registers, needs)
+        out.emit("xor {0},1".format(registers[0]))
 
-    def get_code(self) -> str:
-        s = self.operand.get_code()
-        s += "xor al,1\n"
-        return s
+    def register_need(self, needs: Dict[int, int]) -> int:
+        return self.operand.register_need(needs)
 
     def get_value(self) -> int:
         return int(not self.operand.get_value())
 
+    def compile_closure(self) -> Callable[[Environment], int]:
+        operand = self.operand.compile_closure()
+        return lambda env: int(not operand(env))
+
+    def resolve(self):
+        self.operand.resolve()
+
     def to_string(self) -> str:
         return "{0} ({1})".format(self.op, self.operand.to_string())
 
 
 class TernaryExpression(Expression):
+    __slots__ = ("condition", "true_expression", "false_expression", "type")
 
-    def __init__(self, line: int, condition: Expression, true_expression: Expression, false_expression: Expression):
-        self.line = line
+    def __init__(self, condition: Expression, true_expression: Expression, false_expression: Expression):
         self.condition = condition
         self.true_expression = true_expression
         self.false_expression = false_expression
+        self.type = None
 
-    def get_type(self) -> int:
-        if self.condition.get_type() != BOOLEAN:
-            error(self.line, "Condition of '?:' expression is not boolean.")
-        if self.true_expression.get_type() != self.false_expression.get_type():
-            error(self.line, "The sides of '?:' expression are not the same type.")
+    def type_check(self, line: int) -> int:
+        if self.condition.type_check(line) != BOOLEAN:
+            error(line, "Condition of '?:' expression is not boolean.")
+        self.type = self.true_expression.type_check(line)
+        if self.type != self.false_expression.type_check(line):
+            error(line, "The sides of '?:' expression are not the same type.")
+        return self.type
 
-        return self.true_expression.get_type()
-
-    def get_code(self) -> str:
+    def emit_value(self, out: Emitter, registers: List[str], needs: Dict[int, int]):
         else_label = next_label()
         end_label = next_label()
-        s = self.condition.get_code()
-        s += "cmp al,1\n"
-        s += "jne near {0}\n".format(else_label)
-        s += self.true_expression.get_code()
-        s += "jmp {0}\n".format(end_label)
-        s += "{0}:\n".format(else_label)
-        s += self.false_expression.get_code()
-        s += "{0}:\n".format(end_label)
-        return s
+        self.condition.emit_value(out, registers, needs)
+        out.emit("cmp {0},1".format(registers[0]))
+        out.emit("jne near {0}".format(else_label))
+        self.true_expression.emit_value(out, registers, needs)
+        out.emit("jmp {0}".format(end_label))
+        out.emit("{0}:".format(else_label))
+        self.false_expression.emit_value(out, registers, needs)
+        out.emit("{0}:".format(end_label))
+
+    def register_need(self, needs: Dict[int, int]) -> int:
+        return max(self.condition.register_need(needs), self.true_expression.register_need(needs),
+                   self.false_expression.register_need(needs))
 
     def get_value(self) -> int:
         if self.condition.get_value():
@@ -234,12 +873,24 @@ class TernaryExpression(Expression):
         else:
             return self.false_expression.get_value()
 
+    def compile_closure(self) -> Callable[[Environment], int]:
+        condition = self.condition.compile_closure()
+        true_expression = self.true_expression.compile_closure()
+        false_expression = self.false_expression.compile_closure()
+        return lambda env: true_expression(env) if condition(env) else false_expression(env)
+
+    def resolve(self):
+        self.condition.resolve()
+        self.true_expression.resolve()
+        self.false_expression.resolve()
+
     def to_string(self) -> str:
         return "({0} ? {1} : {2})".format(self.condition.to_string(), self.true_expression.to_string(),
                                           self.false_expression.to_string())
 
 
 class Instruction:
+    __slots__ = ("line",)
 
     def __init__(self, line: int):
         self.line = line
@@ -247,12 +898,18 @@ class Instruction:
     def type_check(self):
         pass
 
-    def get_code(self) -> str:
+    def emit_code(self, out: Emitter):
         pass
 
     def execute(self):
         pass
 
+    def compile_closure(self) -> Callable[[Environment], None]:
+        pass
+
+    def resolve(self):
+        pass
+
     def get_line(self):
         return self.line
 
@@ -261,25 +918,47 @@ class Instruction:
 
 
 class AssignInstruction(Instruction):
+    __slots__ = ("left", "right", "symbol", "slot", "frame")
 
     def __init__(self, line: int, left: str, right: Expression):
         super().__init__(line)
         self.left = left
         self.right = right
+        self.symbol: Symbol = None
+        self.slot: int = None
+        self.frame: Environment = None
 
     def type_check(self):
+        symbol_table = compilation().symbol_table
         if self.left not in symbol_table:
             error(self.line, "Undefined variable: {0}".format(self.left))
-        if symbol_table[self.left].symbol_type != self.right.get_type():
+        self.symbol = symbol_table[self.left]
+        if self.symbol.symbol_type != self.right.type_check(self.line):
             error(self.line, "Left and right hand sides of assignment are of different types.")
 
-    def get_code(self) -> str:
-        s = self.right.get_code()
-        s += "mov [{0}], {1}\n".format(symbol_table[self.left].label, get_register(symbol_table[self.left].symbol_type))
-        return s
+    def emit_code(self, out: Emitter):
+        self.right.emit_code(out)
+        emit_store_code(out, self.symbol, "eax")
 
     def execute(self):
-        value_table[self.left] = self.right.get_value()
+        self.frame[self.slot] = self.right.get_value()
+
+    def compile_closure(self) -> Callable[[Environment], None]:
+        line = self.line
+        slot = self.slot
+        right = self.right.compile_closure()
+
+        def assign_closure(env: Environment):
+            try:
+                env[slot] = right(env)
+            except UninitializedVariable as variable:
+                uninitialized_error(line, variable)
+        return assign_closure
+
+    def resolve(self):
+        self.slot = self.symbol.slot
+        self.frame = compilation().value_frame
+        self.right.resolve()
 
     def print(self, indent_level: int):
         indent(indent_level)
@@ -287,30 +966,54 @@ class AssignInstruction(Instruction):
 
 
 class ReadInstruction(Instruction):
+    __slots__ = ("id", "symbol", "slot", "frame")
 
     def __init__(self, line: int, id: str):
         super().__init__(line)
         self.id = id
+        self.symbol: Symbol = None
+        self.slot: int = None
+        self.frame: Environment = None
 
     def type_check(self):
+        symbol_table = compilation().symbol_table
         if self.id not in symbol_table:
             error(self.line, "Undefined variable: {0}".format(self.id))
+        self.symbol = symbol_table[self.id]
 
-    def get_code(self) -> str:
-        t = symbol_table[self.id].symbol_type
-        s = "call read_{0}\n".format(get_type_name(t))
-        s += "mov [{0}],{1}\n".format(symbol_table[self.id].label, get_type_name(t))
-        return s
+    def emit_code(self, out: Emitter):
+        t = self.symbol.symbol_type
+        out.emit("call read_{0}".format(get_type_name(t)))
+        # read_boolean only sets al.
+        if t == BOOLEAN and self.id in compilation().loop_registers:
+            out.emit("movzx eax,al")
+        emit_store_code(out, self.symbol, "eax")
 
     def execute(self):
-        input_line = input()
-        if symbol_table[self.id].symbol_type == NATURAL:
-            value_table[self.id] = int(input_line)
-        elif symbol_table[self.id].symbol_type == BOOLEAN:
+        self.store(read_line())
+
+    def store(self, input_line: str):
+        if self.symbol.symbol_type == NATURAL:
+            self.frame[self.slot] = int(input_line)
+        elif self.symbol.symbol_type == BOOLEAN:
             if input_line == "true":
-                value_table[self.id] = 1
+                self.frame[self.slot] = 1
             else:
-                value_table[self.id] = 0
+                self.frame[self.slot] = 0
+
+    def compile_closure(self) -> Callable[[Environment], None]:
+        slot = self.slot
+        if self.symbol.symbol_type == NATURAL:
+            def read_closure(env: Environment):
+                env[slot] = int(read_line())
+        else:
+            def read_closure(env: Environment):
+                env[slot] = 1 if read_line() == "true" else 0
+        return read_closure
+
+    def resolve(self):
+        self.slot = self.symbol.slot
+        self.frame = compilation().value_frame
 
     def print(self, indent_level: int):
         indent(indent_level)
@@ -318,6 +1021,7 @@ class ReadInstruction(Instruction):
 
 
 class WriteInstruction(Instruction):
+    __slots__ = ("exp", "exp_type")
 
     def __init__(self, line: int, exp: Expression):
         super().__init__(line)
@@ -325,21 +1029,40 @@ class WriteInstruction(Instruction):
         self.exp_type = None
 
     def type_check(self):
-        self.exp_type = self.exp.get_type()
+        self.exp_type = self.exp.type_check(self.line)
 
-    def get_code(self) -> str:
-        s = self.exp.get_code()
-        if self.exp_type == BOOLEAN:
-            s += "and eax,1\n"
-        s += "push eax\n"
-        s += "call write_{0}\n".format(get_type_name(self.exp_type))
-        return s
+    def emit_code(self, out: Emitter):
+        self.exp.emit_code(out)
+        compilation().target.emit_write(out, get_type_name(self.exp_type))
 
     def execute(self):
+        write_line(self.output_line())
+
+    def output_line(self) -> str:
+        if self.exp_type == NATURAL:
+            return str(self.exp.get_value())
+        else:
+            return "true" if self.exp.get_value() else "false"
+
+    def compile_closure(self) -> Callable[[Environment], None]:
+        line = self.line
+        exp = self.exp.compile_closure()
         if self.exp_type == NATURAL:
-            print(self.exp.get_value())
+            def write_closure(env: Environment):
+                try:
+                    write_line(str(exp(env)))
+                except UninitializedVariable as variable:
+                    uninitialized_error(line, variable)
         else:
-            print("true" if self.exp.get_value() else "false")
+            def write_closure(env: Environment):
+                try:
+                    write_line("true" if exp(env) else "false")
+                except UninitializedVariable as variable:
+                    uninitialized_error(line, variable)
+        return write_closure
+
+    def resolve(self):
+        self.exp.resolve()
 
     def print(self, indent_level: int):
         indent(indent_level)
@@ -347,6 +1070,7 @@ class WriteInstruction(Instruction):
 
 
 class IfInstruction(Instruction):
+    __slots__ = ("condition", "true_branch", "false_branch")
 
     def __init__(self, line: int, condition: Expression, true_branch: List[Instruction],
                  false_branch: List[Instruction]):
@@ -356,23 +1080,22 @@ class IfInstruction(Instruction):
         self.false_branch = false_branch
 
     def type_check(self):
-        if self.condition.get_type() != BOOLEAN:
+        if self.condition.type_check(self.line) != BOOLEAN:
             error(self.line, "Condition of 'if' instruction is not boolean.")
         type_check_commands(self.true_branch)
         type_check_commands(self.false_branch)
 
-    def get_code(self) -> str:
+    def emit_code(self, out: Emitter):
         else_label = next_label()
         end_label = next_label()
-        s = self.condition.get_code()
-        s += "cmp al,1\n"
-        s += "jne near {0}\n".format(else_label)
-        s += generate_code_of_commands(self.true_branch)
-        s += "jmp {0}\n".format(end_label)
-        s += "{0}:\n".format(else_label)
-        s += generate_code_of_commands(self.false_branch)
-        s += "{0}:\n".format(end_label)
-        return s
+        self.condition.emit_code(out)
+        out.emit("cmp al,1")
+        out.emit("jne near {0}".format(else_label))
+        generate_code_of_commands(self.true_branch, out)
+        out.emit("jmp {0}".format(end_label))
+        out.emit("{0}:".format(else_label))
+        generate_code_of_commands(self.false_branch, out)
+        out.emit("{0}:".format(end_label))
 
     def execute(self):
         if self.condition.get_value():
@@ -380,6 +1103,28 @@ class IfInstruction(Instruction):
         else:
             execute_commands(self.false_branch)
 
+    def compile_closure(self) -> Callable[[Environment], None]:
+        line = self.line
+        condition = self.condition.compile_closure()
+        true_branch = compile_closure_of_commands(self.true_branch)
+        false_branch = compile_closure_of_commands(self.false_branch)
+
+        # The commands of the branches report their own lines, so only the condition raises UninitializedVariable.
+        def if_closure(env: Environment):
+            try:
+                if condition(env):
+                    true_branch(env)
+                else:
+                    false_branch(env)
+            except UninitializedVariable as variable:
+                uninitialized_error(line, variable)
+        return if_closure
+
+    def resolve(self):
+        self.condition.resolve()
+        resolve_commands(self.true_branch)
+        resolve_commands(self.false_branch)
+
     def print(self, indent_level: int):
         indent(indent_level)
         print("if {0} then".format(self.condition.to_string()))
@@ -395,6 +1140,7 @@ class IfInstruction(Instruction):
 
 
 class WhileInstruction(Instruction):
+    __slots__ = ("condition", "body")
 
     def __init__(self, line: int, condition: Expression, body: List[Instruction]):
         super().__init__(line)
@@ -402,26 +1148,44 @@ class WhileInstruction(Instruction):
         self.body = body
 
     def type_check(self):
-        if self.condition.get_type() != BOOLEAN:
+        if self.condition.type_check(self.line) != BOOLEAN:
             error(self.line, "Condition of 'while' instruction is not boolean.")
         type_check_commands(self.body)
 
-    def get_code(self) -> str:
+    def emit_code(self, out: Emitter):
+        variables = allocate_loop_variables(self, out)
         begin_label = next_label()
         end_label = next_label()
-        s = "{0}:\n".format(begin_label)
-        s += self.condition.get_code()
-        s += "cmp al,1\n"
-        s += "jne near {0}\n".format(end_label)
-        s += generate_code_of_commands(self.body)
-        s += "jmp {0}\n".format(begin_label)
-        s += "{0}:\n".format(end_label)
-        return s
+        out.emit("{0}:".format(begin_label))
+        self.condition.emit_code(out)
+        out.emit("cmp al,1")
+        out.emit("jne near {0}".format(end_label))
+        generate_code_of_commands(self.body, out)
+        out.emit("jmp {0}".format(begin_label))
+        out.emit("{0}:".format(end_label))
+        release_loop_variables(self, variables, out)
 
     def execute(self):
         while self.condition.get_value():
             execute_commands(self.body)
 
+    def compile_closure(self) -> Callable[[Environment], None]:
+        line = self.line
+        condition = self.condition.compile_closure()
+        body = compile_closure_of_commands(self.body)
+
+        def while_closure(env: Environment):
+            try:
+                while condition(env):
+                    body(env)
+            except UninitializedVariable as variable:
+                uninitialized_error(line, variable)
+        return while_closure
+
+    def resolve(self):
+        self.condition.resolve()
+        resolve_commands(self.body)
+
     def print(self, indent_level: int):
         indent(indent_level)
         print("while {0} do".format(self.condition.to_string()))
@@ -432,6 +1196,7 @@ class WhileInstruction(Instruction):
 
 
 class RepeatInstruction(Instruction):
+    __slots__ = ("count", "body")
 
     def __init__(self, line: int, count: Expression, body: List[Instruction]):
         super().__init__(line)
@@ -439,29 +1204,41 @@ class RepeatInstruction(Instruction):
         self.body = body
 
     def type_check(self):
-        if self.count.get_type() != NATURAL:
+        if self.count.type_check(self.line) != NATURAL:
             error(self.line, "Count of 'repeat' instruction is not natural.")
 
         type_check_commands(self.body)
 
-    def get_code(self) -> str:
-        begin_label = next_label()
-        s = self.count.get_code()
-        s += "mov ecx,eax\n"
-        s += "{0}:\n".format(begin_label)
-        s += "push ecx\n"
-        s += generate_code_of_commands(self.body)
-        s += "pop ecx\n"
-        s += "loop {0}\n".format(begin_label)
-        return s
+    def emit_code(self, out: Emitter):
+        variables = allocate_loop_variables(self, out)
+        self.count.emit_code(out)
+        compilation().target.emit_repeat(out, self.body)
+        release_loop_variables(self, variables, out)
 
     def execute(self):
         for i in range(self.count.get_value(), 0, -1):
             execute_commands(self.body)
 
+    def compile_closure(self) -> Callable[[Environment], None]:
+        line = self.line
+        count = self.count.compile_closure()
+        body = compile_closure_of_commands(self.body)
+
+        def repeat_closure(env: Environment):
+            try:
+                for i in range(count(env), 0, -1):
+                    body(env)
+            except UninitializedVariable as variable:
+                uninitialized_error(line, variable)
+        return repeat_closure
+
+    def resolve(self):
+        self.count.resolve()
+        resolve_commands(self.body)
+
     def print(self, indent_level: int):
         indent(indent_level)
-        print("repeat {0} do".format(self.count.get_value()))
+        print("repeat {0} do".format(self.count.to_string()))
         print_commands(indent_level + 1, self.body)
 
         indent(indent_level)
@@ -469,29 +1246,187 @@ class RepeatInstruction(Instruction):
 
 
 def type_check_commands(commands: List[Instruction]):
-    for it in commands:
-        it.type_check()
+    """A single bottom-up pass that stores the type on every expression and the symbol on every variable
+    reference; later passes only read them."""
+    for command in commands:
+        command.type_check()
+
+
+def resolve_commands(commands: List[Instruction]):
+    """Binds the variables of the checked commands to the slots of their symbols."""
+    for command in commands:
+        command.resolve()
+
+
+def new_frame() -> Environment:
+    return [None] * len(compilation().symbol_table)
+
+
+def reset_frame():
+    compilation().value_frame[:] = new_frame()
+
+
+def extend_frame():
+    """Adds the variables declared since the frame was reset (the temporaries of the optimizer)."""
+    frame = compilation().value_frame
+    frame.extend([None] * (len(compilation().symbol_table) - len(frame)))
+
+
+def reset_state():
+    """Starts a new compilation in this thread, so the next program does not see the last one."""
+    current.compilation = Compilation()
+
+
+# The size of the blocks of input the interpreter reads, in characters, and of its output, in lines.
+INPUT_BLOCK_SIZE = 1 << 16
+OUTPUT_BLOCK_SIZE = 4096
+
+
+class InputBuffer:
+    """The lines of the input of the read instructions, read from the stream in large blocks. A terminal is read
+    line by line, as the user types them. The output written so far is flushed before waiting for more input, so
+    the user sees what the program asks for."""
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.lines: List[str] = []
+        self.position = 0
+        # The start of a line whose end is in the next block.
+        self.partial = ""
+        self.interactive = stream.isatty()
+        buffer = getattr(stream, "buffer", None)
+        # The buffered bytes of a file or a pipe are read as soon as some are available, so a program that answers
+        # the output of the interpreter does not wait for a full block.
+        self.raw = buffer if hasattr(buffer, "read1") else None
+        if self.raw is not None:
+            decoder = codecs.getincrementaldecoder(stream.encoding or "utf-8")()
+            self.decoder = io.IncrementalNewlineDecoder(decoder, True)
+
+    def read_line(self) -> str:
+        if self.position == len(self.lines):
+            self.fill()
+        line = self.lines[self.position]
+        self.position += 1
+        return line
+
+    def fill(self):
+        flush_output()
+        self.position = 0
+        if self.interactive:
+            line = self.stream.readline()
+            if not line:
+                raise EOFError("EOF when reading a line")
+            self.lines = [line.rstrip("\n")]
+            return
+        while True:
+            block = self.read_block()
+            if not block:
+                if not self.partial:
+                    raise EOFError("EOF when reading a line")
+                self.lines = [self.partial]
+                self.partial = ""
+                return
+            self.lines = (self.partial + block).split("\n")
+            self.partial = self.lines.pop()
+            if self.lines:
+                return
+
+    def read_block(self) -> str:
+        if self.raw is None:
+            return self.stream.read(INPUT_BLOCK_SIZE)
+        data = self.raw.read1(INPUT_BLOCK_SIZE)
+        return self.decoder.decode(data, final=not data)
+
+
+def read_line() -> str:
+    state = compilation()
+    stream = sys.stdin if state.stdin is None else state.stdin
+    if state.input is None or state.input.stream is not stream:
+        state.input = InputBuffer(stream)
+    return state.input.read_line()
+
+
+def write_line(text: str):
+    state = compilation()
+    stream = sys.stdout if state.stdout is None else state.stdout
+    if state.output is None or state.output.sink is not stream:
+        flush_output()
+        # A terminal shows every line when it is written.
+        state.output = Emitter(stream, 1 if stream.isatty() else OUTPUT_BLOCK_SIZE)
+    state.output.emit(text)
+
+
+def flush_output():
+    """Writes the output of the write instructions to its stream."""
+    output = compilation().output
+    if output is not None and output.lines:
+        output.flush()
+        output.sink.flush()
+
+
+def execute_program(commands: List[Instruction]):
+    """Interprets the top-level commands, and flushes their output even when the program fails."""
+    try:
+        execute_commands(commands)
+    finally:
+        flush_output()
 
 
 def execute_commands(commands: List[Instruction]):
     for command in commands:
-        command.execute()
+        try:
+            command.execute()
+        except UninitializedVariable as variable:
+            uninitialized_error(command.line, variable)
+
+
+def uninitialized_error(line: int, variable: UninitializedVariable):
+    error(line, "Variable has not been initialized {0}".format(variable))
+
+
+def compile_closure_of_commands(commands: List[Instruction]) -> Callable[[Environment], None]:
+    closures = [command.compile_closure() for command in commands]
+    if len(closures) == 1:
+        return closures[0]
+
+    def commands_closure(env: Environment):
+        for closure in closures:
+            closure(env)
+    return commands_closure
+
+
+def compile_to_closures(commands: List[Instruction]) -> Callable[..., None]:
+    """Compiles the resolved commands once into nested closures. The returned program can be run many times, on
+    value_frame by default or on the given frame. Like the tree walking interpreter, every command reports the
+    variables it reads before they are assigned, and the output is flushed when the program ends."""
+    body = compile_closure_of_commands(commands)
+    value_frame = compilation().value_frame
+
+    def program(env: Environment = None):
+        try:
+            body(value_frame if env is None else env)
+        finally:
+            flush_output()
+    return program
 
 
 def print_program(name: str, commands: List[Instruction]):
+    print_program_header(name)
+    print_commands(1, commands)
+    print("end")
+
+
+def print_program_header(name: str):
     print("program {0}".format(name))
 
-    for value in symbol_table.values():
+    for value in compilation().symbol_table.values():
         print("{0}{1} {2}".format(INDENT, "boolean" if value.symbol_type == 0 else "natural", value.name))
 
     print("begin")
-    print_commands(1, commands)
-    print("end")
 
 
 def error(line: int, text: str):
-    print("Line {1}: Error: {1}".format(line, text))
-    exit(1)
+    raise Diagnostic(line, text)
 
 
 def print_commands(indent_level: int, commands: List[Instruction]):
@@ -504,35 +1439,50 @@ def indent(indent_level: int):
 
 
 def next_label() -> str:
-    global ID
-    ID += 1
-    return "label{0}".format(ID)
-
-
-def generate_code(commands: List[Instruction]):
-    s = "global main\n"
-    s += "extern write_natural\n"
-    s += "extern read_natural\n"
-    s += "extern write_boolean\n"
-    s += "extern read_boolean\n"
-    s += "\n"
-    s += "section .bss\n"
-    for symbol in symbol_table.values():
-        s += symbol.get_code()
-    s += "\n"
-    s += "section .text\n"
-    s += "main:\n"
-    s += generate_code_of_commands(commands)
-    s += "xor eax,eax\n"
-    s += "ret\n"
-    print(s)
-
-
-def generate_code_of_commands(commands: List[Instruction]) -> str:
-    s = ""
+    state = compilation()
+    state.label_count += 1
+    return "label{0}".format(state.label_count)
+
+
+def generate_code(commands: List[Instruction], sink: TextIO = None, target: Target = X86):
+    from peephole import generate_optimized_code
+    compilation().target = target
+    out = Emitter(sys.stdout if sink is None else sink)
+    generate_prologue(out)
+    generate_optimized_code(commands, out)
+    generate_epilogue(out)
+
+
+def generate_prologue(out: Emitter):
+    target = compilation().target
+    target.emit_header(out)
+    out.emit("global main")
+    out.emit("extern write_natural")
+    out.emit("extern read_natural")
+    out.emit("extern write_boolean")
+    out.emit("extern read_boolean")
+    out.emit("")
+    out.emit("section .bss")
+    for symbol in compilation().symbol_table.values():
+        symbol.emit_code(out)
+    out.emit("")
+    out.emit("section .text")
+    out.emit("main:")
+    for register in target.saved_registers:
+        out.emit("push {0}".format(register))
+
+
+def generate_epilogue(out: Emitter):
+    for register in reversed(compilation().target.saved_registers):
+        out.emit("pop {0}".format(register))
+    out.emit("xor eax,eax")
+    out.emit("ret")
+    out.flush()
+
+
+def generate_code_of_commands(commands: List[Instruction], out: Emitter):
     for command in commands:
-        s += command.get_code()
-    return s
+        command.emit_code(out)
 
 
 def get_type_name(t: int) -> str:
@@ -542,80 +1492,143 @@ def get_type_name(t: int) -> str:
         return "natural"
 
 
-def get_register(t: int) -> str:
-    if t == BOOLEAN:
-        return "al"
-    else:
-        return "eax"
+def byte_register(register: str) -> str:
+    """The lowest byte of a 32 bit register that holds a boolean."""
+    if register.startswith("e"):
+        return register[1] + "l"
+    return register[:-1] + "b"
 
 
-def eq_code(t: int) -> str:
-    if t == NATURAL:
-        s = "cmp eax, ecx\n"
-    else:
-        s = "cmp al, cl\n"
-    s += "mov al,0\n"
-    s += "mov cx,1\n"
-    s += "cmove ax, cx\n"
-    return s
-
-
-def operator_code(op: str) -> str:
-    s = ""
-    if op == "+":
-        s += "add eax,ecx\n"
-    elif op == "-":
-        s += "sub eax,ecx\n"
-    elif op == "*":
-        s += "xor edx,edx\n"
-        s += "mul ecx\n"
-    elif op == "/":
-        s += "xor edx,edx\n"
-        s += "div ecx\n"
-    elif op == "%":
-        s += "xor edx,edx\n"
-        s += "div ecx\n"
-        s += "mov eax,edx\n"
-    elif op == "<":
-        s += "cmp eax,ecx\n"
-        s += "mov al,0\n"
-        s += "mov cx,1\n"
-        s += "cmovb ax,cx\n"
-    elif op == "<=":
-        s += "cmp eax,ecx\n"
-        s += "mov al,0\n"
-        s += "mov cx,1\n"
-        s += "cmovbe ax,cx\n"
-    elif op == ">":
-        s += "cmp eax,ecx\n"
-        s += "mov al,0\n"
-        s += "mov cx,1\n"
-        s += "cmova ax,cx\n"
-    elif op == ">=":
-        s += "cmp eax,ecx\n"
-        s += "mov al,0\n"
-        s += "mov cx,1\n"
-        s += "cmovae ax,cx\n"
-    elif op == "and":
-        s += "cmp al,1\n"
-        s += "cmove ax,cx\n"
-    elif op == "or":
-        s += "cmp al,0\n"
-        s += "cmove ax,cx\n"
+def emit_store_code(out: Emitter, symbol: Symbol, register: str):
+    """Stores the 32 bit register in the variable, which may be kept in a register by a loop."""
+    variable_register = compilation().loop_registers.get(symbol.name)
+    if variable_register is not None:
+        out.emit("mov {0},{1}".format(variable_register, register))
+    elif symbol.symbol_type == BOOLEAN:
+        out.emit("mov [{0}],{1}".format(symbol.label, byte_register(register)))
     else:
-        error(-1, "Bug: Unsupported binary operator: {0}".format(op))
-    return s
+        out.emit("mov [{0}],{1}".format(symbol.label, register))
 
 
-def operand_type(op: str) -> int:
-    if op in ["+", "-", "*", "/", "%", "<", ">", "<=", ">="]:
-        return NATURAL
-    else:
-        return BOOLEAN
+# A variable used in a nested loop counts this many times more than one used once per iteration.
+LOOP_WEIGHT = 8
 
 
-def return_type(op: str) -> int:
-    if op in ["+", "-", "*", "/", "%"]:
-        return NATURAL
+def count_variable_uses(commands: List[Instruction], counts: Dict[str, int], weight: int):
+    for command in commands:
+        if isinstance(command, AssignInstruction):
+            counts[command.left] = counts.get(command.left, 0) + weight
+            count_expression_uses(command.right, counts, weight)
+        elif isinstance(command, ReadInstruction):
+            counts[command.id] = counts.get(command.id, 0) + weight
+        elif isinstance(command, WriteInstruction):
+            count_expression_uses(command.exp, counts, weight)
+        elif isinstance(command, IfInstruction):
+            count_expression_uses(command.condition, counts, weight)
+            count_variable_uses(command.true_branch, counts, weight)
+            count_variable_uses(command.false_branch, counts, weight)
+        elif isinstance(command, WhileInstruction):
+            count_expression_uses(command.condition, counts, weight * LOOP_WEIGHT)
+            count_variable_uses(command.body, counts, weight * LOOP_WEIGHT)
+        elif isinstance(command, RepeatInstruction):
+            count_expression_uses(command.count, counts, weight)
+            count_variable_uses(command.body, counts, weight * LOOP_WEIGHT)
+
+
+def count_expression_uses(exp: Expression, counts: Dict[str, int], weight: int):
+    if isinstance(exp, IdExpression):
+        counts[exp.name] = counts.get(exp.name, 0) + weight
+    elif isinstance(exp, BinopExpression):
+        count_expression_uses(exp.left, counts, weight)
+        count_expression_uses(exp.right, counts, weight)
+    elif isinstance(exp, NotExpression):
+        count_expression_uses(exp.operand, counts, weight)
+    elif isinstance(exp, TernaryExpression):
+        count_expression_uses(exp.condition, counts, weight)
+        count_expression_uses(exp.true_expression, counts, weight)
+        count_expression_uses(exp.false_expression, counts, weight)
+
+
+def assigned_names(commands: List[Instruction], names: set):
+    for command in commands:
+        if isinstance(command, AssignInstruction):
+            names.add(command.left)
+        elif isinstance(command, ReadInstruction):
+            names.add(command.id)
+        elif isinstance(command, IfInstruction):
+            assigned_names(command.true_branch, names)
+            assigned_names(command.false_branch, names)
+        elif isinstance(command, (WhileInstruction, RepeatInstruction)):
+            assigned_names(command.body, names)
+
+
+def allocate_loop_variables(loop: Instruction, out: Emitter) -> List[Symbol]:
+    """Loads the variables the loop uses most into the free variable registers of the target, where they are kept
+    until release_loop_variables(). Returns their symbols."""
+    state = compilation()
+    free = [it for it in state.target.variable_registers if it not in state.loop_registers.values()]
+    if not free:
+        return []
+    counts: Dict[str, int] = {}
+    count_variable_uses([loop], counts, 1)
+    names = sorted((it for it in counts if it not in state.loop_registers), key=lambda it: -counts[it])
+    variables = []
+    for name, register in zip(names, free):
+        symbol = state.symbol_table[name]
+        if symbol.symbol_type == BOOLEAN:
+            out.emit("movzx {0},byte [{1}]".format(register, symbol.label))
+        else:
+            out.emit("mov {0},[{1}]".format(register, symbol.label))
+        state.loop_registers[name] = register
+        variables.append(symbol)
+    return variables
+
+
+def release_loop_variables(loop: Instruction, variables: List[Symbol], out: Emitter):
+    """Stores the variables the loop assigns back from their registers, after the loop."""
+    loop_registers = compilation().loop_registers
+    assigned = set()
+    assigned_names([loop], assigned)
+    for symbol in variables:
+        register = loop_registers.pop(symbol.name)
+        if symbol.name in assigned:
+            emit_store_code(out, symbol, register)
+
+
+def emit_comparison_code(out: Emitter, target: str, operand: str, condition: str):
+    out.emit("cmp {0},{1}".format(target, operand))
+    out.emit("set{0} dl".format(condition))
+    out.emit("movzx {0},dl".format(target))
+
+
+def division_operand(divisor: Expression) -> str:
+    """div takes no immediate operand, only a register or a variable."""
+    operand = divisor.source_operand()
+    if operand is not None and not operand.isdigit():
+        return operand
+    return None
+
+
+def emit_division_code(out: Emitter, target: str, operand: str, result: str):
+    """Divides the target by the operand and keeps the quotient (eax) or the remainder (edx) in the target. The
+    dividend has to be in eax, which may hold another value outside of the target."""
+    if operand.startswith("["):
+        operand = "dword " + operand
+    if target == "eax":
+        out.emit("xor edx,edx")
+        out.emit("div {0}".format(operand))
+        if result != "eax":
+            out.emit("mov eax,{0}".format(result))
+    elif operand == "eax":
+        # The divisor is not needed after the division, so its register is free.
+        out.emit("xchg eax,{0}".format(target))
+        out.emit("xor edx,edx")
+        out.emit("div {0}".format(target))
+        out.emit("mov {0},{1}".format(target, result))
     else:
-        return BOOLEAN
+        out.emit("xchg eax,{0}".format(target))
+        out.emit("xor edx,edx")
+        out.emit("div {0}".format(operand))
+        if result != "eax":
+            out.emit("mov eax,{0}".format(result))
+        out.emit("xchg eax,{0}".format(target))
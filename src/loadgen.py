@@ -0,0 +1,111 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from server import raise_file_limit
+
+# Doubles every number it reads, until it reads 0.
+ECHO_PROGRAM = """
+program echo
+    natural n
+begin
+    read(n)
+    while n > 0 do
+        write(n * 2)
+        read(n)
+    done
+end
+"""
+
+
+async def open_connection(address: str):
+    if address.startswith("unix:"):
+        return await asyncio.open_unix_connection(address[len("unix:"):])
+    host, _, port = address.rpartition(":")
+    return await asyncio.open_connection(host or "127.0.0.1", int(port))
+
+
+async def run_client(address: str, rounds: int, idle: float, latencies: List[float]) -> bool:
+    """A mostly idle session: sends a number every idle seconds and waits for its double."""
+    reader, writer = await open_connection(address)
+    source = ECHO_PROGRAM.encode()
+    writer.write(b"%d\n%s" % (len(source), source))
+    ok = True
+    for i in range(1, rounds + 1):
+        await asyncio.sleep(idle)
+        start = time.perf_counter()
+        writer.write(b"%d\n" % i)
+        line = await reader.readline()
+        latencies.append(time.perf_counter() - start)
+        if line != b"%d\n" % (i * 2):
+            ok = False
+            break
+    writer.write(b"0\n")
+    await writer.drain()
+    if await reader.read() != b"":
+        ok = False
+    writer.close()
+    await writer.wait_closed()
+    return ok
+
+
+async def generate_load(address: str, sessions: int, rounds: int, idle: float):
+    latencies: List[float] = []
+    start = time.perf_counter()
+    # The sessions connect over the first idle period, as users would, instead of all at once.
+    async def delayed_client(i: int) -> bool:
+        await asyncio.sleep(idle * i / sessions)
+        return await run_client(address, rounds, idle, latencies)
+    results = await asyncio.gather(*(delayed_client(i) for i in range(sessions)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failures = [it for it in results if it is not True]
+    latencies.sort()
+    print("{0} sessions, {1} failed, {2:.1f}s".format(sessions, len(failures), elapsed))
+    if failures:
+        print("first failure: {0!r}".format(failures[0]))
+    if latencies:
+        print("latency: median {0:.2f}ms, 99th percentile {1:.2f}ms, max {2:.2f}ms".format(
+            latencies[len(latencies) // 2] * 1000, latencies[len(latencies) * 99 // 100] * 1000,
+            latencies[-1] * 1000))
+
+
+def peak_memory(pid: int) -> str:
+    try:
+        with open("/proc/{0}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return line.split(":")[1].strip()
+    except OSError:
+        pass
+    return "unknown"
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (1, 2, 5):
+        print("Usage: {0} [address [sessions rounds idle_seconds]]".format(sys.argv[0]), file=sys.stderr)
+        print("Without an address, a server is started on a Unix socket for the measurement.", file=sys.stderr)
+        exit(1)
+    sessions, rounds, idle = 2000, 5, 3.0
+    if len(sys.argv) == 5:
+        sessions, rounds, idle = int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4])
+    raise_file_limit()
+    server = None
+    if len(sys.argv) == 1:
+        address = "unix:" + os.path.join(tempfile.mkdtemp(), "while.sock")
+        server = subprocess.Popen([sys.executable, "server.py", address])
+        while not os.path.exists(address[len("unix:"):]):
+            time.sleep(0.05)
+    else:
+        address = sys.argv[1]
+    try:
+        asyncio.run(generate_load(address, sessions, rounds, idle))
+    finally:
+        if server:
+            print("server peak memory: {0}".format(peak_memory(server.pid)))
+            server.terminate()
+            server.wait()
+            os.remove(address[len("unix:"):])
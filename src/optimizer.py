@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
-from typing import Tuple
+from typing import Optional, Set, Tuple
 
 from implementation import *
 
 FLIPPABLE_OPERANDS = ["+", "*", "and", "or"]
+IDEMPOTENT_OPERANDS = ["and", "or"]
+# The names of the variables declared by the optimizer, a name taken by the program is skipped.
+TEMPORARY_NAME = "_t{0}"
+# Operators whose operands can be swapped without changing the value.
+COMMUTATIVE_OPERANDS = ["+", "*", "and", "or", "="]
+
 
 class OptimizableSymbol:
 
@@ -19,389 +25,649 @@ class OptimizableSymbol:
         return "OptimizableSymbol<Name: {0}, Value: {1}, Optimizable: {2}>".format(self.name, self.value, self.optimizable)
 
 
-class OptStruct:
+def is_constant(exp: Expression) -> bool:
+    return isinstance(exp, (NumberExpression, BooleanExpression))
 
-    def __init__(self, optimizable: bool, value: int, type: int):
-        self.optimizable = optimizable
-        self.value = value
-        self.type = type
 
-    def __str__(self) -> str:
-        return "OptStruct<Optimizable: {0}, Value: {1}, Type: {2}>".format(self.optimizable, self.value, "BOOLEAN" if self.type == BOOLEAN else "NATURAL")
+def is_same_variable(left: Expression, right: Expression) -> bool:
+    return isinstance(left, IdExpression) and isinstance(right, IdExpression) and left.name == right.name
 
-    def __repr__(self) -> str:
-        return "OptStruct<Optimizable: {0}, Value: {1}, Type: {2}>".format(self.optimizable, self.value, "BOOLEAN" if self.type == BOOLEAN else "NATURAL")
+
+def can_fail(exp: BinopExpression) -> bool:
+    """Whether computing the operator may fail even if its operands are initialized."""
+    return exp.op in ("/", "%") and not (isinstance(exp.right, NumberExpression) and exp.right.value != 0)
+
+
+def assigned_variables(commands: List[Instruction], variables: Set[str]) -> Set[str]:
+    for command in commands:
+        if isinstance(command, AssignInstruction):
+            variables.add(command.left)
+        elif isinstance(command, ReadInstruction):
+            variables.add(command.id)
+        elif isinstance(command, IfInstruction):
+            assigned_variables(command.true_branch, variables)
+            assigned_variables(command.false_branch, variables)
+        elif isinstance(command, (WhileInstruction, RepeatInstruction)):
+            assigned_variables(command.body, variables)
+    return variables
+
+
+# The constants known at a point of the program: the variables that have the same value on every path to the point.
+# A variable without an entry, or with an entry that is not optimizable, may have any value (or none yet).
+ConstantTable = Dict[str, OptimizableSymbol]
+
+
+def join_tables(left: ConstantTable, right: ConstantTable) -> ConstantTable:
+    """The constants known where two paths of the program meet."""
+    table = {}
+    for name, symbol in left.items():
+        other = right.get(name)
+        if symbol.optimizable and other is not None and other.optimizable and other.value == symbol.value:
+            table[name] = symbol
+    return table
+
+
+def same_tables(left: ConstantTable, right: ConstantTable) -> bool:
+    constants = {name: symbol.value for name, symbol in left.items() if symbol.optimizable}
+    return constants == {name: symbol.value for name, symbol in right.items() if symbol.optimizable}
 
 
 class Optimizer:
+    """Constant propagation and constant merging. The constants known at every instruction are computed by a
+    dataflow analysis: the tables of the branches of an if are joined after it, and the table at the head of a
+    loop is iterated to a fixpoint over its back edge. Every expression is then optimized bottom-up in a single
+    pass: a node is simplified once its operands are, so no subtree is analyzed twice. Constant operands are
+    folded, moved to the top of chains of the same associative operator and folded there, and identity elements
+    are removed."""
 
     def __init__(self):
-        self.opt_table: Dict[str, OptimizableSymbol] = {}
-
-    def simpler_node(self, opt_struct: OptStruct):
-        if opt_struct.type == NATURAL:
-            return NumberExpression(str(opt_struct.value))
+        self.opt_table: ConstantTable = {}
+        # The variables initialized on every path to the end of the commands optimized so far, by
+        # hoist_loop_invariants() and by eliminate_common_subexpressions().
+        self.initialized: Set[str] = set()
+        self.numbered_initialized: Set[str] = set()
+        self.temporary_count = 0
+
+    def simpler_node(self, value: int, type: int) -> Expression:
+        if type == NATURAL:
+            return new_number_expression(value)
         else:
-            return BooleanExpression(bool(opt_struct.value))
+            return new_boolean_expression(bool(value))
 
     def optimalize_const_merge(self, commands: List[Instruction]):
+        """Optimizes the commands, which follow the commands optimized before by this optimizer."""
+        self.opt_table = self.propagate(commands, self.opt_table, True)
+
+    def propagate(self, commands: List[Instruction], table: ConstantTable, rewrite: bool) -> ConstantTable:
+        """Returns the constants known after the commands, when table holds the constants known before them (table
+        is updated). With rewrite, the expressions of the commands are replaced by their optimized versions,
+        otherwise the commands are only analyzed."""
         for command in commands:
             if isinstance(command, AssignInstruction):
-                opt_struct = self.opt_expresstion(command, command.right)
-                #print(opt_struct)
-                if opt_struct and opt_struct.optimizable:
-                    command.right = self.simpler_node(opt_struct)
-                    self.opt_table[command.left] = OptimizableSymbol(command.left, opt_struct.value, True)
+                right = self.optimize_expression(command.right, table)
+                if rewrite:
+                    command.right = right
+                if is_constant(right):
+                    table[command.left] = OptimizableSymbol(command.left, right.get_value(), True)
                 else:
-                    self.opt_table[command.left] = OptimizableSymbol(command.left)
+                    table[command.left] = OptimizableSymbol(command.left)
 
             elif isinstance(command, ReadInstruction):
-                self.opt_table[command.id] = OptimizableSymbol(command.id)
+                table[command.id] = OptimizableSymbol(command.id)
 
             elif isinstance(command, WriteInstruction):
-                opt_struct = self.opt_expresstion(command, command.exp)
-                if opt_struct.optimizable:
-                    command.exp = self.simpler_node(opt_struct)
+                if rewrite:
+                    command.exp = self.optimize_expression(command.exp, table)
 
             elif isinstance(command, IfInstruction):
-                opt_struct = self.opt_expresstion(command, command.condition)
-                if opt_struct.optimizable:
-                    command.condition = self.simpler_node(opt_struct)
-                self.optimalize_const_merge(command.true_branch)
-                self.optimalize_const_merge(command.false_branch)
+                condition = self.optimize_expression(command.condition, table)
+                if rewrite:
+                    command.condition = condition
+                true_table = self.propagate(command.true_branch, dict(table), rewrite)
+                false_table = self.propagate(command.false_branch, dict(table), rewrite)
+                if not is_constant(condition):
+                    table = join_tables(true_table, false_table)
+                elif condition.get_value():
+                    table = true_table
+                else:
+                    table = false_table
 
             elif isinstance(command, WhileInstruction):
-                opt_struct = self.opt_expresstion(command, command.condition)
-                if opt_struct.optimizable:
-                    command.condition = self.simpler_node(opt_struct)
-                self.optimalize_const_merge(command.body)
+                entry_condition = self.optimize_expression(command.condition, table)
+                head = self.loop_head(command.body, table)
+                condition = self.optimize_expression(command.condition, head)
+                if rewrite:
+                    command.condition = condition
+                    self.propagate(command.body, dict(head), True)
+                # The loop is left when the condition is false at its head.
+                if not (is_constant(entry_condition) and not entry_condition.get_value()):
+                    table = head
 
             elif isinstance(command, RepeatInstruction):
-                opt_struct = self.opt_expresstion(command, command.count)
-                if opt_struct.optimizable:
-                    command.count = self.simpler_node(opt_struct)
-                self.optimalize_const_merge(command.body)
-
-        #print_commands(0, commands)
-
+                # The count is computed once, before the first iteration.
+                count = self.optimize_expression(command.count, table)
+                if rewrite:
+                    command.count = count
+                head = self.loop_head(command.body, table)
+                if rewrite:
+                    self.propagate(command.body, dict(head), True)
+                if not (is_constant(count) and count.get_value() == 0):
+                    table = head
+        return table
+
+    def eliminate_dead_code(self, commands: List[Instruction]) -> bool:
+        """Removes the instructions that are never executed, after optimalize_const_merge(): an if with a constant
+        condition is replaced by the taken branch, a while with a false condition and a repeat with a constant
+        count and nothing to repeat are removed, and so are the instructions after a loop that never ends. The
+        lists of instructions are updated in place. Returns whether the execution of the commands can reach their
+        end."""
+        live = []
+        finishes = True
+        for command in commands:
+            if isinstance(command, IfInstruction):
+                true_finishes = self.eliminate_dead_code(command.true_branch)
+                false_finishes = self.eliminate_dead_code(command.false_branch)
+                if not is_constant(command.condition):
+                    live.append(command)
+                    finishes = true_finishes or false_finishes
+                elif command.condition.get_value():
+                    live.extend(command.true_branch)
+                    finishes = true_finishes
+                else:
+                    live.extend(command.false_branch)
+                    finishes = false_finishes
 
-    def opt_expresstion(self, root: Instruction, exp: Expression) -> OptStruct:
-        if isinstance(exp, NumberExpression):
-            return OptStruct(True, exp.get_value(), NATURAL)
+            elif isinstance(command, WhileInstruction):
+                if is_constant(command.condition) and not command.condition.get_value():
+                    continue
+                self.eliminate_dead_code(command.body)
+                live.append(command)
+                # A loop with a true condition ends only with an error.
+                finishes = not is_constant(command.condition)
 
-        elif isinstance(exp, BooleanExpression):
-            return OptStruct(True, exp.get_value(), BOOLEAN)
+            elif isinstance(command, RepeatInstruction):
+                body_finishes = self.eliminate_dead_code(command.body)
+                if is_constant(command.count) and (command.count.get_value() == 0 or not command.body):
+                    continue
+                live.append(command)
+                finishes = body_finishes or not is_constant(command.count)
 
-        elif isinstance(exp, IdExpression):
-            if exp.name in self.opt_table and self.opt_table[exp.name].optimizable:
-                return OptStruct(True, self.opt_table[exp.name].value, exp.get_type())
             else:
-                return OptStruct(False, -1, -1)
+                live.append(command)
+
+            if not finishes:
+                break
+        commands[:] = live
+        return finishes
+
+    def hoist_loop_invariants(self, commands: List[Instruction]):
+        """Moves the computations that give the same value in every iteration of a loop before the loop: the
+        largest subexpressions of the condition and the body of a while (and of the body of a repeat) that only
+        read variables not assigned in the loop are assigned to temporaries before the loop, and replaced by the
+        temporaries. Only expressions that cannot fail are moved, as the loop may not run: their variables are
+        initialized before the loop, and they do not divide by a value that may be zero."""
+        self.initialized = self.hoist_commands(commands, self.initialized)
+
+    def hoist_commands(self, commands: List[Instruction], initialized: Set[str]) -> Set[str]:
+        """Hoists the invariants of the loops in the commands, when the variables in initialized are initialized
+        before them. Returns the variables initialized after the commands."""
+        hoisted = []
+        for command in commands:
+            if isinstance(command, (WhileInstruction, RepeatInstruction)):
+                invariants = LoopInvariants(self, command, initialized)
+                hoisted.extend(invariants.assignments)
+                initialized.update(it.left for it in invariants.assignments)
+                # The body may not run, so the variables it initializes are not initialized after the loop.
+                self.hoist_commands(command.body, set(initialized))
+            elif isinstance(command, IfInstruction):
+                initialized = (self.hoist_commands(command.true_branch, set(initialized)) &
+                               self.hoist_commands(command.false_branch, set(initialized)))
+            elif isinstance(command, AssignInstruction):
+                initialized.add(command.left)
+            elif isinstance(command, ReadInstruction):
+                initialized.add(command.id)
+            hoisted.append(command)
+        commands[:] = hoisted
+        return initialized
+
+    def eliminate_common_subexpressions(self, commands: List[Instruction]):
+        """Local value numbering: in every straight-line block of instructions, the expressions that compute the
+        same value (the same operators on the same values of the variables) are computed once, into a temporary
+        assigned before the first instruction that computes it. Only the computations that every execution of the
+        block makes are merged, and only expressions whose variables are initialized, so no error moves. The
+        number of computations removed is added to compilation().eliminated_evaluations."""
+        self.numbered_initialized = self.number_commands(commands, self.numbered_initialized)
+
+    def number_commands(self, commands: List[Instruction], initialized: Set[str]) -> Set[str]:
+        """Numbers the blocks of the commands, when the variables in initialized are initialized before them.
+        Returns the variables initialized after the commands."""
+        numbered = []
+        block = ValueNumbering(self, initialized)
+        for command in commands:
+            # The condition of an if and the count of a repeat are computed in the block, the body of a while
+            # starts a new block, as its condition is computed again after the body.
+            if not isinstance(command, WhileInstruction):
+                block.add(command)
+            if isinstance(command, (IfInstruction, WhileInstruction, RepeatInstruction)):
+                numbered.extend(block.finish())
+                if isinstance(command, IfInstruction):
+                    initialized = (self.number_commands(command.true_branch, set(initialized)) &
+                                   self.number_commands(command.false_branch, set(initialized)))
+                else:
+                    self.number_commands(command.body, set(initialized))
+                block = ValueNumbering(self, initialized)
+                if isinstance(command, WhileInstruction):
+                    numbered.append(command)
+            elif isinstance(command, AssignInstruction):
+                initialized.add(command.left)
+            elif isinstance(command, ReadInstruction):
+                initialized.add(command.id)
+        numbered.extend(block.finish())
+        commands[:] = numbered
+        return initialized
+
+    def declare_temporary(self, line: int, type: int) -> str:
+        symbol_table = compilation().symbol_table
+        while True:
+            self.temporary_count += 1
+            name = TEMPORARY_NAME.format(self.temporary_count)
+            if name not in symbol_table:
+                break
+        symbol = Symbol(line, name, type)
+        symbol.temporary = True
+        symbol.declare()
+        return name
+
+    def loop_head(self, body: List[Instruction], table: ConstantTable) -> ConstantTable:
+        """The constants known at the head of a loop entered with table: those known both on entry and after any
+        number of iterations of the body. Every iteration removes constants, so the fixpoint is reached after at
+        most one iteration per variable."""
+        head = table
+        while True:
+            next_head = join_tables(table, self.propagate(body, dict(head), False))
+            if same_tables(next_head, head):
+                return head
+            head = next_head
+
+    def optimize_expression(self, exp: Expression, table: ConstantTable) -> Expression:
+        """Returns the optimized expression, a literal if its value is known from the constants in table. exp is
+        not modified, the operator nodes are rebuilt when their operands change."""
+        if isinstance(exp, IdExpression):
+            symbol = table.get(exp.name)
+            if symbol is not None and symbol.optimizable:
+                return self.simpler_node(symbol.value, exp.type)
+            return exp
+
+        elif isinstance(exp, BinopExpression):
+            left = self.optimize_expression(exp.left, table)
+            right = self.optimize_expression(exp.right, table)
+            if left is not exp.left or right is not exp.right:
+                exp = new_binop_expression(exp.op, left, right)
+            return self.simplify(exp)
 
         elif isinstance(exp, NotExpression):
-            opt_struct = self.opt_expresstion(root, exp.operand)
-            if opt_struct.optimizable:
-                return OptStruct(True, not opt_struct.value, BOOLEAN)
-            else:
-                return OptStruct(False, -1, -1)
+            operand = self.optimize_expression(exp.operand, table)
+            if is_constant(operand):
+                return new_boolean_expression(not operand.get_value())
+            if operand is not exp.operand:
+                exp = NotExpression(exp.op, operand)
+            return exp
+
+        elif isinstance(exp, TernaryExpression):
+            condition = self.optimize_expression(exp.condition, table)
+            if is_constant(condition):
+                if condition.get_value():
+                    return self.optimize_expression(exp.true_expression, table)
+                return self.optimize_expression(exp.false_expression, table)
+            true_expression = self.optimize_expression(exp.true_expression, table)
+            false_expression = self.optimize_expression(exp.false_expression, table)
+            if (condition is not exp.condition or true_expression is not exp.true_expression or
+                    false_expression is not exp.false_expression):
+                ternary = TernaryExpression(condition, true_expression, false_expression)
+                ternary.type = exp.type
+                exp = ternary
+            return exp
+
+        return exp
+
+    def simplify(self, exp: BinopExpression) -> Expression:
+        """Simplifies the operator whose operands are already optimized. The nodes it creates are simplified in
+        turn, which ends after a few steps, as every step moves a constant up or removes a node."""
+        op = exp.op
+        left = exp.left
+        right = exp.right
+        if is_constant(left) and is_constant(right):
+            # A division by zero may be in a branch that never runs, it fails at run time if it does run.
+            if op in ("/", "%") and right.get_value() == 0:
+                return exp
+            return self.simpler_node(exp.compute(left.get_value(), right.get_value()), exp.type)
+
+        if is_constant(right):
+            if isinstance(left, BinopExpression) and left.op == op and op in FLIPPABLE_OPERANDS:
+                # (x op c1) op c2 = x op (c1 op c2)
+                if is_constant(left.left):
+                    constant = self.simplify(new_binop_expression(op, right, left.left))
+                    return self.simplify(new_binop_expression(op, left.right, constant))
+                elif is_constant(left.right):
+                    constant = self.simplify(new_binop_expression(op, right, left.right))
+                    return self.simplify(new_binop_expression(op, left.left, constant))
+            return self.simplify_right_identity(exp)
+
+        if is_constant(left):
+            return self.simplify_left_identity(exp)
+
+        if isinstance(left, BinopExpression) and left.op == op and op in FLIPPABLE_OPERANDS:
+            # (c op x) op y = (x op y) op c, so the constant can be merged by the next operator of the chain.
+            if is_constant(left.left):
+                grouped = self.simplify(new_binop_expression(op, left.right, right))
+                return self.simplify(new_binop_expression(op, grouped, left.left))
+            elif is_constant(left.right):
+                grouped = self.simplify(new_binop_expression(op, left.left, right))
+                return self.simplify(new_binop_expression(op, grouped, left.right))
+            elif op in IDEMPOTENT_OPERANDS and (is_same_variable(left.left, right) or
+                                                is_same_variable(left.right, right)):
+                # (x and y) and x = x and y
+                return left
+            return exp
+
+        return self.simplify_same_variables(exp)
+
+    def simplify_right_identity(self, exp: BinopExpression) -> Expression:
+        value = exp.right.get_value()
+        if exp.op in ("+", "-"):
+            if value == 0:
+                return exp.left
+        elif exp.op in ("*", "/"):
+            if value == 1:
+                return exp.left
+        elif exp.op == "and":
+            return exp.left if value else new_boolean_expression(False)
+        elif exp.op == "or":
+            return new_boolean_expression(True) if value else exp.left
+        return exp
+
+    def simplify_left_identity(self, exp: BinopExpression) -> Expression:
+        value = exp.left.get_value()
+        if exp.op == "+":
+            if value == 0:
+                return exp.right
+        elif exp.op == "*":
+            if value == 1:
+                return exp.right
+        elif exp.op == "and":
+            return exp.right if value else new_boolean_expression(False)
+        elif exp.op == "or":
+            return new_boolean_expression(True) if value else exp.right
+        return exp
+
+    def simplify_same_variables(self, exp: BinopExpression) -> Expression:
+        'azaonos valtozo egysegesites'
+        if not is_same_variable(exp.left, exp.right):
+            return exp
+        if exp.op in ("-", "%"):
+            return new_number_expression(0)
+        elif exp.op == "/":
+            return new_number_expression(1)
+        elif exp.op in IDEMPOTENT_OPERANDS:
+            return exp.left
+        return exp
+
+
+class LoopInvariants:
+    """Replaces the loop invariant subexpressions of a loop by temporaries. assignments are the assignments of the
+    temporaries, to be run before the loop; an invariant that occurs several times is computed once."""
+
+    def __init__(self, optimizer: Optimizer, loop: Instruction, initialized: Set[str]):
+        self.optimizer = optimizer
+        self.line = loop.line
+        self.assigned = assigned_variables(loop.body, set())
+        self.initialized = initialized
+        self.temporaries: Dict[str, str] = {}
+        self.assignments: List[AssignInstruction] = []
+        if isinstance(loop, WhileInstruction):
+            loop.condition = self.rewrite(loop.condition)
+        self.rewrite_commands(loop.body)
+
+    def rewrite_commands(self, commands: List[Instruction]):
+        for command in commands:
+            if isinstance(command, AssignInstruction):
+                command.right = self.rewrite(command.right)
+            elif isinstance(command, WriteInstruction):
+                command.exp = self.rewrite(command.exp)
+            elif isinstance(command, IfInstruction):
+                command.condition = self.rewrite(command.condition)
+                self.rewrite_commands(command.true_branch)
+                self.rewrite_commands(command.false_branch)
+            elif isinstance(command, WhileInstruction):
+                command.condition = self.rewrite(command.condition)
+                self.rewrite_commands(command.body)
+            elif isinstance(command, RepeatInstruction):
+                command.count = self.rewrite(command.count)
+                self.rewrite_commands(command.body)
+
+    def rewrite(self, exp: Expression) -> Expression:
+        exp, invariant = self.visit(exp)
+        return self.hoist(exp) if invariant else exp
+
+    def visit(self, exp: Expression) -> Tuple[Expression, bool]:
+        """Returns the expression with its largest invariant subexpressions hoisted, and whether the whole
+        expression is invariant (then it is returned unchanged)."""
+        if isinstance(exp, IdExpression):
+            return exp, exp.name not in self.assigned and exp.name in self.initialized
 
         elif isinstance(exp, BinopExpression):
-            main_expression_left = self.opt_expresstion(root, exp.left)
-            if main_expression_left.optimizable:
-                exp.left = self.simpler_node(main_expression_left)
-
-            main_expression_right = self.opt_expresstion(root, exp.right)
-            if main_expression_right.optimizable:
-                exp.right = self.simpler_node(main_expression_right)
-
-            if main_expression_left.optimizable and main_expression_right.optimizable:
-                left_value = main_expression_left.value
-                right_value = main_expression_right.value
-                if exp.op == "+":
-                    value = left_value + right_value
-                    type = NATURAL
-                elif exp.op == "-":
-                    value = left_value - right_value
-                    type = NATURAL
-                elif exp.op == "*":
-                    value = left_value * right_value
-                    type = NATURAL
-                elif exp.op == "/":
-                    value = left_value // right_value
-                    type = NATURAL
-                elif exp.op == "%":
-                    value = left_value % right_value
-                    type = NATURAL
-                elif exp.op == "<":
-                    value = left_value < right_value
-                    type = BOOLEAN
-                elif exp.op == ">":
-                    value = left_value > right_value
-                    type = BOOLEAN
-                elif exp.op == "<=":
-                    value = left_value <= right_value
-                    type = BOOLEAN
-                elif exp.op == ">=":
-                    value = left_value <= right_value
-                    type = BOOLEAN
-                elif exp.op == "and":
-                    value = left_value and right_value
-                    type = BOOLEAN
-                elif exp.op == "or":
-                    value = left_value or right_value
-                    type = BOOLEAN
-                else:
-                    value = left_value == right_value
-                    type = BOOLEAN
-                return OptStruct(True, value, type)
-            elif not main_expression_left.optimizable and main_expression_right.optimizable:
-                ''' a jobb oldal optimalizalhato
-                    megézzük hogy a bal oldal miért nem optimalizálható
-                    nézzük meg összetett kifelyezés van-e a bal oldalon '''
-
-                if isinstance(exp.left, BinopExpression):
-                    not_optimalizable_expression: BinopExpression = exp.left
-                    ''' nézzük meg hogy megegyeznek-e az operátorok, a nem kiértékelhető
-                        és a rákövetkező műveletnél, és az asszociativ-e '''
-
-                    if not_optimalizable_expression.op == exp.op and exp.op in FLIPPABLE_OPERANDS:
-                        'bal oldalon ki kell derinteni miert nem optimalizalhato'
-                        not_optimalizable_left_expression = self.opt_expresstion(root, not_optimalizable_expression.left)
-                        not_optimalizable_right_expression = self.opt_expresstion(root, not_optimalizable_expression.right)
-
-                        if not_optimalizable_left_expression.optimizable:
-                            'ha bal oldal optimalizalhato akkor a jobb a gond'
-                            new_optimlaizable_expression = BinopExpression(exp.line, exp.op, exp.right, not_optimalizable_expression.left)
-                            optimalized_expression = self.simpler_node(self.opt_expresstion(root, new_optimlaizable_expression))
-                            new_expression = BinopExpression(exp.line, exp.op, not_optimalizable_expression.right, optimalized_expression)
-                            # exp = new_expression
-                            self.replace_expression(root, exp, new_expression)
-                            return self.opt_expresstion(root, new_expression)
-
-                        elif not_optimalizable_right_expression.optimizable:
-                            'ha jobb oldal optimalizalhato akkor a bal a gond'
-                            new_optimlaizable_expression = BinopExpression(exp.line, exp.op, exp.right, not_optimalizable_expression.right)
-                            optimalized_expression = self.simpler_node(self.opt_expresstion(root, new_optimlaizable_expression))
-                            new_expression = BinopExpression(exp.line, exp.op, not_optimalizable_expression.left, optimalized_expression)
-                            # exp = new_expression
-                            self.replace_expression(root, exp, new_expression)
-                            return self.opt_expresstion(root, new_expression)
-                        else:
-                            'semleges elem vizsgalat'
-                            if exp.op == "and":
-                                if self.opt_expresstion(root, exp.right).value == 1:
-                                    self.replace_expression(root, exp, exp.left)
-                                else:
-                                    self.replace_expression(root, exp, BooleanExpression(False))
-                                    return OptStruct(True, False, BOOLEAN)
-                            elif exp.op == "or":
-                                if self.opt_expresstion(root, exp.right).value == 1:
-                                    self.replace_expression(root, exp, BooleanExpression(True))
-                                    return OptStruct(True, True, BOOLEAN)
-                                else:
-                                    self.replace_expression(root, exp, exp.left)
-                            return OptStruct(False, -1, -1)
-                else:
-                    'nem BinExpression a bal elem, ebbol az kovetkezik hogy egyszeru elem'
-                    'semleges elem vizsgalat, jobb oldal optimalizalhato'
-                    if exp.op == "+":
-                        if self.opt_expresstion(root, exp.right).value == 0:
-                            self.replace_expression(root, exp, exp.left)
-                    elif exp.op == "-":
-                        if self.opt_expresstion(root, exp.right).value == 0:
-                            self.replace_expression(root, exp, exp.left)
-                    elif exp.op == "*":
-                        if self.opt_expresstion(root, exp.right).value == 1:
-                            self.replace_expression(root, exp, exp.left)
-                    elif exp.op == "/":
-                        if self.opt_expresstion(root, exp.right).value == 1:
-                            self.replace_expression(root, exp, exp.left)
-                    elif exp.op == "and":
-                        if self.opt_expresstion(root, exp.right).value == 1:
-                            self.replace_expression(root, exp, exp.left)
-                        else:
-                            self.replace_expression(root, exp, BooleanExpression(False))
-                            return OptStruct(True, False, BOOLEAN)
-                    elif exp.op == "or":
-                        if self.opt_expresstion(root, exp.right).value == 1:
-                            self.replace_expression(root, exp, BooleanExpression(True))
-                            return OptStruct(True, True, BOOLEAN)
-                        else:
-                            self.replace_expression(root, exp, exp.left)
-
-                    return OptStruct(False, -1, -1)
-
-            elif main_expression_left.optimizable and not main_expression_right.optimizable:
-                'semleges elem vizsgalat, bal oldal optimalizalhato'
-                if exp.op == "+":
-                    if self.opt_expresstion(root, exp.left).value == 0:
-                        self.replace_expression(root, exp, exp.right)
-                elif exp.op == "*":
-                    if self.opt_expresstion(root, exp.left).value == 1:
-                        self.replace_expression(root, exp, exp.right)
-                elif exp.op == "and":
-                    if self.opt_expresstion(root, exp.left).value == 1:
-                        self.replace_expression(root, exp, exp.right)
-                    else:
-                        self.replace_expression(root, exp, BooleanExpression(False))
-                        return OptStruct(True, False, BOOLEAN)
-                elif exp.op == "or":
-                    if self.opt_expresstion(root, exp.left).value == 1:
-                        self.replace_expression(root, exp, BooleanExpression(True))
-                        return OptStruct(True, True, BOOLEAN)
-                    else:
-                        self.replace_expression(root, exp, exp.right)
-                return OptStruct(False, -1, -1)
-            else:
-                'egyik oldal sem optimalizalhato'
-                'ez csak akkor lehet ha egyszerre tobb nem kotott valtozo van'
-                if isinstance(exp.left, BinopExpression):
-                    not_optimalizable_expression: BinopExpression = exp.left
-                    'megkeressuk van e legalabb 1 dolog amit ki lehet hozni'
-
-                    if not_optimalizable_expression.op == exp.op and exp.op in FLIPPABLE_OPERANDS:
-                        not_optimalizable_left_expression = self.opt_expresstion(root, not_optimalizable_expression.left)
-                        not_optimalizable_right_expression = self.opt_expresstion(root, not_optimalizable_expression.right)
-
-                        if not_optimalizable_left_expression.optimizable:
-                            'bal oldalon van egy optimalizalhato'
-                            'csoportositjuk a ket nem optimalizalhatot'
-                            new_not_optimalizable_expression = BinopExpression(exp.line, exp.op, not_optimalizable_expression.right, exp.right)
-
-                            new_expression = BinopExpression(exp.line, exp.op, new_not_optimalizable_expression, not_optimalizable_expression.left)
-
-                            self.replace_expression(root, exp, new_expression)
-                            return self.opt_expresstion(root, new_expression)
-                        elif not_optimalizable_right_expression.optimizable:
-                            'jobb oldalon van egy optimalizalhato'
-                            'csoportositjuk a ket nem optimalizalhatot'
-                            new_not_optimalizable_expression = BinopExpression(exp.line, exp.op, not_optimalizable_expression.left, exp.right)
-
-                            new_expression = BinopExpression(exp.line, exp.op, new_not_optimalizable_expression, not_optimalizable_expression.right)
-
-                            self.replace_expression(root, exp, new_expression)
-                            return self.opt_expresstion(root, new_expression)
-                        else:
-                            'a fa egyik ága sem optimalizalható'
-                            'meg kell nézni van e identitás a binop és a külsö között'
-                            exp.right: IdExpression # rendundás if helyett csak sima cast, mivel már az OptStructból tudjuk ami kell
-                            if isinstance(not_optimalizable_expression.left, IdExpression) and not_optimalizable_expression.left.name == exp.right.name:
-                                new_expression = BinopExpression(exp.line, exp.op, not_optimalizable_expression.left, not_optimalizable_expression.right)
-                                self.replace_expression(root, exp, new_expression)
-                                return self.opt_expresstion(root, new_expression)
-                            elif isinstance(not_optimalizable_expression.right, IdExpression) and not_optimalizable_expression.right.name == exp.right.name:
-                                'nézzük meg összevonaható e identitás elemként a külső'
-                                new_expression = BinopExpression(exp.line, exp.op, not_optimalizable_expression.left, not_optimalizable_expression.right)
-                                self.replace_expression(root, exp, new_expression)
-                                return self.opt_expresstion(root, new_expression)
-
-                            return OptStruct(False, -1, -1)
-                    elif not_optimalizable_expression.op == exp.op and exp.op in ["-", "/"]:
-                        'keressük meg hogy melyik fél nem optimalizálható, és nézzük meg egyszerűsíthető-e'
-                        not_optimalizable_left_expression = self.opt_expresstion(root, not_optimalizable_expression.left)
-                        not_optimalizable_right_expression = self.opt_expresstion(root,not_optimalizable_expression.right)
-
-                        if not_optimalizable_left_expression.optimizable:
-                            'bal oldalon van egy optimalizalhato, ezért a jobb oldalt van az IdExpression'
-
-                            if isinstance(not_optimalizable_expression.right, IdExpression) and \
-                                    isinstance(exp.right, IdExpression) and \
-                                    not_optimalizable_expression.right.name == exp.right.name:
-
-                                'azaonos valtozo egysegesites'
-                                new_expression = NumberExpression("0") if exp.op == "-" else NumberExpression("1")
-
-                                reduced_exp = BinopExpression(exp.line, exp.op, not_optimalizable_expression.left, new_expression)
-                                self.replace_expression(root, exp, reduced_exp)
-                                return self.opt_expresstion(root, reduced_exp)
-
-                        elif not_optimalizable_right_expression.optimizable:
-                            'jobb oldalon van egy optimalizalhato, ezért a bal oldalt van az IdExpression'
-
-                            if isinstance(not_optimalizable_expression.left, IdExpression) and \
-                                    isinstance(exp.right, IdExpression) and \
-                                    not_optimalizable_expression.left.name == exp.right.name:
-
-                                'azaonos valtozo egysegesites'
-                                new_expression = NumberExpression("0") if exp.op == "-" else NumberExpression("1")
-
-                                reduced_exp = BinopExpression(exp.line, exp.op, not_optimalizable_expression.right, new_expression)
-                                self.replace_expression(root, exp, reduced_exp)
-                                return self.opt_expresstion(root, reduced_exp)
-                        else:
-                            return OptStruct(False, -1, -1)
-                else:
-                    self.simplify_identity_element(root, exp)
-                return OptStruct(False, -1, -1)
+            left, left_invariant = self.visit(exp.left)
+            right, right_invariant = self.visit(exp.right)
+            if left_invariant and right_invariant and not can_fail(exp):
+                return exp, True
+            left = self.hoist(left) if left_invariant else left
+            right = self.hoist(right) if right_invariant else right
+            if left is not exp.left or right is not exp.right:
+                exp = new_binop_expression(exp.op, left, right)
+            return exp, False
+
+        elif isinstance(exp, NotExpression):
+            operand, invariant = self.visit(exp.operand)
+            if invariant:
+                return exp, True
+            if operand is not exp.operand:
+                exp = NotExpression(exp.op, operand)
+            return exp, False
 
         elif isinstance(exp, TernaryExpression):
-            opt_struct = self.opt_expresstion(root, exp.condition)
+            parts = [self.visit(it) for it in (exp.condition, exp.true_expression, exp.false_expression)]
+            if all(invariant for _, invariant in parts):
+                return exp, True
+            condition, true_expression, false_expression = [
+                self.hoist(part) if invariant else part for part, invariant in parts]
+            if (condition is not exp.condition or true_expression is not exp.true_expression or
+                    false_expression is not exp.false_expression):
+                ternary = TernaryExpression(condition, true_expression, false_expression)
+                ternary.type = exp.type
+                exp = ternary
+            return exp, False
+
+        return exp, True
+
+    def hoist(self, exp: Expression) -> Expression:
+        if isinstance(exp, (IdExpression, NumberExpression, BooleanExpression)):
+            return exp
+        key = exp.to_string()
+        name = self.temporaries.get(key)
+        if name is None:
+            name = self.temporaries[key] = self.optimizer.declare_temporary(self.line, exp.type)
+            assignment = AssignInstruction(self.line, name, exp)
+            assignment.type_check()
+            self.assignments.append(assignment)
+        temporary = new_id_expression(name)
+        temporary.type_check(self.line)
+        return temporary
+
+
+class ValueNumbering:
+    """The value numbering of a straight-line block. The instructions are added in order; finish() returns them
+    with the common subexpressions replaced by temporaries. A value number identifies the value of an expression:
+    the same number is given to the same operator applied to the same numbers, and to the same version of a
+    variable (every assignment starts a new version), so an expression whose variables are assigned between two
+    occurrences gets a new number."""
+
+    def __init__(self, optimizer: Optimizer, initialized: Set[str]):
+        self.optimizer = optimizer
+        self.initialized = set(initialized)
+        self.commands: List[Instruction] = []
+        self.versions: Dict[str, int] = {}
+        self.value_numbers: Dict[tuple, int] = {}
+        # The value numbers of the operator nodes of the block, by node identity, or None when a variable of the
+        # expression may be uninitialized.
+        self.numbers: Dict[int, Optional[int]] = {}
+        # How many times the value of a number is computed in every execution of the block.
+        self.counts: Dict[int, int] = {}
+        self.temporaries: Dict[int, str] = {}
+
+    def add(self, command: Instruction):
+        self.commands.append(command)
+        for exp in computed_expressions(command):
+            self.number(exp)
+            self.count(exp)
+        if isinstance(command, AssignInstruction):
+            self.assign(command.left)
+        elif isinstance(command, ReadInstruction):
+            self.assign(command.id)
+
+    def assign(self, name: str):
+        self.versions[name] = self.versions.get(name, 0) + 1
+        self.initialized.add(name)
+
+    def value_number(self, key: tuple) -> int:
+        number = self.value_numbers.get(key)
+        if number is None:
+            number = self.value_numbers[key] = len(self.value_numbers)
+        return number
+
+    def number(self, exp: Expression) -> Optional[int]:
+        if isinstance(exp, IdExpression):
+            if exp.name not in self.initialized:
+                return None
+            return self.value_number(("id", exp.name, self.versions.get(exp.name, 0)))
+
+        elif isinstance(exp, (NumberExpression, BooleanExpression)):
+            return self.value_number((type(exp), exp.value))
 
-            if opt_struct.optimizable:
-                exp.condition = self.simpler_node(opt_struct)
-                if opt_struct.value:
-                    return self.opt_expresstion(root, exp.true_expression)
-                else:
-                    return self.opt_expresstion(root, exp.false_expression)
+        elif isinstance(exp, BinopExpression):
+            left = self.number(exp.left)
+            right = self.number(exp.right)
+            if left is None or right is None:
+                number = None
+            elif exp.op in COMMUTATIVE_OPERANDS:
+                number = self.value_number((exp.op, min(left, right), max(left, right)))
             else:
-                return OptStruct(False, -1, -1)
-        return OptStruct(False, -1, -1)
+                number = self.value_number((exp.op, left, right))
 
-    def simplify_identity_element(self, root, exp):
+        elif isinstance(exp, NotExpression):
+            operand = self.number(exp.operand)
+            number = None if operand is None else self.value_number((exp.op, operand))
 
-        'azaonos valtozo egysegesites'
-        if exp.op == "-":
-            if isinstance(exp.left, IdExpression) and isinstance(exp.right, IdExpression) and exp.left.name == exp.right.name:
-                self.replace_expression(root, exp, NumberExpression("0"))
-        elif exp.op == "/":
-            if isinstance(exp.left, IdExpression) and isinstance(exp.right, IdExpression) and exp.left.name == exp.right.name:
-                self.replace_expression(root, exp, NumberExpression("1"))
-        elif exp.op == "%":
-            if isinstance(exp.left, IdExpression) and isinstance(exp.right, IdExpression) and exp.left.name == exp.right.name:
-                self.replace_expression(root, exp, NumberExpression("0"))
-        elif exp.op == "and":
-            if isinstance(exp.left, IdExpression) and isinstance(exp.right, IdExpression) and exp.left.name == exp.right.name:
-                self.replace_expression(root, exp, exp.left)
-        elif exp.op == "or":
-            if isinstance(exp.left, IdExpression) and isinstance(exp.right, IdExpression) and exp.left.name == exp.right.name:
-                self.replace_expression(root, exp, exp.left)
+        elif isinstance(exp, TernaryExpression):
+            parts = (self.number(exp.condition), self.number(exp.true_expression), self.number(exp.false_expression))
+            number = None if None in parts else self.value_number(("?",) + parts)
 
-    def replace_expression(self, instrcution: Instruction, old_expression: Expression, new_expression: Expression):
-        if isinstance(instrcution, AssignInstruction):
-            if instrcution.right == old_expression:
-                instrcution.right = new_expression
-            else:
-                self.search_and_replace_expression(instrcution.right, old_expression, new_expression)
-        elif isinstance(instrcution, WriteInstruction):
-            if instrcution.exp == old_expression:
-                instrcution.exp = new_expression
-            else:
-                self.search_and_replace_expression(instrcution.exp, old_expression, new_expression)
-        elif isinstance(instrcution, IfInstruction):
-            if instrcution.condition == old_expression:
-                instrcution.condition = new_expression
-            else:
-                self.search_and_replace_expression(instrcution.condition, old_expression, new_expression)
-        elif isinstance(instrcution, WhileInstruction):
-            if instrcution.condition == old_expression:
-                instrcution.condition = new_expression
-            else:
-                self.search_and_replace_expression(instrcution.condition, old_expression, new_expression)
-        elif isinstance(instrcution, RepeatInstruction):
-            if instrcution.count == old_expression:
-                instrcution.count = new_expression
-            else:
-                self.search_and_replace_expression(instrcution.count, old_expression, new_expression)
+        else:
+            return None
+        self.numbers[id(exp)] = number
+        return number
+
+    def count(self, exp: Expression):
+        """Counts the computations of the operators that every evaluation of exp makes: the operands of a value
+        computed before are not computed again, and the branches of a ternary, of which only one is computed, are
+        skipped. Both operands of 'and' and 'or' are computed in every mode."""
+        number = self.numbers.get(id(exp))
+        if number is not None:
+            count = self.counts.get(number, 0)
+            self.counts[number] = count + 1
+            if count:
+                return
+        if isinstance(exp, BinopExpression):
+            self.count(exp.left)
+            self.count(exp.right)
+        elif isinstance(exp, NotExpression):
+            self.count(exp.operand)
+        elif isinstance(exp, TernaryExpression):
+            self.count(exp.condition)
 
-        return instrcution
+    def finish(self) -> List[Instruction]:
+        commands = []
+        for command in self.commands:
+            assignments: List[AssignInstruction] = []
+            if isinstance(command, AssignInstruction):
+                command.right = self.rewrite(command.right, False, assignments, command.line)
+            elif isinstance(command, WriteInstruction):
+                command.exp = self.rewrite(command.exp, False, assignments, command.line)
+            elif isinstance(command, IfInstruction):
+                command.condition = self.rewrite(command.condition, False, assignments, command.line)
+            elif isinstance(command, RepeatInstruction):
+                command.count = self.rewrite(command.count, False, assignments, command.line)
+            commands.extend(assignments)
+            commands.append(command)
+        return commands
+
+    def rewrite(self, exp: Expression, conditional: bool, assignments: List[AssignInstruction],
+                line: int) -> Expression:
+        """Replaces the values computed more than once by temporaries. The temporary of a value is assigned (to
+        the assignments run before the instruction) at its first computation that is not conditional, and the
+        later computations, conditional or not, use it. One call per level of the expression, so a long chain
+        recurses no deeper than in the other passes."""
+        number = self.numbers.get(id(exp))
+        define = False
+        if number is not None:
+            name = self.temporaries.get(number)
+            if name is not None:
+                compilation().eliminated_evaluations += 1
+                return self.temporary(name, line)
+            define = not conditional and self.counts.get(number, 0) > 1
+
+        if isinstance(exp, BinopExpression):
+            left = self.rewrite(exp.left, conditional, assignments, line)
+            right = self.rewrite(exp.right, conditional, assignments, line)
+            if left is not exp.left or right is not exp.right:
+                exp = new_binop_expression(exp.op, left, right)
 
-    def search_and_replace_expression(self, root_expression: Expression, old_expression: Expression, new_expression: Expression):
-        if isinstance(root_expression, BinopExpression):
-            if root_expression.right == old_expression:
-                root_expression.right = new_expression
-            elif root_expression.left == old_expression:
-                root_expression.left = new_expression
-            else:
-                self.search_and_replace_expression(root_expression.right, old_expression, new_expression)
-                self.search_and_replace_expression(root_expression.left, old_expression, new_expression)
+        elif isinstance(exp, NotExpression):
+            operand = self.rewrite(exp.operand, conditional, assignments, line)
+            if operand is not exp.operand:
+                exp = NotExpression(exp.op, operand)
 
+        elif isinstance(exp, TernaryExpression):
+            condition = self.rewrite(exp.condition, conditional, assignments, line)
+            true_expression = self.rewrite(exp.true_expression, True, assignments, line)
+            false_expression = self.rewrite(exp.false_expression, True, assignments, line)
+            if (condition is not exp.condition or true_expression is not exp.true_expression or
+                    false_expression is not exp.false_expression):
+                ternary = TernaryExpression(condition, true_expression, false_expression)
+                ternary.type = exp.type
+                exp = ternary
+
+        if define:
+            name = self.temporaries[number] = self.optimizer.declare_temporary(line, exp.type)
+            assignment = AssignInstruction(line, name, exp)
+            assignment.type_check()
+            assignments.append(assignment)
+            return self.temporary(name, line)
+        return exp
+
+    def temporary(self, name: str, line: int) -> IdExpression:
+        temporary = new_id_expression(name)
+        temporary.type_check(line)
+        return temporary
+
+
+def computed_expressions(command: Instruction) -> List[Expression]:
+    """The expressions an instruction computes before any other instruction runs."""
+    if isinstance(command, AssignInstruction):
+        return [command.right]
+    elif isinstance(command, WriteInstruction):
+        return [command.exp]
+    elif isinstance(command, IfInstruction):
+        return [command.condition]
+    elif isinstance(command, RepeatInstruction):
+        return [command.count]
+    return []
@@ -0,0 +1,265 @@
+import marshal
+import os
+import sys
+from operator import itemgetter
+from types import SimpleNamespace
+from typing import List, Tuple, Callable, Dict, Iterator
+
+import sly
+from sly.yacc import Parser, Production, YaccProduction, ERROR_COUNT
+
+# Increment when the layout of the cache file changes.
+PARSER_TABLES_VERSION = 1
+
+ERROR_LOOKAHEAD = sys.maxsize
+
+
+class ParserTables:
+    """The parts of sly's LRTable that the parser uses at run time."""
+
+    def __init__(self, lr_action: dict, lr_goto: dict, defaulted_states: dict):
+        self.lr_action = lr_action
+        self.lr_goto = lr_goto
+        self.defaulted_states = defaulted_states
+
+
+class Grammar:
+    """The parts of sly's Grammar that the parser uses at run time."""
+
+    def __init__(self, productions: List[Production]):
+        self.Productions = productions
+
+
+class Reduction(YaccProduction):
+    """The production passed to the grammar rules by parse_token_arrays(): the slice holds the values of the
+    symbols and the line numbers are kept apart, instead of in sly's symbol objects."""
+    __slots__ = ('_lines',)
+
+    @property
+    def lineno(self):
+        for line in self._lines:
+            if line:
+                return line
+        raise AttributeError('No line number found')
+
+
+def value_namemap(production: Production) -> Dict[str, Callable]:
+    """Translates the accessors of the symbol names of the production (p.ID, p.expression0, ...) to read the
+    values from a list."""
+    probes = [SimpleNamespace(value=i) for i in range(production.len)]
+    return {name: itemgetter(accessor(probes)) for name, accessor in production.namemap.items()}
+
+
+class CachedParser(Parser):
+    """A sly parser whose LALR tables are built once and stored in a cache file. The cache is keyed by the
+    contents of the source files of the grammar, so it is regenerated when they change."""
+    # Set by the subclasses: the files the grammar is defined in, and the cache file.
+    grammar_files: Tuple[str, ...] = ()
+    tables_file: str = None
+
+    @classmethod
+    def _build(cls, definitions):
+        if cls.tables_file is None:
+            return
+        key = tables_key(cls.grammar_files)
+        functions = rule_functions(definitions)
+        if not load_tables(cls, key, functions):
+            super()._build(definitions)
+            save_tables(cls, key, functions)
+        cls._value_namemaps = [value_namemap(p) for p in cls._grammar.Productions]
+
+    def lexical_error(self, line: int, message: str):
+        print(message)
+
+    def parse_token_arrays(self, tokens):
+        return self.parse_token_blocks(iter([tokens]))
+
+    def parse_token_blocks(self, blocks: Iterator):
+        """The parsing loop of sly's parse(), including its error recovery, reading the tokens from parallel arrays
+        (see whilelexel.TokenArrays), which may come in several blocks. Objects are created only for the reported
+        tokens. The lexical errors are printed when the token that follows them is read, as sly's lexer does."""
+        actions = self._lrtable.lr_action
+        goto = self._lrtable.lr_goto
+        productions = self._grammar.Productions
+        defaulted_states = self._lrtable.defaulted_states
+        namemaps = self._value_namemaps
+        tokens = next(blocks)
+        names = tokens.names
+        types = tokens.types
+        token_lines = tokens.lines
+        count = len(types)
+        errors = tokens.errors
+        next_error = 0
+        reduction = Reduction(None)
+
+        # The lookahead is the index of a token in the current block, count at the end of the input, or
+        # ERROR_LOOKAHEAD.
+        lookahead = None
+        lookaheadstack = []
+        position = 0
+        errorcount = 0
+        self.errorok = False
+        states = [0]
+        values = [None]
+        lines = [None]
+        state = 0
+        while True:
+            if state not in defaulted_states:
+                if lookahead is None:
+                    if lookaheadstack:
+                        lookahead = lookaheadstack.pop()
+                    else:
+                        while True:
+                            while next_error < len(errors) and errors[next_error][0] <= position:
+                                self.lexical_error(errors[next_error][1], errors[next_error][2])
+                                next_error += 1
+                            if position < count or blocks is None:
+                                break
+                            tokens = next(blocks, None)
+                            if tokens is None:
+                                blocks = None
+                                break
+                            types = tokens.types
+                            token_lines = tokens.lines
+                            count = len(types)
+                            errors = tokens.errors
+                            next_error = 0
+                            position = 0
+                        lookahead = position
+                        if position < count:
+                            position += 1
+                if lookahead < count:
+                    t = actions[state].get(names[types[lookahead]])
+                else:
+                    t = actions[state].get("$end" if lookahead == count else "error")
+            else:
+                t = defaulted_states[state]
+
+            if t is not None:
+                if t > 0:
+                    states.append(t)
+                    state = t
+                    values.append(tokens.value(lookahead))
+                    lines.append(token_lines[lookahead])
+                    lookahead = None
+                    if errorcount:
+                        errorcount -= 1
+                    continue
+
+                if t < 0:
+                    p = productions[-t]
+                    plen = p.len
+                    reduction._namemap = namemaps[-t]
+                    if plen:
+                        reduction._slice = values[-plen:]
+                        reduction._lines = lines[-plen:]
+                        line = lines[-plen]
+                    else:
+                        reduction._slice = []
+                        reduction._lines = []
+                        line = None
+                    self.production = p
+                    value = p.func(self, reduction)
+                    if plen:
+                        del values[-plen:]
+                        del lines[-plen:]
+                        del states[-plen:]
+                    state = goto[states[-1]][p.name]
+                    states.append(state)
+                    values.append(value)
+                    lines.append(line)
+                    continue
+
+                return values[-1]
+
+            # The grammar has no error rules, so the error symbol is never shifted and the error() of the parser
+            # does not return a token.
+            if errorcount == 0 or self.errorok:
+                errorcount = ERROR_COUNT
+                self.errorok = False
+                self.error(tokens.token(lookahead) if lookahead < count else None)
+                if lookahead == count:
+                    return None
+            else:
+                errorcount = ERROR_COUNT
+
+            if len(states) <= 1 and lookahead != count:
+                lookahead = None
+                state = 0
+                del lookaheadstack[:]
+                continue
+
+            if lookahead == count:
+                return None
+
+            if lookahead != ERROR_LOOKAHEAD:
+                lookaheadstack.append(lookahead)
+                lookahead = ERROR_LOOKAHEAD
+            else:
+                states.pop()
+                values.pop()
+                lines.pop()
+                state = states[-1]
+
+
+def tables_key(grammar_files: Tuple[str, ...]) -> bytes:
+    """The versions and the sources of the grammar. The sources are compared as they are: importing hashlib takes
+    longer than the comparison."""
+    key = "{0} {1} {2}\n".format(PARSER_TABLES_VERSION, sly.__version__, sys.version).encode()
+    for file_name in grammar_files:
+        with open(file_name, 'rb') as f:
+            key += f.read()
+    return key
+
+
+def rule_functions(definitions: list) -> List[Callable]:
+    """Lists the grammar rule functions in the order of their definition, including the overloaded ones."""
+    functions = []
+    for name, value in definitions:
+        while callable(value) and hasattr(value, 'rules'):
+            functions.append(value)
+            value = getattr(value, 'next_func', None)
+    return functions
+
+
+def load_tables(cls, key: bytes, functions: List[Callable]) -> bool:
+    try:
+        with open(cls.tables_file, 'rb') as f:
+            tables = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return False
+    if not isinstance(tables, dict) or tables.get("key") != key:
+        return False
+    productions = []
+    for number, name, prod, precedence, function in tables["productions"]:
+        productions.append(Production(number, name, prod, precedence,
+                                      functions[function] if function is not None else None))
+    cls._grammar = Grammar(productions)
+    cls._lrtable = ParserTables(tables["lr_action"], tables["lr_goto"], tables["defaulted_states"])
+    return True
+
+
+def save_tables(cls, key: bytes, functions: List[Callable]):
+    productions = []
+    for p in cls._grammar.Productions:
+        function = None
+        if p.func is not None:
+            function = next(i for i, it in enumerate(functions) if it is p.func)
+        productions.append((p.number, p.name, p.prod, p.prec, function))
+    tables = {
+        "key": key,
+        "productions": productions,
+        "lr_action": cls._lrtable.lr_action,
+        "lr_goto": cls._lrtable.lr_goto,
+        "defaulted_states": cls._lrtable.defaulted_states,
+    }
+    # Written to a temporary file first, so a concurrent compiler never reads a partial cache.
+    temporary_file = "{0}.{1}".format(cls.tables_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cls.tables_file), exist_ok=True)
+        with open(temporary_file, 'wb') as f:
+            marshal.dump(tables, f)
+        os.replace(temporary_file, cls.tables_file)
+    except OSError:
+        # The cache is an optimization only, e.g. the directory may be read-only.
+        pass
@@ -0,0 +1,163 @@
+import sys
+from typing import Dict, List, Optional
+
+from implementation import *
+
+# The jump taken when the condition of a setCC is false.
+NEGATED_JUMPS = {
+    "sete": "jne",
+    "setne": "je",
+    "setb": "jae",
+    "setae": "jb",
+    "seta": "jbe",
+    "setbe": "ja",
+}
+JUMPS = {"jmp", "je", "jne", "jb", "jae", "ja", "jbe", "loop"}
+
+
+def is_label(line: str) -> bool:
+    return line.endswith(":")
+
+
+def jump_target(line: str) -> Optional[str]:
+    parts = line.split()
+    if len(parts) >= 2 and parts[0] in JUMPS:
+        return parts[-1]
+    return None
+
+
+def retarget(line: str, target: str) -> str:
+    parts = line.split()
+    parts[-1] = target
+    return " ".join(parts)
+
+
+def generate_optimized_code(commands: List[Instruction], out: Emitter):
+    """Generates the code of the commands like generate_code_of_commands(), with the peephole optimizer applied to
+    the code of every command. The jumps of a command only go to its own labels, so the code of a command can be
+    optimized on its own, without holding the code of the whole program."""
+    for command in commands:
+        segment = Emitter(None, sys.maxsize)
+        command.emit_code(segment)
+        for line in optimize_assembly(segment.lines):
+            out.emit(line)
+
+
+def optimize_assembly(lines: List[str]) -> List[str]:
+    """Removes redundant instructions from the generated code, until none is left. The rules rely on the way the
+    generator uses the registers: the value of a statement's expression is in eax, the flags and edx are scratch,
+    and no register is used by the code after a conditional jump, which computes its values again."""
+    while True:
+        optimized = simplify_jumps(combine_instructions(lines))
+        if len(optimized) == len(lines) and optimized == lines:
+            return optimized
+        lines = optimized
+
+
+def combine_instructions(lines: List[str]) -> List[str]:
+    """Replaces sequences of adjacent instructions by shorter ones. Every instruction is matched against the end of
+    the optimized code, so the result of a rule is matched again with the instructions that follow it."""
+    out: List[str] = []
+    for line in lines:
+        out.append(line)
+        while combine_tail(out):
+            pass
+    return out
+
+
+def combine_tail(out: List[str]) -> bool:
+    last = out[-1]
+
+    # A boolean computed with setCC and tested by a conditional jump: the jump tests the flags of the comparison.
+    if last.startswith("jne near ") and len(out) >= 5 and out[-2] in ("cmp al,1", "cmp eax,1"):
+        negations = 0
+        i = len(out) - 3
+        while i >= 0 and out[i] == "xor eax,1":
+            negations += 1
+            i -= 1
+        if i >= 2 and out[i] == "movzx eax,dl" and out[i - 1].endswith(" dl"):
+            condition = out[i - 1].split()[0]
+            if condition in NEGATED_JUMPS and out[i - 2].startswith("cmp "):
+                jump = NEGATED_JUMPS[condition] if negations % 2 == 0 else "j" + condition[len("set"):]
+                out[i - 1:] = ["{0} near {1}".format(jump, last.split()[-1])]
+                return True
+
+    # A boolean variable tested by a conditional jump is compared in memory.
+    if (last.startswith("jne near ") and len(out) >= 3 and out[-2] in ("cmp al,1", "cmp eax,1")
+            and out[-3].startswith("movzx eax,byte [")):
+        out[-3:] = ["cmp {0},1".format(out[-3][len("movzx eax,"):]), last]
+        return True
+
+    # A variable, in memory or in a register, loaded again after a comparison of its value: the comparison does not
+    # change eax.
+    if (last.startswith("mov eax,") and len(out) >= 4 and out[-4] == last and out[-3].startswith("cmp eax,")
+            and jump_target(out[-2]) is not None and not out[-2].startswith("jmp ")):
+        out.pop()
+        return True
+
+    # A natural variable, or a variable in a register, loaded right after it is stored: eax already holds its value.
+    # A boolean stored in memory may come from read_boolean, which only sets al.
+    if last.startswith("mov eax,") and len(out) >= 2 and out[-2] == "mov {0},eax".format(last[len("mov eax,"):]):
+        out.pop()
+        return True
+
+    return False
+
+
+def simplify_jumps(lines: List[str]) -> List[str]:
+    """Threads the jumps to jumps, removes the jumps to the next instruction, the unreachable instructions after a
+    jmp and the labels that no jump uses."""
+    # The labels that are followed by the same instruction are merged into the first one.
+    aliases: Dict[str, str] = {}
+    # The label a jmp at a label goes to.
+    jumps: Dict[str, str] = {}
+    run: List[str] = []
+    for line in lines:
+        if is_label(line):
+            run.append(line[:-1])
+            aliases[line[:-1]] = run[0]
+        else:
+            if line.startswith("jmp "):
+                for label in run:
+                    jumps[label] = jump_target(line)
+            run = []
+
+    def resolve(label: str) -> str:
+        seen = set()
+        label = aliases.get(label, label)
+        while label in jumps and label not in seen:
+            seen.add(label)
+            label = aliases.get(jumps[label], jumps[label])
+        return label
+
+    threaded = []
+    reachable = True
+    for line in lines:
+        if is_label(line):
+            reachable = True
+        elif not reachable:
+            continue
+        target = jump_target(line)
+        if target is not None:
+            line = retarget(line, resolve(target))
+            if line.startswith("jmp "):
+                reachable = False
+        threaded.append(line)
+
+    # A jump to one of the labels right after it.
+    following: List[str] = []
+    result: List[str] = []
+    for line in reversed(threaded):
+        if is_label(line):
+            following.append(aliases.get(line[:-1], line[:-1]))
+        else:
+            target = jump_target(line)
+            if target is not None and not line.startswith("loop ") and target in following:
+                continue
+            following = []
+        result.append(line)
+    result.reverse()
+
+    used = {jump_target(it) for it in result}
+    return [it for it in result if not is_label(it) or aliases.get(it[:-1], it[:-1]) in used and
+            aliases.get(it[:-1], it[:-1]) == it[:-1]]
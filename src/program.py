@@ -0,0 +1,98 @@
+import io
+import threading
+from typing import Dict, List, TextIO
+
+from implementation import *
+from whilelexel import tokenize
+from whileparser import WhileParser
+
+
+class Program:
+    """A checked and optimized While program with the compilation that owns its symbols and variables. Programs
+    are independent of each other, so they can be compiled and run in several threads at once; a program is run
+    by one thread at a time."""
+
+    def __init__(self, name: str, commands: List[Instruction], state: Compilation):
+        self.name = name
+        self.commands = commands
+        self.compilation = state
+        self.lock = threading.Lock()
+        self.assembly: str = None
+
+    def run(self, stdin: TextIO = None, stdout: TextIO = None) -> Dict[str, int]:
+        """Interprets the program, reading from and writing to the given streams (the standard streams when
+        None). Returns the final values of the initialized variables; errors are raised as Diagnostic, also the end
+        of the input, a line that is not a natural number and a division by zero."""
+        with self.lock, self.compilation:
+            self.compilation.stdin = stdin
+            self.compilation.stdout = stdout
+            try:
+                reset_frame()
+                try:
+                    execute_program(self.commands)
+                except RUNTIME_ERRORS as exception:
+                    raise runtime_diagnostic(exception)
+                return {name: self.compilation.value_frame[symbol.slot]
+                        for name, symbol in self.compilation.symbol_table.items()
+                        if self.compilation.value_frame[symbol.slot] is not None and not symbol.temporary}
+            finally:
+                self.compilation.stdin = None
+                self.compilation.stdout = None
+
+    def run_lanes(self, inputs: List[str]) -> list:
+        """Interprets the program once on every input at once, with NumPy (see vectorized.py). Returns a LaneResult
+        with the output and the error of every input, the same as running the program on each of them."""
+        from vectorized import execute_lanes
+        with self.lock, self.compilation:
+            return execute_lanes(self.commands, inputs)
+
+    def to_asm(self) -> str:
+        """The NASM assembly of the program, generated on the first call."""
+        with self.lock, self.compilation:
+            if self.assembly is None:
+                sink = io.StringIO()
+                generate_code(self.commands, sink)
+                self.assembly = sink.getvalue()
+            return self.assembly
+
+
+def compile(source: str) -> Program:
+    """Checks and optimizes the source of a While program. The first error is raised as a Diagnostic."""
+    with Compilation() as state:
+        parser = WhileParser(CHECKER, strict=True)
+        try:
+            commands = parser.parse_token_arrays(tokenize(source))
+        except (ZeroDivisionError, RecursionError) as exception:
+            # Folding a constant division, which the optimizer should leave to the run, or an expression too long
+            # for the recursive passes.
+            raise runtime_diagnostic(exception)
+        return Program(parser.program_name, commands, state)
+
+
+# The exceptions of the interpreter that are the program's fault, reported as a Diagnostic.
+RUNTIME_ERRORS = (EOFError, ZeroDivisionError, ValueError, RecursionError)
+
+
+def runtime_diagnostic(exception: Exception) -> Diagnostic:
+    """The exception as a Diagnostic at the line of the innermost command that was run (or checked, or optimized)
+    when it was raised, with the messages of server.py."""
+    command = innermost_local(exception, "command")
+    line = command.line if isinstance(command, Instruction) else -1
+    if isinstance(exception, EOFError):
+        return Diagnostic(line, "Unexpected end of input")
+    elif isinstance(exception, ZeroDivisionError):
+        return Diagnostic(line, "Division by zero")
+    elif isinstance(exception, RecursionError):
+        # The passes over an expression recurse into its operands, see benchmark_optimizer().
+        return Diagnostic(line, "Expression is nested too deeply")
+    return Diagnostic(line, "Not a natural number: {0}".format(innermost_local(exception, "input_line")))
+
+
+def innermost_local(exception: Exception, name: str):
+    """The value of the local variable in the innermost frame of the traceback that has one."""
+    value = None
+    traceback = exception.__traceback__
+    while traceback is not None:
+        value = traceback.tb_frame.f_locals.get(name, value)
+        traceback = traceback.tb_next
+    return value
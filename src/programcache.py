@@ -0,0 +1,205 @@
+import marshal
+import os
+import sys
+from typing import List, Tuple, Optional
+
+try:
+    # hashlib loads OpenSSL, which takes longer than compiling a small program.
+    from _blake2 import blake2b
+except ImportError:
+    from hashlib import blake2b
+
+from implementation import *
+from whilelexel import tokenize
+from whileparser import WhileParser, source_file
+
+# Increment when the layout of the cache files changes.
+PROGRAM_CACHE_VERSION = 3
+CACHE_DIRECTORY = source_file(os.path.join("__pycache__", "programs"))
+# The least recently used programs are evicted when the cache grows larger than this many bytes.
+CACHE_SIZE = 64 << 20
+# The sources of the passes whose results are cached: the cache is invalid when one of them changes.
+COMPILER_FILES = ("implementation.py", "optimizer.py", "whileparser.py", "whilelexel.py", "programcache.py")
+
+INSTRUCTION_TAGS = {
+    AssignInstruction: 0,
+    ReadInstruction: 1,
+    WriteInstruction: 2,
+    IfInstruction: 3,
+    WhileInstruction: 4,
+    RepeatInstruction: 5,
+}
+
+
+def compiler_version() -> bytes:
+    version = "{0} {1}\n".format(PROGRAM_CACHE_VERSION, sys.version).encode()
+    for name in COMPILER_FILES:
+        with open(source_file(name), 'rb') as f:
+            version += f.read()
+    return version
+
+
+def cache_key(text: str) -> str:
+    return blake2b(compiler_version() + text.encode(), digest_size=20).hexdigest()
+
+
+def encode_expression(exp: Expression):
+    """Expressions are encoded as marshal values: numbers and booleans as themselves, variables as their names and
+    operators as tuples of the operator and the operands."""
+    if isinstance(exp, NumberExpression):
+        return exp.value
+    elif isinstance(exp, BooleanExpression):
+        return bool(exp.value)
+    elif isinstance(exp, IdExpression):
+        return exp.name
+    elif isinstance(exp, BinopExpression):
+        return exp.op, encode_expression(exp.left), encode_expression(exp.right)
+    elif isinstance(exp, NotExpression):
+        return exp.op, encode_expression(exp.operand)
+    elif isinstance(exp, TernaryExpression):
+        return ("?", encode_expression(exp.condition), encode_expression(exp.true_expression),
+                encode_expression(exp.false_expression))
+    error(-1, "Bug: Unsupported expression: {0}".format(type(exp).__name__))
+
+
+def decode_expression(data) -> Expression:
+    if isinstance(data, bool):
+        return new_boolean_expression(data)
+    elif isinstance(data, int):
+        return new_number_expression(data)
+    elif isinstance(data, str):
+        return new_id_expression(data)
+    elif len(data) == 3:
+        return new_binop_expression(data[0], decode_expression(data[1]), decode_expression(data[2]))
+    elif len(data) == 2:
+        return NotExpression(data[0], decode_expression(data[1]))
+    return TernaryExpression(decode_expression(data[1]), decode_expression(data[2]), decode_expression(data[3]))
+
+
+def encode_commands(commands: List[Instruction]) -> list:
+    """Instructions are encoded as tuples of a tag, the line and the fields."""
+    encoded = []
+    for command in commands:
+        tag = INSTRUCTION_TAGS[type(command)]
+        if isinstance(command, AssignInstruction):
+            encoded.append((tag, command.line, command.left, encode_expression(command.right)))
+        elif isinstance(command, ReadInstruction):
+            encoded.append((tag, command.line, command.id))
+        elif isinstance(command, WriteInstruction):
+            encoded.append((tag, command.line, encode_expression(command.exp)))
+        elif isinstance(command, IfInstruction):
+            encoded.append((tag, command.line, encode_expression(command.condition),
+                            encode_commands(command.true_branch), encode_commands(command.false_branch)))
+        elif isinstance(command, WhileInstruction):
+            encoded.append((tag, command.line, encode_expression(command.condition), encode_commands(command.body)))
+        elif isinstance(command, RepeatInstruction):
+            encoded.append((tag, command.line, encode_expression(command.count), encode_commands(command.body)))
+    return encoded
+
+
+def decode_commands(data: list) -> List[Instruction]:
+    commands = []
+    for it in data:
+        tag, line = it[0], it[1]
+        if tag == 0:
+            commands.append(AssignInstruction(line, it[2], decode_expression(it[3])))
+        elif tag == 1:
+            commands.append(ReadInstruction(line, it[2]))
+        elif tag == 2:
+            commands.append(WriteInstruction(line, decode_expression(it[2])))
+        elif tag == 3:
+            commands.append(IfInstruction(line, decode_expression(it[2]), decode_commands(it[3]),
+                                          decode_commands(it[4])))
+        elif tag == 4:
+            commands.append(WhileInstruction(line, decode_expression(it[2]), decode_commands(it[3])))
+        else:
+            commands.append(RepeatInstruction(line, decode_expression(it[2]), decode_commands(it[3])))
+    return commands
+
+
+def cache_file(key: str) -> str:
+    return os.path.join(CACHE_DIRECTORY, key + ".ast")
+
+
+def load_program(key: str) -> Optional[Tuple[str, List[Instruction]]]:
+    """Declares the symbols of the cached program and returns its name and its resolved commands. The type
+    annotations are recomputed, which cannot fail on a cached program."""
+    file_name = cache_file(key)
+    try:
+        with open(file_name, 'rb') as f:
+            name, symbols, data, eliminated_evaluations = marshal.load(f)
+        # The modification time orders the files for the eviction.
+        os.utime(file_name)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    compilation().eliminated_evaluations = eliminated_evaluations
+    for symbol_name, symbol_type, line, temporary in symbols:
+        symbol = Symbol(line, symbol_name, symbol_type)
+        symbol.temporary = temporary
+        symbol.declare()
+    commands = decode_commands(data)
+    type_check_commands(commands)
+    resolve_commands(commands)
+    return name, commands
+
+
+def save_program(key: str, name: str, commands: List[Instruction]):
+    symbols = [(it.name, it.symbol_type, it.line, it.temporary) for it in compilation().symbol_table.values()]
+    file_name = cache_file(key)
+    # Written to a temporary file first, so a concurrent compiler never reads a partial program.
+    temporary_file = "{0}.{1}".format(file_name, os.getpid())
+    try:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        with open(temporary_file, 'wb') as f:
+            marshal.dump((name, symbols, encode_commands(commands), compilation().eliminated_evaluations), f)
+        os.replace(temporary_file, file_name)
+        evict(CACHE_SIZE)
+    except (OSError, ValueError):
+        # The cache is an optimization only, e.g. the directory may be read-only or the program may be nested too
+        # deeply for marshal.
+        pass
+
+
+def evict(size: int):
+    """Removes the least recently used programs until the cache takes at most size bytes. Another process may
+    remove the same files at the same time."""
+    entries = []
+    total = 0
+    with os.scandir(CACHE_DIRECTORY) as it:
+        for entry in it:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    if total <= size:
+        return
+    entries.sort()
+    for _, entry_size, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= entry_size
+        if total <= size:
+            break
+
+
+def compile_cached(parser: WhileParser, text: str, use_cache: bool = True) -> Tuple[str, List[Instruction]]:
+    """Checks and optimizes the program with the parser (in CHECKER mode), or loads it from the cache. Returns the
+    name of the program and its commands, or None when the parser could not recover from a syntax error. Programs
+    with lexical or syntax errors are not cached, so their errors are reported every time."""
+    key = cache_key(text) if use_cache else None
+    if key is not None:
+        program = load_program(key)
+        if program is not None:
+            return program
+    tokens = tokenize(text)
+    syntax_errors = parser.syntax_errors
+    commands = parser.parse_token_arrays(tokens)
+    if commands is None:
+        return None
+    if key is not None and not tokens.errors and parser.syntax_errors == syntax_errors:
+        save_program(key, parser.program_name, commands)
+    return parser.program_name, commands
@@ -0,0 +1,182 @@
+import re
+from typing import List, Dict
+
+from implementation import *
+
+PYTHON_OPERATORS = {
+    "+": "+",
+    "-": "-",
+    "*": "*",
+    "/": "//",
+    "%": "%",
+    "<": "<",
+    ">": ">",
+    "<=": "<=",
+    ">=": ">=",
+    "=": "==",
+    # The booleans are 0 and 1 (or False and True), and unlike 'and' and 'or' these evaluate both operands.
+    "and": "&",
+    "or": "|",
+}
+
+# The operators of one precedence level in Python, which associate to the left. The comparisons are not among them,
+# Python chains them.
+PYTHON_LEVELS = [("+", "-"), ("*", "/", "%"), ("and",), ("or",)]
+
+# Ends every generated statement, so an error in the module can be reported at the line of the While command.
+LINE_COMMENT = "  # line "
+
+
+class PythonProgram:
+    """A While program translated to a Python module. The module defines main(), which runs the program on
+    local variables and returns their final values. A variable that is read before it is assigned is an unbound
+    local variable of main(), or an undefined global when the program never assigns it; run() reports it like the
+    tree walking interpreter."""
+
+    def __init__(self, name: str, source: str):
+        self.name = name
+        self.source = source
+        self.code = compile(source, "<while program {0}>".format(name), "exec")
+
+    def run(self) -> Dict[str, int]:
+        namespace = {"__name__": "while_{0}".format(self.name)}
+        exec(self.code, namespace)
+        try:
+            values = namespace["main"]()
+        except NameError as exception:
+            self.report_uninitialized(exception)
+            raise
+        state = compilation()
+        for name, value in values.items():
+            state.value_frame[state.symbol_table[name].slot] = value
+        return values
+
+    def report_uninitialized(self, exception: NameError):
+        line = None
+        traceback = exception.__traceback__
+        while traceback is not None:
+            if traceback.tb_frame.f_code.co_filename == self.code.co_filename:
+                line = traceback.tb_lineno
+            traceback = traceback.tb_next
+        variable = re.search(r"'v_(\w+)'", str(exception))
+        if line is None or variable is None:
+            return
+        source_line = self.source.splitlines()[line - 1]
+        if LINE_COMMENT in source_line:
+            error(int(source_line.rsplit(LINE_COMMENT, 1)[1]),
+                  "Variable has not been initialized {0}".format(variable.group(1)))
+
+    def dump(self, file_name: str):
+        with open(file_name, 'w') as f:
+            f.write(self.source)
+
+    @staticmethod
+    def load(file_name: str) -> 'PythonProgram':
+        with open(file_name, 'r') as f:
+            source = f.read()
+        return PythonProgram(file_name, source)
+
+
+def generate_python(name: str, commands: List[Instruction]) -> PythonProgram:
+    lines = ["# Generated from the While program '{0}'.".format(name),
+             "",
+             "",
+             "def main(print=print, input=input, int=int):"]
+    generate_python_of_commands(lines, 1, commands)
+    lines.append(INDENT + "return {name[2:]: value for name, value in locals().items() "
+                          "if name.startswith(\"v_\")}")
+    lines.append("")
+    lines.append("")
+    lines.append("if __name__ == '__main__':")
+    lines.append(INDENT + "main()")
+    lines.append("")
+    return PythonProgram(name, "\n".join(lines))
+
+
+def python_name(name: str) -> str:
+    # While identifiers may clash with Python keywords and builtins.
+    return "v_{0}".format(name)
+
+
+def generate_python_of_commands(lines: List[str], indent_level: int, commands: List[Instruction]):
+    if not commands:
+        lines.append(INDENT * indent_level + "pass")
+    for command in commands:
+        generate_python_of_instruction(lines, indent_level, command)
+
+
+def generate_python_of_instruction(lines: List[str], indent_level: int, command: Instruction):
+    prefix = INDENT * indent_level
+    suffix = LINE_COMMENT + str(command.line)
+    if isinstance(command, AssignInstruction):
+        lines.append(prefix + "{0} = {1}".format(python_name(command.left), python_expression(command.right)) +
+                     suffix)
+
+    elif isinstance(command, ReadInstruction):
+        if command.symbol.symbol_type == NATURAL:
+            lines.append(prefix + "{0} = int(input())".format(python_name(command.id)) + suffix)
+        else:
+            lines.append(prefix + "{0} = 1 if input() == \"true\" else 0".format(python_name(command.id)) + suffix)
+
+    elif isinstance(command, WriteInstruction):
+        if command.exp_type == NATURAL:
+            lines.append(prefix + "print({0})".format(python_expression(command.exp)) + suffix)
+        else:
+            lines.append(prefix + "print(\"true\" if {0} else \"false\")".format(python_expression(command.exp)) +
+                         suffix)
+
+    elif isinstance(command, IfInstruction):
+        lines.append(prefix + "if {0}:".format(python_expression(command.condition)) + suffix)
+        generate_python_of_commands(lines, indent_level + 1, command.true_branch)
+        if command.false_branch:
+            lines.append(prefix + "else:")
+            generate_python_of_commands(lines, indent_level + 1, command.false_branch)
+
+    elif isinstance(command, WhileInstruction):
+        lines.append(prefix + "while {0}:".format(python_expression(command.condition)) + suffix)
+        generate_python_of_commands(lines, indent_level + 1, command.body)
+
+    elif isinstance(command, RepeatInstruction):
+        lines.append(prefix + "for _ in range({0}):".format(python_expression(command.count)) + suffix)
+        generate_python_of_commands(lines, indent_level + 1, command.body)
+
+    else:
+        error(command.line, "Bug: Unsupported instruction: {0}".format(type(command).__name__))
+
+
+def python_expression(exp: Expression) -> str:
+    """Translates the expression to an inlined Python expression, which evaluates its operands in the order of the
+    tree interpreter."""
+    if isinstance(exp, NumberExpression):
+        return str(exp.value)
+
+    elif isinstance(exp, BooleanExpression):
+        return "1" if exp.value else "0"
+
+    elif isinstance(exp, IdExpression):
+        return python_name(exp.name)
+
+    elif isinstance(exp, BinopExpression):
+        if exp.op not in PYTHON_OPERATORS:
+            error(-1, "Unkonwn operator: {0}".format(exp.op))
+        return "({0})".format(python_operation(exp))
+
+    elif isinstance(exp, NotExpression):
+        return "(not {0})".format(python_expression(exp.operand))
+
+    elif isinstance(exp, TernaryExpression):
+        return "({0} if {1} else {2})".format(python_expression(exp.true_expression),
+                                              python_expression(exp.condition),
+                                              python_expression(exp.false_expression))
+
+    error(-1, "Bug: Unsupported expression: {0}".format(type(exp).__name__))
+
+
+def python_operation(exp: BinopExpression) -> str:
+    """The operator without the parentheses around it. A left operand of the same precedence level needs none either,
+    which keeps a long chain within the limit of nested parentheses of the Python parser (200)."""
+    if isinstance(exp.left, BinopExpression) and any(exp.op in it and exp.left.op in it for it in PYTHON_LEVELS):
+        left = python_operation(exp.left)
+    else:
+        left = python_expression(exp.left)
+    return "{0} {1} {2}".format(left, PYTHON_OPERATORS[exp.op], python_expression(exp.right))
@@ -0,0 +1,147 @@
+import asyncio
+import resource
+import sys
+from typing import Iterator, List, Optional
+
+from implementation import *
+from program import Program, compile
+
+# The requests of a running session to the event loop: a line of input, or a pause so the other sessions can run
+# (and the output written so far can be sent).
+READ = 0
+PAUSE = 1
+
+# A long loop pauses after this many iterations, so a busy session does not stall the others.
+TIME_SLICE = 1000
+# The output is sent when this many lines are waiting, even if the program does not read or pause.
+OUTPUT_LINES = 256
+MAX_SOURCE_SIZE = 1 << 20
+
+
+def execute_steps(commands: List[Instruction], output: List[str]) -> Iterator[int]:
+    """Interprets the commands like execute_commands(), as a generator: a read instruction yields READ and expects
+    the input line (None at the end of the input) to be sent back, and the lines written are appended to output."""
+    for command in commands:
+        try:
+            yield from execute_step(command, output)
+        except UninitializedVariable as variable:
+            error(command.line, "Variable has not been initialized {0}".format(variable))
+
+
+def execute_step(command: Instruction, output: List[str]) -> Iterator[int]:
+    if isinstance(command, ReadInstruction):
+        input_line = yield READ
+        if input_line is None:
+            error(command.line, "Unexpected end of input")
+        try:
+            command.store(input_line)
+        except ValueError:
+            error(command.line, "Not a natural number: {0}".format(input_line))
+
+    elif isinstance(command, WriteInstruction):
+        output.append(command.output_line())
+        if len(output) >= OUTPUT_LINES:
+            yield PAUSE
+
+    elif isinstance(command, IfInstruction):
+        if command.condition.get_value():
+            yield from execute_steps(command.true_branch, output)
+        else:
+            yield from execute_steps(command.false_branch, output)
+
+    elif isinstance(command, WhileInstruction):
+        iterations = 0
+        while command.condition.get_value():
+            yield from execute_steps(command.body, output)
+            iterations += 1
+            if iterations % TIME_SLICE == 0:
+                yield PAUSE
+
+    elif isinstance(command, RepeatInstruction):
+        for i in range(command.count.get_value(), 0, -1):
+            yield from execute_steps(command.body, output)
+            if i % TIME_SLICE == 0:
+                yield PAUSE
+
+    else:
+        command.execute()
+
+
+async def read_program(reader: asyncio.StreamReader) -> Program:
+    """A session starts with the size of the source in bytes on a line of its own, followed by the source."""
+    header = await reader.readline()
+    if not header.strip().isdigit() or int(header) > MAX_SOURCE_SIZE:
+        error(-1, "Expected the size of the program, at most {0} bytes".format(MAX_SOURCE_SIZE))
+    source = await reader.readexactly(int(header))
+    # Checking and optimizing a large program takes a while, so it runs in a thread while the other sessions go on.
+    return await asyncio.get_running_loop().run_in_executor(None, compile, source.decode(errors="replace"))
+
+
+async def run_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Compiles the program sent by the client and runs it, reading its input from the rest of the connection and
+    writing its output back. Errors are written like the command line interpreter prints them, and any other
+    exception of the program (e.g. a division by zero) as its type and message, before the connection is closed."""
+    output: List[str] = []
+    try:
+        program = await read_program(reader)
+        with program.compilation:
+            reset_frame()
+        steps = execute_steps(program.commands, output)
+        input_line: Optional[str] = None
+        while True:
+            request = steps.send(input_line)
+            input_line = None
+            if output:
+                writer.write("".join(line + "\n" for line in output).encode())
+                output.clear()
+            if request == READ:
+                await writer.drain()
+                line = await reader.readline()
+                input_line = line.decode(errors="replace").rstrip("\r\n") if line else None
+            else:
+                await writer.drain()
+                await asyncio.sleep(0)
+    except StopIteration:
+        pass
+    except Diagnostic as diagnostic:
+        output.append(str(diagnostic))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return
+    except Exception as exception:
+        output.append("Error: {0}: {1}".format(type(exception).__name__, exception))
+    try:
+        if output:
+            writer.write("".join(line + "\n" for line in output).encode())
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    except ConnectionError:
+        pass
+
+
+def raise_file_limit():
+    """Every session takes a file descriptor, allow as many as the system does."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def serve(address: str):
+    if address.startswith("unix:"):
+        server = await asyncio.start_unix_server(run_session, address[len("unix:"):], backlog=4096)
+    else:
+        host, _, port = address.rpartition(":")
+        server = await asyncio.start_server(run_session, host or "127.0.0.1", int(port), backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        print("Usage: {0} [[host:]port|unix:path]".format(sys.argv[0]), file=sys.stderr)
+        exit(1)
+    raise_file_limit()
+    try:
+        asyncio.run(serve(sys.argv[1] if len(sys.argv) == 2 else "127.0.0.1:9999"))
+    except KeyboardInterrupt:
+        pass
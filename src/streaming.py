@@ -0,0 +1,65 @@
+from typing import TextIO
+
+from implementation import *
+from optimizer import Optimizer
+from peephole import generate_optimized_code
+
+STREAMING_MODES = (PRINTER, INTERPRETER, COMPILER, COMPILER_64, CHECKER)
+
+
+class CommandStream:
+    """Runs the top-level commands of a program one by one, as the parser reduces them, so only the command
+    being processed is kept in memory. The constants known after a command are kept by the optimizer for the
+    next ones, so the result is the same as optimizing the whole program at once. A type error in a command is
+    reported only after the commands before it have run."""
+
+    def __init__(self, mode: int, name: str, output: TextIO = None):
+        if mode not in STREAMING_MODES:
+            error(-1, "The mode cannot stream the program")
+        self.mode = mode
+        self.optimizer = Optimizer()
+        self.reachable = True
+        self.out = Emitter(sys.stdout if output is None else output)
+        reset_frame()
+        # The symbols declared in the prologue, the temporaries declared later are declared in the epilogue.
+        self.symbols = len(compilation().symbol_table)
+        if mode in TARGETS:
+            compilation().target = TARGETS[mode]
+            generate_prologue(self.out)
+        elif mode == PRINTER:
+            print_program_header(name)
+
+    def process(self, command: Instruction):
+        commands = [command]
+        command.type_check()
+        # The commands after one that never ends are checked, but not run.
+        if not self.reachable:
+            return
+        self.optimizer.optimalize_const_merge(commands)
+        self.reachable = self.optimizer.eliminate_dead_code(commands)
+        # The printed header cannot declare the temporaries any more.
+        if self.mode != PRINTER:
+            self.optimizer.hoist_loop_invariants(commands)
+            self.optimizer.eliminate_common_subexpressions(commands)
+            extend_frame()
+        resolve_commands(commands)
+        if self.mode == INTERPRETER:
+            execute_program(commands)
+        elif self.mode in TARGETS:
+            generate_optimized_code(commands, self.out)
+        elif self.mode == PRINTER:
+            print_commands(1, commands)
+        # The constants of the command are not shared with the next ones.
+        compilation().number_expressions.clear()
+
+    def finish(self):
+        if self.mode in TARGETS:
+            generate_epilogue(self.out)
+            temporaries = list(compilation().symbol_table.values())[self.symbols:]
+            if temporaries:
+                self.out.emit("section .bss")
+                for symbol in temporaries:
+                    symbol.emit_code(self.out)
+                self.out.flush()
+        elif self.mode == PRINTER:
+            print("end")
@@ -0,0 +1,77 @@
+import io
+import unittest
+
+from implementation import Diagnostic
+from program import compile
+
+DIVISION = """program division
+  natural a
+begin
+  write(1)
+  read(a)
+  write(5 / a)
+end
+"""
+
+
+class ProgramErrorsTest(unittest.TestCase):
+    """The errors of compile() and Program.run() are Diagnostics at the line of the command, never the exceptions
+    of Python."""
+
+    def run_program(self, source: str, stdin: str) -> (Diagnostic, str):
+        stdout = io.StringIO()
+        with self.assertRaises(Diagnostic) as context:
+            compile(source).run(io.StringIO(stdin), stdout)
+        return context.exception, stdout.getvalue()
+
+    def test_division_by_zero(self):
+        diagnostic, output = self.run_program(DIVISION, "0\n")
+        self.assertEqual((diagnostic.line, diagnostic.message), (6, "Division by zero"))
+        self.assertEqual(output, "1\n")
+
+    def test_modulo_by_zero(self):
+        diagnostic, _ = self.run_program(DIVISION.replace("/", "%"), "0\n")
+        self.assertEqual((diagnostic.line, diagnostic.message), (6, "Division by zero"))
+
+    def test_end_of_input(self):
+        diagnostic, output = self.run_program(DIVISION, "")
+        self.assertEqual((diagnostic.line, diagnostic.message), (5, "Unexpected end of input"))
+        self.assertEqual(output, "1\n")
+
+    def test_not_a_natural_number(self):
+        diagnostic, _ = self.run_program(DIVISION, "five\n")
+        self.assertEqual((diagnostic.line, diagnostic.message), (5, "Not a natural number: five"))
+
+    def test_constant_division_by_zero(self):
+        diagnostic, _ = self.run_program("program constant\nbegin\n  write(5 / 0)\nend\n", "")
+        self.assertEqual((diagnostic.line, diagnostic.message), (3, "Division by zero"))
+
+    def test_expression_nested_too_deeply(self):
+        source = "program deep\n  natural a\nbegin\n  a := 1\n  write(a{0})\nend\n".format(" + 1 + a" * 1500)
+        with self.assertRaises(Diagnostic) as context:
+            compile(source)
+        self.assertEqual((context.exception.line, context.exception.message), (5, "Expression is nested too deeply"))
+
+    def test_long_expression(self):
+        stdout = io.StringIO()
+        compile("program long\n  natural a\nbegin\n  read(a)\n  write(a{0})\nend\n".format(" + 1" * 800)).run(
+            io.StringIO("2\n"), stdout)
+        self.assertEqual(stdout.getvalue(), "802\n")
+
+    def test_nested_command(self):
+        source = DIVISION.replace("  write(5 / a)\n", "  repeat 2 do\n    if a = 0 then\n      write(5 / a)\n"
+                                                        "    endif\n  done\n")
+        diagnostic, _ = self.run_program(source, "0\n")
+        self.assertEqual((diagnostic.line, diagnostic.message), (8, "Division by zero"))
+
+    def test_run_after_error(self):
+        program = compile(DIVISION)
+        with self.assertRaises(Diagnostic):
+            program.run(io.StringIO("0\n"), io.StringIO())
+        stdout = io.StringIO()
+        self.assertEqual(program.run(io.StringIO("5\n"), stdout), {"a": 5})
+        self.assertEqual(stdout.getvalue(), "1\n1\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+import glob
+import sys
+from typing import List
+
+import numpy
+
+from implementation import *
+
+# Naturals are 64 bit integers while they fit. An operation that overflows is computed again on Python integers
+# (object arrays), so every lane computes the same numbers as the tree interpreter.
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+# A product whose estimate in floating point is below this cannot overflow.
+MULTIPLY_LIMIT = float(1 << 62)
+
+
+class LaneResult:
+    """The outcome of running the program on one input: what it wrote, and the error that stopped it, if any."""
+
+    def __init__(self, output: str, error: Exception = None):
+        self.output = output
+        self.error = error
+
+
+def add(left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+    result = left + right
+    if result.dtype != object and numpy.any((left ^ result) & (right ^ result) < 0):
+        return left.astype(object) + right.astype(object)
+    return result
+
+
+def subtract(left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+    result = left - right
+    if result.dtype != object and numpy.any((left ^ right) & (left ^ result) < 0):
+        return left.astype(object) - right.astype(object)
+    return result
+
+
+def multiply(left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+    result = left * right
+    if result.dtype != object and numpy.any(numpy.abs(left.astype(float) * right.astype(float)) >= MULTIPLY_LIMIT):
+        return left.astype(object) * right.astype(object)
+    return result
+
+
+def divide(left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+    if left.dtype != object and right.dtype != object and numpy.any((left == INT64_MIN) & (right == -1)):
+        return left.astype(object) // right.astype(object)
+    return left // right
+
+
+def zero_division_error(op: str) -> ZeroDivisionError:
+    """The error of the tree interpreter, whose message depends on the operator and the version of Python."""
+    try:
+        return 1 // 0 if op == "/" else 1 % 0
+    except ZeroDivisionError as e:
+        return e
+
+
+OPERATORS = {
+    "+": add,
+    "-": subtract,
+    "*": multiply,
+    "/": divide,
+    "%": numpy.remainder,
+    "<": numpy.less,
+    ">": numpy.greater,
+    "<=": numpy.less_equal,
+    ">=": numpy.greater_equal,
+    "=": numpy.equal,
+    "and": numpy.logical_and,
+    "or": numpy.logical_or,
+}
+
+
+def input_lines(text: str) -> List[str]:
+    """The lines the read instructions see in the input, like read_line(). The line ends of a file are translated
+    when it is read as text."""
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def parse_natural(line: str):
+    try:
+        return int(line), None
+    except ValueError as e:
+        return 0, e
+
+
+def natural_array(values: list) -> numpy.ndarray:
+    if all(INT64_MIN <= it <= INT64_MAX for it in values):
+        return numpy.array(values, dtype=numpy.int64)
+    return numpy.array(values, dtype=object)
+
+
+class Lanes:
+    """The state of running one program on many inputs at once. Every variable is an array with an element for
+    each input (a lane), and every command is executed once on the array of the lanes that reach it, so an operator
+    of an expression is one NumPy operation for all of them. A lane stops at its first error, like the tree
+    interpreter."""
+
+    def __init__(self, inputs: List[str]):
+        count = len(inputs)
+        symbols = compilation().symbol_table.values()
+        self.values: List[numpy.ndarray] = [None] * len(symbols)
+        # The lanes in which the variables were assigned, None when all of them were.
+        self.initialized: List[numpy.ndarray] = [None] * len(symbols)
+        for symbol in symbols:
+            dtype = numpy.int64 if symbol.symbol_type == NATURAL else bool
+            self.values[symbol.slot] = numpy.zeros(count, dtype=dtype)
+            self.initialized[symbol.slot] = numpy.zeros(count, dtype=bool)
+
+        # The lines of all the inputs one after the other, parsed for both types, and where the input of each lane
+        # starts, how long it is and how much of it was read.
+        cells: List[str] = []
+        offsets = []
+        for text in inputs:
+            offsets.append(len(cells))
+            cells.extend(input_lines(text))
+        self.offsets = numpy.array(offsets + [len(cells)], dtype=numpy.int64)
+        self.lengths = numpy.diff(self.offsets)
+        self.positions = numpy.zeros(count, dtype=numpy.int64)
+        naturals = [parse_natural(it) for it in cells]
+        self.naturals = natural_array([it[0] for it in naturals])
+        self.input_errors = {index: it[1] for index, it in enumerate(naturals) if it[1] is not None}
+        self.booleans = numpy.array([it == "true" for it in cells], dtype=bool)
+
+        self.failed = numpy.zeros(count, dtype=bool)
+        self.errors: List[Exception] = [None] * count
+        self.failures = 0
+        # The lines written by the write instructions, in the order they were written, with their lanes.
+        self.written_lanes: List[numpy.ndarray] = []
+        self.written_lines: List[numpy.ndarray] = []
+
+    def fail(self, lanes: numpy.ndarray, error: Exception):
+        """Stops the lanes at the error, unless an earlier error stopped them."""
+        for lane in lanes.tolist():
+            if not self.failed[lane]:
+                self.failed[lane] = True
+                self.errors[lane] = error
+                self.failures += 1
+
+    def running(self, lanes: numpy.ndarray, value: numpy.ndarray, failures: int) -> (numpy.ndarray, numpy.ndarray):
+        """The lanes that did not fail while the value was computed, and their values. failures is the number of
+        failed lanes before."""
+        if self.failures == failures:
+            return lanes, value
+        running = ~self.failed[lanes]
+        return lanes[running], value[running]
+
+    def execute(self, commands: List[Instruction], lanes: numpy.ndarray) -> numpy.ndarray:
+        """Executes the commands on the lanes, and returns the lanes that did not fail, in increasing order."""
+        for command in commands:
+            if len(lanes) == 0:
+                break
+            lanes = self.execute_instruction(command, lanes)
+        return lanes
+
+    def execute_instruction(self, command: Instruction, lanes: numpy.ndarray) -> numpy.ndarray:
+        line = command.line
+        failures = self.failures
+        if isinstance(command, AssignInstruction):
+            lanes, value = self.running(lanes, self.evaluate(command.right, lanes, line), failures)
+            self.store(command.symbol.slot, lanes, value)
+
+        elif isinstance(command, ReadInstruction):
+            lanes = self.read(command, lanes)
+
+        elif isinstance(command, WriteInstruction):
+            lanes, value = self.running(lanes, self.evaluate(command.exp, lanes, line), failures)
+            if command.exp_type == NATURAL:
+                self.written_lines.append(value.astype(str))
+            else:
+                self.written_lines.append(numpy.where(value, "true", "false"))
+            self.written_lanes.append(lanes)
+
+        elif isinstance(command, IfInstruction):
+            lanes, condition = self.running(lanes, self.evaluate(command.condition, lanes, line), failures)
+            true_lanes = self.execute(command.true_branch, lanes[condition])
+            false_lanes = self.execute(command.false_branch, lanes[~condition])
+            lanes = numpy.sort(numpy.concatenate((true_lanes, false_lanes)))
+
+        elif isinstance(command, WhileInstruction):
+            finished = []
+            while len(lanes):
+                failures = self.failures
+                lanes, condition = self.running(lanes, self.evaluate(command.condition, lanes, line), failures)
+                finished.append(lanes[~condition])
+                lanes = self.execute(command.body, lanes[condition])
+            lanes = numpy.sort(numpy.concatenate(finished))
+
+        elif isinstance(command, RepeatInstruction):
+            # The count is evaluated once, and the lanes leave the loop when their own count runs out.
+            lanes, remaining = self.running(lanes, self.evaluate(command.count, lanes, line), failures)
+            finished = []
+            while len(lanes):
+                done = remaining <= 0
+                finished.append(lanes[done])
+                lanes, remaining = lanes[~done], remaining[~done]
+                body_lanes = self.execute(command.body, lanes)
+                if len(body_lanes) != len(lanes):
+                    remaining = remaining[numpy.isin(lanes, body_lanes, assume_unique=True)]
+                lanes, remaining = body_lanes, remaining - 1
+            lanes = numpy.sort(numpy.concatenate(finished))
+
+        else:
+            error(line, "Bug: Unsupported instruction: {0}".format(type(command).__name__))
+        return lanes
+
+    def store(self, slot: int, lanes: numpy.ndarray, value: numpy.ndarray):
+        if value.dtype == object and self.values[slot].dtype != object:
+            self.values[slot] = self.values[slot].astype(object)
+        self.values[slot][lanes] = value
+        initialized = self.initialized[slot]
+        if initialized is not None:
+            initialized[lanes] = True
+            if initialized.all():
+                self.initialized[slot] = None
+
+    def read(self, command: ReadInstruction, lanes: numpy.ndarray) -> numpy.ndarray:
+        positions = self.positions[lanes]
+        ended = positions >= self.lengths[lanes]
+        if ended.any():
+            self.fail(lanes[ended], EOFError("EOF when reading a line"))
+            lanes, positions = lanes[~ended], positions[~ended]
+        self.positions[lanes] += 1
+        cells = self.offsets[lanes] + positions
+        if command.symbol.symbol_type == NATURAL:
+            if self.input_errors:
+                failures = self.failures
+                for lane, cell in zip(lanes.tolist(), cells.tolist()):
+                    if cell in self.input_errors:
+                        self.fail(numpy.array([lane]), self.input_errors[cell])
+                lanes, cells = self.running(lanes, cells, failures)
+            value = self.naturals[cells]
+        else:
+            value = self.booleans[cells]
+        self.store(command.symbol.slot, lanes, value)
+        return lanes
+
+    def evaluate(self, exp: Expression, lanes: numpy.ndarray, line: int) -> numpy.ndarray:
+        """The values of the expression in the lanes. The lanes that fail keep a value, which is not used."""
+        if isinstance(exp, NumberExpression):
+            return natural_array([exp.value]).repeat(len(lanes))
+
+        if isinstance(exp, BooleanExpression):
+            return numpy.full(len(lanes), bool(exp.value))
+
+        if isinstance(exp, IdExpression):
+            slot = exp.symbol.slot
+            if self.initialized[slot] is not None:
+                uninitialized = ~self.initialized[slot][lanes]
+                if uninitialized.any():
+                    self.fail(lanes[uninitialized], Diagnostic(line, "Variable has not been initialized {0}".format(
+                        exp.name)))
+            return self.values[slot][lanes]
+
+        if isinstance(exp, BinopExpression):
+            if exp.op not in OPERATORS:
+                error(line, "Unkonwn operator: {0}".format(exp.op))
+            left = self.evaluate(exp.left, lanes, line)
+            right = self.evaluate(exp.right, lanes, line)
+            if exp.op in ("/", "%"):
+                zero = right == 0
+                if zero.any():
+                    self.fail(lanes[zero], zero_division_error(exp.op))
+                    right = numpy.where(zero, 1, right)
+            return OPERATORS[exp.op](left, right)
+
+        if isinstance(exp, NotExpression):
+            return numpy.logical_not(self.evaluate(exp.operand, lanes, line))
+
+        if isinstance(exp, TernaryExpression):
+            condition = self.evaluate(exp.condition, lanes, line).astype(bool)
+            true_value = self.evaluate(exp.true_expression, lanes[condition], line)
+            false_value = self.evaluate(exp.false_expression, lanes[~condition], line)
+            value = numpy.empty(len(lanes), dtype=numpy.result_type(true_value, false_value))
+            value[condition] = true_value
+            value[~condition] = false_value
+            return value
+
+        error(line, "Bug: Unsupported expression: {0}".format(type(exp).__name__))
+
+    def results(self) -> List[LaneResult]:
+        count = len(self.errors)
+        outputs = [""] * count
+        if self.written_lanes:
+            written_lanes = numpy.concatenate(self.written_lanes)
+            # The lines of every lane, in the order they were written.
+            order = numpy.argsort(written_lanes, kind="stable")
+            written_lines = numpy.concatenate(self.written_lines)[order].tolist()
+            ends = numpy.cumsum(numpy.bincount(written_lanes, minlength=count)).tolist()
+            start = 0
+            for lane, end in enumerate(ends):
+                if end > start:
+                    outputs[lane] = "\n".join(written_lines[start:end]) + "\n"
+                start = end
+        return [LaneResult(output, error) for output, error in zip(outputs, self.errors)]
+
+
+def execute_lanes(commands: List[Instruction], inputs: List[str]) -> List[LaneResult]:
+    """Runs the resolved commands on every input at once. The result of every input is the same as the result of
+    running the tree interpreter on it."""
+    lanes = Lanes(inputs)
+    lanes.execute(commands, numpy.arange(len(inputs)))
+    return lanes.results()
+
+
+def input_file_names(arguments: List[str]) -> List[str]:
+    """Expands the glob patterns, which the shell may have left as they are."""
+    file_names = []
+    for argument in arguments:
+        if glob.has_magic(argument):
+            file_names.extend(sorted(glob.glob(argument)))
+        else:
+            file_names.append(argument)
+    return file_names
+
+
+def print_lanes(commands: List[Instruction], file_names: List[str]) -> int:
+    """Runs the commands on the input files and prints the output of every file after a header, and its errors like
+    the command line interpreter. Returns the exit status."""
+    inputs = []
+    for file_name in file_names:
+        with open(file_name, 'r') as f:
+            inputs.append(f.read())
+    status = 0
+    for file_name, result in zip(file_names, execute_lanes(commands, inputs)):
+        print("==> {0} <==".format(file_name))
+        sys.stdout.write(result.output)
+        if isinstance(result.error, Diagnostic):
+            print(result.error)
+        elif result.error is not None:
+            print("{0}: {1}: {2}".format(file_name, type(result.error).__name__, result.error), file=sys.stderr)
+        if result.error is not None:
+            status = 1
+    return status
@@ -1,4 +1,9 @@
+import re
+from array import array
+from typing import Dict, List, Tuple, Iterator, Optional, Pattern, Union
+
 from sly import Lexer
+from sly.lex import Token
 
 class WhileLexer(Lexer):
     tokens = {
@@ -91,4 +96,170 @@ class WhileLexer(Lexer):
 
     def error(self, t):
         print("Illegal character '%s'" % t.value[0])
-        self.index += 1
\ No newline at end of file
+        self.index += 1
+
+# The fast lexer below produces the same tokens as WhileLexer. It matches every word with a single pattern and
+# looks the keywords up in a table. The keywords are listed in the order of the patterns of WhileLexer: sly takes
+# the first pattern that matches, so a word that starts with a keyword is split, e.g. 'order' is OR and ID 'der'.
+KEYWORDS = (
+    ("program", "PRG"), ("begin", "BEG"), ("boolean", "BOO"), ("natural", "NAT"), ("read", "REA"),
+    ("write", "WRI"), ("if", "IF"), ("then", "THE"), ("else", "ELS"), ("endif", "EIF"), ("end", "END"),
+    ("while", "WHI"), ("repeat", "REP"), ("done", "DON"), ("do", "DO"), ("true", "TRU"), ("false", "FAL"),
+    ("and", "AND"), ("or", "OR"), ("not", "NOT"),
+)
+
+OPERATORS = {
+    ":=": "ASN", "+": "ADD", "-": "SUB", "*": "MUL", "/": "DIV", "%": "MOD", "<=": "LSE", ">=": "GRE", "<": "LS",
+    ">": "GR", "=": "EQ", "?": "QM", ":": "COL", "(": "OP", ")": "CL",
+}
+
+# Token types are stored as their index in this tuple.
+TOKEN_NAMES = tuple(sorted(WhileLexer.tokens))
+TOKEN_CODES = {name: code for code, name in enumerate(TOKEN_NAMES)}
+# The operators are looked up both in text and in bytes.
+OPERATOR_CODES = {**{text: TOKEN_CODES[name] for text, name in OPERATORS.items()},
+                  **{text.encode(): TOKEN_CODES[name] for text, name in OPERATORS.items()}}
+
+# The ignored characters are skipped in front of every token, so they need no match of their own.
+TOKEN_PATTERN_TEMPLATE = r"""
+    [{ignore}]*
+    (?:
+        (?P<word>[a-zA-Z_][a-zA-Z0-9_]*)
+      | (?P<number>\d+)
+      | (?P<operator>:=|<=|>=|[-+*/%<>=?:()])
+      | (?P<newline>\n+)
+      | (?P<comment>\#.*)
+      | (?P<error>{error})
+    )
+"""
+IGNORE = re.escape(WhileLexer.ignore)
+TOKEN_PATTERN = re.compile(TOKEN_PATTERN_TEMPLATE.format(ignore=IGNORE, error=r"[^{0}\n]".format(IGNORE)),
+                           re.VERBOSE)
+# For UTF-8 encoded bytes: an illegal character may take several bytes.
+BYTE_TOKEN_PATTERN = re.compile(TOKEN_PATTERN_TEMPLATE.format(
+    ignore=IGNORE, error=r"[\xc0-\xff][\x80-\xbf]*|[^{0}\n]".format(IGNORE)).encode(), re.VERBOSE)
+
+# The number of distinct words whose tokens a scan remembers. A program uses far fewer, the bound only keeps a
+# long-lived process or a generated program with endless names from holding them all.
+WORD_CACHE_SIZE = 4096
+
+
+class TokenArrays:
+    """The tokens of a text as parallel arrays of type codes, start and end offsets and line numbers. The lexical
+    errors are kept with their line and the number of tokens that precede them, so they can be reported where sly
+    would."""
+
+    names = TOKEN_NAMES
+
+    def __init__(self, text: str):
+        self.text = text
+        self.types = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.lines = array('I')
+        self.errors: List[Tuple[int, int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def value(self, i: int) -> str:
+        return self.text[self.starts[i]:self.ends[i]]
+
+    def token(self, i: int) -> Token:
+        token = Token()
+        token.type = TOKEN_NAMES[self.types[i]]
+        token.value = self.value(i)
+        token.lineno = self.lines[i]
+        token.index = self.starts[i]
+        token.end = self.ends[i]
+        return token
+
+
+class ByteTokenArrays(TokenArrays):
+    """Tokens of UTF-8 encoded bytes, e.g. of a memory mapped file. The offsets are byte offsets."""
+
+    def value(self, i: int) -> str:
+        return self.text[self.starts[i]:self.ends[i]].decode()
+
+
+def split_word(word: str) -> Tuple[Tuple[int, int, int], ...]:
+    tokens = []
+    position = 0
+    while position < len(word):
+        for keyword, name in KEYWORDS:
+            if word.startswith(keyword, position):
+                tokens.append((TOKEN_CODES[name], position, position + len(keyword)))
+                position += len(keyword)
+                break
+        else:
+            if word[position].isdigit():
+                end = position
+                while end < len(word) and word[end].isdigit():
+                    end += 1
+                tokens.append((TOKEN_CODES["NUM"], position, end))
+            else:
+                end = len(word)
+                tokens.append((TOKEN_CODES["ID"], position, end))
+            position = end
+    return tuple(tokens)
+
+
+def tokenize(text: str) -> TokenArrays:
+    return next(scan(TokenArrays, TOKEN_PATTERN, text, None))
+
+
+def tokenize_blocks(data: bytes, block_size: int = 1 << 16) -> Iterator[TokenArrays]:
+    """Tokenizes UTF-8 encoded bytes (e.g. a memory mapped file) lazily, in blocks of about block_size tokens. A
+    block ends at the end of a line."""
+    return scan(ByteTokenArrays, BYTE_TOKEN_PATTERN, data, block_size)
+
+
+def scan(arrays_type: type, pattern: Pattern, text: Union[str, bytes], block_size: Optional[int]) \
+        -> Iterator[TokenArrays]:
+    tokens = arrays_type(text)
+    add_type, add_start, add_end, add_line = (tokens.types.append, tokens.starts.append, tokens.ends.append,
+                                              tokens.lines.append)
+    operator_codes = OPERATOR_CODES
+    number_code = TOKEN_CODES["NUM"]
+    # The tokens of the words seen so far: (type code, start, end) with the offsets relative to the word.
+    word_tokens: Dict[Union[str, bytes], Tuple[Tuple[int, int, int], ...]] = {}
+    line = 1
+    for match in pattern.finditer(text):
+        kind = match.lastgroup
+        start = match.start(match.lastindex)
+        end = match.end()
+        if kind == "word":
+            word = text[start:end]
+            pieces = word_tokens.get(word)
+            if pieces is None:
+                if len(word_tokens) >= WORD_CACHE_SIZE:
+                    word_tokens.clear()
+                pieces = word_tokens[word] = split_word(word if isinstance(word, str) else word.decode())
+            for code, piece_start, piece_end in pieces:
+                add_type(code)
+                add_start(start + piece_start)
+                add_end(start + piece_end)
+                add_line(line)
+        elif kind == "operator":
+            add_type(operator_codes[text[start:end]])
+            add_start(start)
+            add_end(end)
+            add_line(line)
+        elif kind == "number":
+            add_type(number_code)
+            add_start(start)
+            add_end(end)
+            add_line(line)
+        elif kind == "newline":
+            line += end - start
+            if block_size is not None and len(tokens.types) >= block_size:
+                yield tokens
+                tokens = arrays_type(text)
+                add_type, add_start, add_end, add_line = (tokens.types.append, tokens.starts.append,
+                                                          tokens.ends.append, tokens.lines.append)
+        elif kind == "error":
+            character = text[start:end]
+            if not isinstance(character, str):
+                character = character.decode(errors="replace")
+            tokens.errors.append((len(tokens.types), line, "Illegal character '%s'" % character))
+    yield tokens
@@ -1,13 +1,49 @@
-from sly import Parser
+import os
+import sys
 
 from implementation import *
-from optimizer import Optimizer
+from parsetables import CachedParser
 from whilelexel import WhileLexer
 
 
-class WhileParser(Parser):
+def source_file(name: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def run_program(mode: int, name: str, commands: List[Instruction], output: TextIO = None):
+    """Runs, compiles or prints the checked and optimized commands, as the mode says."""
+    reset_frame()
+    if mode == INTERPRETER:
+        execute_program(commands)
+    elif mode == BYTECODE:
+        from bytecode import compile_bytecode, execute_bytecode
+        execute_bytecode(compile_bytecode(commands))
+    elif mode == CLOSURES:
+        compile_to_closures(commands)()
+    elif mode == VECTORIZED:
+        from vectorized import execute_lanes
+        result = execute_lanes(commands, [sys.stdin.read()])[0]
+        sys.stdout.write(result.output)
+        if result.error is not None:
+            raise result.error
+    elif mode == PYTHON:
+        from pythoncode import generate_python
+        generate_python(name, commands).run()
+    elif mode == PYTHON_SOURCE:
+        from pythoncode import generate_python
+        print(generate_python(name, commands).source, end="")
+    elif mode in TARGETS:
+        generate_code(commands, output, TARGETS[mode])
+    elif mode == PRINTER:
+        print_program(name, commands)
+
+
+class WhileParser(CachedParser):
     tokens = WhileLexer.tokens
     start = 'sstart'
+    # Names in capitals would be taken for tokens in the class body.
+    grammar_files = (source_file("whileparser.py"), source_file("whilelexel.py"))
+    tables_file = source_file(os.path.join("__pycache__", "whileparser.tables"))
 
     precedence = (
         ('left', OR),
@@ -19,27 +55,81 @@ class WhileParser(Parser):
         ('right', BNOT),
     )
 
-    def __init__(self):
+    def __init__(self, mode: int = PRINTER, output: TextIO = None, streaming: bool = False, strict: bool = False):
         self.names = {}
+        self.mode = mode
+        self.output = output
+        # A strict parser raises a Diagnostic for the first lexical or syntax error, instead of reporting it and
+        # recovering like sly.
+        self.strict = strict
+        self.syntax_errors = 0
+        self.program_name: str = None
+        # When streaming, the top-level commands are run by the stream as they are parsed, see streaming.py.
+        self.streaming = streaming
+        self.stream = None
 
     @_('')
     def empty(self, p):
         pass
 
-    @_('PRG ID declarations BEG commands END')
+    @_('program_header program_commands END')
     def sstart(self, p):
-        type_check_commands(p.commands)
-
-        commands = p.commands
-
-        Optimizer().optimalize_const_merge(commands)
-        print_program(p.ID, p.commands)
+        if self.stream:
+            self.stream.finish()
+            return []
+
+        commands = p.program_commands
+        type_check_commands(commands)
+
+        # The back ends are imported by the modes that use them, to keep the startup of the others short.
+        from optimizer import Optimizer
+        optimizer = Optimizer()
+        optimizer.optimalize_const_merge(commands)
+        optimizer.eliminate_dead_code(commands)
+        optimizer.hoist_loop_invariants(commands)
+        optimizer.eliminate_common_subexpressions(commands)
+        resolve_commands(commands)
+        run_program(self.mode, p.program_header, commands, self.output)
+        return commands
         #print("-"*20)
         #generate_code(commands)
         # print(symbol_table)
-        # print(value_table)
+        # print(value_frame)
         # print(commands)
 
+    def lexical_error(self, line: int, message: str):
+        if self.strict:
+            raise Diagnostic(line, message)
+        super().lexical_error(line, message)
+
+    def error(self, token):
+        if self.strict:
+            if token is None:
+                raise Diagnostic(-1, "Unexpected end of file")
+            raise Diagnostic(token.lineno, "Syntax error at '{0}'".format(token.value))
+        self.syntax_errors += 1
+        super().error(token)
+
+    @_('PRG ID declarations BEG')
+    def program_header(self, p):
+        self.program_name = p.ID
+        if self.streaming:
+            from streaming import CommandStream
+            self.stream = CommandStream(self.mode, p.ID, self.output)
+        return p.ID
+
+    @_('empty')
+    def program_commands(self, p):
+        return []
+
+    @_('program_commands command')
+    def program_commands(self, p):
+        if self.stream:
+            self.stream.process(p.command)
+        else:
+            p.program_commands.append(p.command)
+        return p.program_commands
+
     @_('empty')
     def declarations(self, p):
         pass
@@ -95,71 +185,71 @@ class WhileParser(Parser):
 
     @_('NUM')
     def expression(self, p):
-        return NumberExpression(p.NUM)
+        return new_number_expression(int(p.NUM))
 
     @_('TRU')
     def expression(self, p):
-        return BooleanExpression(True)
+        return new_boolean_expression(True)
 
     @_('FAL')
     def expression(self, p):
-        return BooleanExpression(False)
+        return new_boolean_expression(False)
 
     @_('ID')
     def expression(self, p):
-        return IdExpression(p.lineno, p.ID)
+        return new_id_expression(p.ID)
 
     @_('expression ADD expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "+", p.expression0, p.expression1)
+        return AddExpression(p.expression0, p.expression1)
 
     @_('expression SUB expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "-", p.expression0, p.expression1)
+        return SubExpression(p.expression0, p.expression1)
 
     @_('expression MUL expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "*", p.expression0, p.expression1)
+        return MulExpression(p.expression0, p.expression1)
 
     @_('expression DIV expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "/", p.expression0, p.expression1)
+        return DivExpression(p.expression0, p.expression1)
 
     @_('expression MOD expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "%", p.expression0, p.expression1)
+        return ModExpression(p.expression0, p.expression1)
 
     @_('expression LS expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "<", p.expression0, p.expression1)
+        return LessExpression(p.expression0, p.expression1)
 
     @_('expression GR expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, ">", p.expression0, p.expression1)
+        return GreaterExpression(p.expression0, p.expression1)
 
     @_('expression LSE expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "<=", p.expression0, p.expression1)
+        return LessEqExpression(p.expression0, p.expression1)
 
     @_('expression GRE expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, ">=", p.expression0, p.expression1)
+        return GreaterEqExpression(p.expression0, p.expression1)
 
     @_('expression AND expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "and", p.expression0, p.expression1)
+        return AndExpression(p.expression0, p.expression1)
 
     @_('expression OR expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "or", p.expression0, p.expression1)
+        return OrExpression(p.expression0, p.expression1)
 
     @_('expression EQ expression')
     def expression(self, p):
-        return BinopExpression(p.lineno, "=", p.expression0, p.expression1)
+        return EqExpression(p.expression0, p.expression1)
 
     @_('NOT expression %prec BNOT')
     def expression(self, p):
-        return NotExpression(p.lineno, "not", p.expression)
+        return NotExpression("not", p.expression)
 
     @_('OP expression CL')
     def expression(self, p):
@@ -167,4 +257,4 @@ class WhileParser(Parser):
 
     @_('OP expression QM expression COL expression CL')
     def expression(self, p):
-        return TernaryExpression(p.lineno, p.expression0, p.expression1, p.expression2)
+        return TernaryExpression(p.expression0, p.expression1, p.expression2)